@@ -0,0 +1,254 @@
+"""Download benchmarks for lapdMouseDBBrowser against a local stand-in server.
+
+The stand-in server serves synthetic files with the layout and (scaled)
+sizes of Resources/allfiles.json, optionally with added latency, limited
+bandwidth and injected connection failures. Results are printed and can be
+written as JSON and compared with the results of another version:
+
+  Slicer --no-main-window --python-script lapdMouseDBBrowserBenchmark.py \\
+    --output new.json --compare old.json
+
+Use --help for all options. The script also runs with a plain Python
+interpreter. It exits with 1 if downloads failed or, with --compare and
+--max-slowdown, if throughput dropped. A short run is registered as a
+CTest test, see Testing/Python/CMakeLists.txt.
+"""
+
+import os
+import sys
+import time
+import json
+import tempfile
+import shutil
+import ssl
+import argparse
+import platform
+import subprocess
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from lapdMouseDBBrowserLib import lapdMouseDBUtil, lapdMouseConnectionPool, lapdMouseDownloadEngine
+from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+
+moduleFolder = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+
+# lapdMouseBrowserWindow.standardFileSelection
+standardFileSelection = ['AutofluorescentSub4.mha', 'AerosolNormalizedSub4.mha', 'Lobes.nrrd', \
+  'AirwayOutlets.vtk', 'AirwayWallDeposition.vtk']
+
+# file size mixes: (name, predicate on catalog entries, size scale factor)
+fileSizeMixes = [
+  ('small', lambda e: e['size']<1024*1024, 1.0),
+  ('medium', lambda e: 1024*1024<=e['size']<100*1024*1024, 0.25),
+  ('standard', lambda e: any(e['name'].endswith('_'+s) for s in standardFileSelection), 1/16.0),
+  ('large', lambda e: e['name'].endswith('Sub2.mha'), 1/64.0),
+  ]
+
+def readCatalog():
+  with open(os.path.join(moduleFolder,'Resources','allfiles.json')) as f:
+    return [e for e in json.load(f) if not e['isFolder'] and os.path.basename(e['name'])!='MD5SUMS']
+
+def selectFiles(catalog, datasets, predicate, scale):
+  # {remoteName: scaled size} of the matching files of the given datasets
+  return {e['name']:int(e['size']*scale) for e in catalog \
+    if e['name'].split('/')[0] in datasets and predicate(e)}
+
+def createFiles(folder, numberOfFiles, fileSize):
+  names = []
+  os.makedirs(os.path.join(folder,'m01'), exist_ok=True)
+  for i in range(numberOfFiles):
+    name = 'm01/m01_File'+str(i)+'.bin'
+    with open(os.path.join(folder,name), 'wb') as f:
+      f.write(os.urandom(fileSize))
+    names.append(name)
+  return names
+
+def createConnectionPool(cafile):
+  connectionPool = lapdMouseConnectionPool()
+  if cafile:
+    connectionPool.sslContext = ssl.create_default_context(cafile=cafile)
+  return connectionPool
+
+def downloadWithoutPool(url, names, localFolder, cafile):
+  # previous behavior: new connection and new SSL context for every file
+  for name in names:
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH, cafile=cafile)
+    context.options |= 0x4  # OP_LEGACY_SERVER_CONNECT
+    response = urllib.request.urlopen(url+name, context=context)
+    with open(os.path.join(localFolder,os.path.basename(name)), 'wb') as f:
+      f.write(response.read())
+    response.close()
+
+def downloadWithPool(url, names, localFolder, cafile):
+  db = lapdMouseDBUtil(url)
+  db.connectionPool = createConnectionPool(cafile)
+  for name in names:
+    db.downloadFile(name, os.path.join(localFolder,os.path.basename(name)))
+  db.connectionPool.clear()
+
+def benchmarkConnectionOverhead(numberOfFiles=100, fileSize=1024, repetitions=3):
+  # per-file overhead of small file downloads over TLS, with and without
+  # connection reuse
+  workFolder = tempfile.mkdtemp()
+  try:
+    remoteFolder = os.path.join(workFolder,'remote')
+    names = createFiles(remoteFolder, numberOfFiles, fileSize)
+    certificateFile = lapdMouseDBBrowserTestServer.createCertificate(workFolder)
+    if certificateFile is None:
+      print('openssl not available, skipping connection overhead benchmark')
+      return None
+    results = {}
+    with lapdMouseDBBrowserTestServer(remoteFolder, certificateFile) as server:
+      for label, download in [('new connection per file', downloadWithoutPool), \
+        ('connection pool', downloadWithPool)]:
+        timings = []
+        for repetition in range(repetitions):
+          localFolder = tempfile.mkdtemp(dir=workFolder)
+          t0 = time.perf_counter()
+          download(server.url, names, localFolder, certificateFile)
+          timings.append((time.perf_counter()-t0)/numberOfFiles)
+        results[label] = min(timings)
+        print('%-25s %8.2f ms/file' % (label, 1000*results[label]))
+    return results
+  finally:
+    shutil.rmtree(workFolder)
+
+def downloadSequential(url, files, localFolder, cafile, scale):
+  # lapdMouseDBUtil.downloadFile, one file after the other; thresholds are
+  # scaled like the file sizes so that the same download paths are taken
+  db = lapdMouseDBUtil(url)
+  db.connectionPool = createConnectionPool(cafile)
+  db.segmentedDownloadThreshold = max(1, int(db.segmentedDownloadThreshold*scale))
+  db.segmentSize = max(1, int(db.segmentSize*scale))
+  failed = 0
+  for name, size in files.items():
+    if not db.downloadFile(name, os.path.join(localFolder,name), size):
+      failed += 1
+  db.connectionPool.clear()
+  return failed
+
+def downloadParallel(url, files, localFolder, cafile, scale, numberOfWorkers=4):
+  # background download queue as used by the browser window
+  engine = lapdMouseDownloadEngine(url, numberOfWorkers=numberOfWorkers)
+  engine.db.connectionPool = createConnectionPool(cafile)
+  engine.db.segmentedDownloadThreshold = max(1, int(engine.db.segmentedDownloadThreshold*scale))
+  engine.db.segmentSize = max(1, int(engine.db.segmentSize*scale))
+  for name, size in files.items():
+    engine.addJob(name, os.path.join(localFolder,name), size)
+  engine.start()
+  engine.wait()
+  engine.db.connectionPool.clear()
+  return len(engine.failedJobs())
+
+def benchmarkThroughput(datasets=['m01'], mixes=None, scale=1.0, latency=0, bandwidth=0, \
+  failureRate=0, useTLS=False, repetitions=1):
+  # files/s and MB/s per file size mix and download method
+  catalog = readCatalog()
+  results = []
+  workFolder = tempfile.mkdtemp()
+  try:
+    certificateFile = lapdMouseDBBrowserTestServer.createCertificate(workFolder) if useTLS else None
+    if useTLS and certificateFile is None:
+      print('openssl not available, using HTTP')
+    for mixName, predicate, mixScale in fileSizeMixes:
+      if mixes and mixName not in mixes:
+        continue
+      files = selectFiles(catalog, datasets, predicate, mixScale*scale)
+      if len(files)==0:
+        continue
+      for method, download in [('downloadFile', downloadSequential), ('engine', downloadParallel)]:
+        with lapdMouseDBBrowserTestServer(syntheticFiles=files, certificateFile=certificateFile, \
+          latency=latency, bandwidth=bandwidth, failureRate=failureRate) as server:
+          timings = []
+          failed = 0
+          for repetition in range(repetitions):
+            localFolder = tempfile.mkdtemp(dir=workFolder)
+            t0 = time.perf_counter()
+            failed += download(server.url, files, localFolder, certificateFile, mixScale*scale)
+            timings.append(time.perf_counter()-t0)
+            shutil.rmtree(localFolder)
+          seconds = min(timings)
+          numberOfBytes = sum(files.values())
+          result = {'mix':mixName, 'method':method, 'files':len(files), 'bytes':numberOfBytes, \
+            'seconds':seconds, 'filesPerSecond':len(files)/seconds, \
+            'MBPerSecond':numberOfBytes/seconds/1e6, 'failedDownloads':failed, \
+            'injectedFailures':server.failureCount, 'connections':server.connectionCount}
+          results.append(result)
+          print('%-10s %-14s %5d files %10.1f MB %8.2f s %9.2f files/s %9.2f MB/s' % (mixName, method, \
+            len(files), numberOfBytes/1e6, seconds, result['filesPerSecond'], result['MBPerSecond']))
+    return results
+  finally:
+    shutil.rmtree(workFolder)
+
+def versionLabel():
+  try:
+    return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=moduleFolder, \
+      check=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout.decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return 'unknown'
+
+def compareResults(previous, current, maxSlowdown=None):
+  # ratio current/previous of the throughput for each (mix, method); returns
+  # False if a throughput dropped by more than the fraction maxSlowdown
+  previousResults = {(r['mix'], r['method']):r for r in previous['throughput']}
+  print('Compared to '+previous['version']+':')
+  withinLimit = True
+  for r in current['throughput']:
+    p = previousResults.get((r['mix'], r['method']))
+    if p is None:
+      continue
+    ratio = r['MBPerSecond']/p['MBPerSecond']
+    print('%-10s %-14s %6.2fx files/s %6.2fx MB/s' % (r['mix'], r['method'], \
+      r['filesPerSecond']/p['filesPerSecond'], ratio))
+    if maxSlowdown is not None and ratio<1-maxSlowdown:
+      print('%-10s %-14s slower than allowed' % (r['mix'], r['method']))
+      withinLimit = False
+  return withinLimit
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='lapdMouseDBBrowser download benchmarks')
+  parser.add_argument('--datasets', default='m01', help='comma separated dataset names (default: m01)')
+  parser.add_argument('--mixes', default=','.join(m[0] for m in fileSizeMixes), \
+    help='comma separated file size mixes (default: all)')
+  parser.add_argument('--scale', type=float, default=1.0, help='additional file size scale factor')
+  parser.add_argument('--latency', type=float, default=0, help='server latency per request in seconds')
+  parser.add_argument('--bandwidth', type=float, default=0, help='server bandwidth per connection in MB/s (0: unlimited)')
+  parser.add_argument('--failure-rate', type=float, default=0, help='fraction of transfers cut off half way')
+  parser.add_argument('--tls', action='store_true', help='use HTTPS')
+  parser.add_argument('--repetitions', type=int, default=1)
+  parser.add_argument('--skip-connection-overhead', action='store_true')
+  parser.add_argument('--label', default=None, help='version label stored in the results (default: git describe)')
+  parser.add_argument('--output', default=None, help='write results as JSON to this file')
+  parser.add_argument('--compare', default=None, help='JSON results of a previous run to compare with')
+  parser.add_argument('--max-slowdown', type=float, default=None, \
+    help='with --compare, fail if a throughput dropped by more than this fraction, e.g. 0.2')
+  args = parser.parse_args(argv)
+
+  parameters = {'datasets':args.datasets.split(','), 'mixes':args.mixes.split(','), 'scale':args.scale, \
+    'latency':args.latency, 'bandwidth':args.bandwidth*1e6, 'failureRate':args.failure_rate, \
+    'useTLS':args.tls, 'repetitions':args.repetitions}
+  results = {'version':args.label or versionLabel(), 'timestamp':time.strftime('%Y-%m-%dT%H:%M:%S'), \
+    'python':platform.python_version(), 'platform':platform.platform(), 'parameters':parameters}
+  if not args.skip_connection_overhead:
+    results['connectionOverhead'] = benchmarkConnectionOverhead()
+  results['throughput'] = benchmarkThroughput(**parameters)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+  # exit code 1 if downloads failed or throughput dropped, see --max-slowdown
+  exitCode = 0
+  if any(r['failedDownloads'] for r in results['throughput']):
+    print('Downloads failed')
+    exitCode = 1
+  if args.compare:
+    with open(args.compare) as f:
+      if not compareResults(json.load(f), results, args.max_slowdown):
+        exitCode = 1
+  return exitCode
+
+if __name__ == '__main__':
+  exitCode = main(sys.argv[1:])
+  if 'slicer' in sys.modules:
+    import slicer
+    slicer.util.exit(exitCode)
+  sys.exit(exitCode)
@@ -1,3 +1,8 @@
+import time
+# (phase, step, time.perf_counter() at the end of the step) of module import,
+# module setup and the first display of the browser window, a step None
+# starts a phase; see reportStartupTimes
+startupTimes = [('module import', None, time.perf_counter())]
 import os
 import unittest
 import vtk, qt, ctk, slicer
@@ -7,212 +12,305 @@ import json
 import sys
 import urllib
 import time, sys, ssl, urllib.request, urllib.error
+import hashlib, tarfile, shutil, threading
+startupTimes.append(('module import', 'Slicer and standard library modules', time.perf_counter()))
 
-class lapdMouseDBUtil():
+from lapdMouseDBBrowserLib import *
+startupTimes.append(('module import', 'lapdMouseDBBrowserLib', time.perf_counter()))
 
-  def __init__(self, remoteFolderUrl):
-    self.gdriveURL = remoteFolderUrl
-    if 'lapdMouseDBBrowser' in slicer.util.moduleNames():
-      self.modulePath = slicer.modules.lapdmousedbbrowser.path.replace("lapdMouseDBBrowser.py","")
-    else:
-      self.modulePath = '.'
+def startupTimeReport(times, phases=None):
+  # lines with the duration of each step in times (see startupTimes) and
+  # the total of each phase, restricted to phases if given
+  lines, phaseStart, previous = [], {}, {}
+  for phase, step, t in times:
+    if phases is not None and phase not in phases:
+      continue
+    if step is None:
+      phaseStart[phase] = previous[phase] = t
+      continue
+    if phase not in previous:
+      continue
+    lines.append('  %-40s %8.3f s' % (phase+': '+step, t-previous[phase]))
+    previous[phase] = t
+  for phase in phaseStart:
+    lines.append('  %-40s %8.3f s' % (phase+' total', previous[phase]-phaseStart[phase]))
+  return lines
 
-  def _canAccess(self):
-    # Create a secure SSL context
-    ctx = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-    ctx.options |= 0x4  # OP_LEGACY_SERVER_CONNECT
+def reportStartupTimes(phases=None):
+  # prints startupTimeReport if enabled with the setting
+  # lapdMouseDBBrowserTimingReport = "true"
+  if qt.QSettings().value("lapdMouseDBBrowserTimingReport", "false")!="true":
+    return
+  print('lapdMouseDBBrowser startup times:')
+  for line in startupTimeReport(startupTimes, phases):
+    print(line)
 
-    try:
-      httpCode = urllib.request.urlopen(self.gdriveURL+'m01/MD5SUMS',context=ctx).getcode()
-      if (httpCode == 200):
-        return True
-      else:
-        print(f"Unexpected HTTP error ({httpCode}.")
-        return False
-    except urllib.error.HTTPError as e:
-      print('The server couldn\'t fulfill the request.')
-      print('Error code: ', e.code)
-      return False
-    except urllib.error.URLError as e:
-      print('We failed to reach a server.')
-      print('Reason: ', e.reason)
-      return False
-    except:
-      print("Unexpected error:", sys.exc_info()[0])
-      return False
+def finerResolutionFileName(name, finestLevel=''):
+  # next resolution level of volume name ('m01_AerosolSub4.mha' ->
+  # 'm01_AerosolSub2.mha' -> 'm01_Aerosol.mha'), None if name is at
+  # finestLevel ('Sub2' or '' for full resolution) already
+  levels = ['Sub4', 'Sub2', '']
+  base, extension = os.path.splitext(name)
+  for i, level in enumerate(levels[:levels.index(finestLevel)]):
+    if base.endswith(level):
+      return base[:len(base)-len(level)]+levels[i+1]+extension
+  return None
 
-  def listDirectory(self, dirname='',depth=0):
-    return self._listFolderRemote(dirname, depth)
-    
-  def downloadFile(self, src, dst):
-    if not os.path.exists(os.path.dirname(dst)):
-      os.makedirs(os.path.dirname(dst))
-    self._downloadFileFromRemote(src, dst)
+class lapdMouseDownloadQueueWidget(qt.QWidget):
+  # Non-modal window listing the jobs of a lapdMouseDownloadEngine with
+  # progress, throughput and ETA. Worker threads never touch Qt: a timer on
+  # the main thread polls the engine, updates the table and calls
+  # jobFinishedCallback(job) and the callbacks registered with addBatch().
 
-  def _downloadFileFromRemote(self, src, destination):
-    requestUrl = self.gdriveURL + src
-    try:
-      request = urllib.request.Request(requestUrl)
-      response = urllib.request.urlopen(request)
-    except urllib.error.HTTPError as e:
-      print('The server couldn\'t fulfill the request.')
-      print('Error code: ', e.code, flush=True)
-      return
-    except urllib.error.URLError as e:
-      print('We failed to reach a server.')
-      print('Reason: ', e.reason, flush=True)
-      return
-    self._downloadURLStreaming(response, destination)
-
-  def _downloadURLStreaming(self,response,destination):
-    if response.getcode() == 200:
-      destinationFile = open(destination, "wb")
-      bufferSize = 1024*1024
-      while True:
-        buffer = response.read(bufferSize)
-        if not buffer:
-          break
-        destinationFile.write(buffer)
-      destinationFile.close()
-
-  def _listFolderRemote(self,dirname,depth=0):
-    # Read file with file names and metadata
-    try:
-      with open(os.path.join(self.modulePath,'Resources','allfiles.json')) as infile:
-        data = infile.read()
-      allcontent = json.loads(data)
-    except:
-      return []
+  def __init__(self, engine, parent=None):
+    super().__init__(parent)
+    self.engine = engine
+    self.jobFinishedCallback = None
+    self.batches = []
+    self._finishedJobs = set()
+    self.setWindowTitle("lapdMouse downloads")
+    self.resize(700,300)
+    self.setLayout(qt.QVBoxLayout())
+    self.summaryLabel = qt.QLabel()
+    self.layout().addWidget(self.summaryLabel)
+    self.table = qt.QTableWidget(self)
+    self.table.setColumnCount(5)
+    self.table.setHorizontalHeaderLabels(["File","Status","Progress","Speed","ETA"])
+    self.table.horizontalHeader().setSectionResizeMode(0, qt.QHeaderView.Stretch)
+    self.table.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.table.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+    self.layout().addWidget(self.table)
+    actions = qt.QFrame(self)
+    actions.setLayout(qt.QHBoxLayout())
+    actions.layout().setMargin(0)
+    for label, callback in [('pause', self.engine.pauseJob), ('resume', self.engine.resumeJob), \
+      ('cancel', self.engine.cancelJob)]:
+      button = qt.QPushButton(label+" selected", actions)
+      button.connect("clicked()", lambda callback=callback: self.onAction(callback))
+      actions.layout().addWidget(button)
+    self.layout().addWidget(actions)
+    self.timer = qt.QTimer()
+    self.timer.setInterval(500)
+    self.timer.connect('timeout()', self.refresh)
+    self.timer.start()
 
-    dircontent = []
-    for oneFile in allcontent:
-      if (dirname == '.' or os.path.commonprefix([dirname,oneFile['name']]) == dirname):
-        remainingPath = oneFile['name'][len(dirname)+1:]
-        if (remainingPath.count('/') <= depth):
-          oneFile['name'] = os.path.basename(oneFile['name'])
-          dircontent.append(oneFile)
-    return dircontent
-
-  def _splitPath(self, p):
-    a,b = os.path.split(p)
-    return (self._splitPath(a) if len(a) and len(b) else []) + [b]
-
-def humanReadableSize(size):
-  if size==None:
-    return ""
-  sizeString = "%.1f B"%size
-  if (size>pow(1024.0,1)):
-    sizeString="%.1f KB"%(size/pow(1024.0,1))
-  if (size>pow(1024.0,2)):
-    sizeString="%.1f MB"%(size/pow(1024.0,2))
-  if (size>pow(1024.0,3)):
-    sizeString="%.1f GB"%(size/pow(1024.0,3))
-  if (size>pow(1024.0,4)):
-    sizeString="%.1f TB"%(size/pow(1024.0,4))
-  return sizeString
-
-def humanReadableTime(seconds):
-  return time.strftime("%H:%M:%S", time.gmtime(seconds))
-
-def getStatus(item):
-  remoteSize = item['size']
-  remoteModificationTime = item['modificationTimestamp']/1000
-  realPath = os.path.realpath(os.path.expanduser(item['localName']))
-  status = 'require download'
-  if os.path.exists(realPath):
-    localModificationTime = os.path.getmtime(realPath)
-    status = 'downloaded'
-    if not item['isFolder']:
-      localSize = os.path.getsize(realPath)
-      if remoteSize!=localSize or \
-        remoteModificationTime>localModificationTime:
-        status = 'require update'
-  return status
-
-def summarizeItems(items):
-  summaryString = ''
-  remoteFiles = items
-  summaryString += 'Matching files/folders: total='+str(len(remoteFiles))
-  if len(remoteFiles)>0:
-    summaryString+='('+humanReadableSize(sum(i['size'] for i in remoteFiles))+')'
-  filesAlreadyDownloaded = [i for i in remoteFiles if i['status']=='downloaded']
-  summaryString += ', downloaded='+str(len(filesAlreadyDownloaded))
-  if len(filesAlreadyDownloaded)>0:
-    summaryString+='('+humanReadableSize(sum(i['size'] for i in filesAlreadyDownloaded))+')'
-  filesForDownload = [i for i in remoteFiles if i['status']=='require download']
-  summaryString += ', require download='+str(len(filesForDownload))
-  if len(filesForDownload)>0:
-    summaryString+='('+humanReadableSize(sum(i['size'] for i in filesForDownload))+')'
-  filesOutOfDate = [i for i in remoteFiles if i['status']=='require update']
-  summaryString += ', require update='+str(len(filesOutOfDate))
-  if len(filesOutOfDate)>0:
-    summaryString+='('+humanReadableSize(sum(i['size'] for i in filesOutOfDate))+')'
-  print(summaryString)
-
-def listItem(item):
-  remoteName = item['remoteName'] 
-  localName = item['localName']
-  message = remoteName
-  if item['isFolder']:
-    message+=' -> '+localName+' (folder)'
-  else:
-    message+=' -> '+localName+' ('+item['status']+'; '+humanReadableSize(item['size'])+')'
-  print(message)
-
-def downloadItem(item, db):
-  listItem(item)
-  remoteName = item['remoteName']
-  localName = item['localName']
-  realPath = os.path.realpath(os.path.expanduser(localName))
-  isFolder = item['isFolder']
-  if os.path.exists(realPath) and os.path.isfile(realPath):
-    os.remove(realPath)
-  if isFolder and not(os.path.exists(realPath)):
-    os.makedirs(realPath)
-    return
-  if not isFolder and not(os.path.exists(os.path.dirname(realPath))):
-    os.makedirs(os.path.dirname(realPath))
-
-  sys.stdout.write('  Downloading ...')
-  sys.stdout.flush()
-  t0 = time.time()
-  try:
-    db.downloadFile(remoteName, realPath)
-  except:
-    print("Unexpected error:", sys.exc_info()[0])
-    if os.path.exists(realPath) and os.path.isfile(realPath):
-      os.remove(realPath)
-  t1 = time.time()
-  downloadSucceeded = os.path.exists(realPath)
-  sys.stdout.write( ( '[DONE]' if downloadSucceeded else '[ERROR]')+' time: '+time.strftime("%M:%S", time.gmtime(t1-t0))+'\n')
-  if not downloadSucceeded:
-    return 'ERROR: download failed for file: '+localName
-  else:
+  def addBatch(self, jobs, callback):
+    # callback() is called once every job in jobs has finished
+    self.batches.append((jobs, callback))
+    self.refresh()
+
+  def onAction(self, callback):
+    for index in self.table.selectionModel().selectedRows():
+      callback(self.engine.jobs[index.row()])
+    self.refresh()
+
+  def refresh(self):
+    jobs = list(self.engine.jobs)
+    self.table.setRowCount(len(jobs))
+    for i, job in enumerate(jobs):
+      size = job['size'] or 0
+      fraction = float(job['bytesDownloaded'])/size if size else (1.0 if job['status']=='done' else 0.0)
+      speed = self.engine.jobThroughput(job)
+      eta = ''
+      if job['status']=='downloading' and speed>0 and size:
+        eta = humanReadableTime((size-job['bytesDownloaded'])/speed)
+      status = job['status']
+      if status=='queued' and not self.engine.isAllowedNow(job['priority']):
+        status = 'scheduled for %02d:00' % self.engine.allowedHours[job['priority']][0]
+      cells = [os.path.basename(job['localName']), status, '%.0f %%' % (100*fraction), \
+        humanReadableSize(speed)+'/s' if job['status']=='downloading' else '', eta]
+      for column, text in enumerate(cells):
+        item = self.table.item(i, column)
+        if item is None:
+          self.table.setItem(i, column, qt.QTableWidgetItem(text))
+        elif item.text()!=text:
+          item.setText(text)
+    filesFinished, filesTotal, bytesDownloaded, bytesTotal = self.engine.progress()
+    throughput = self.engine.throughput()
+    summary = str(filesFinished)+' of '+str(filesTotal)+' file(s) finished, '+\
+      humanReadableSize(bytesDownloaded)+' of '+humanReadableSize(bytesTotal)
+    if self.engine.isRunning():
+      summary += ', '+humanReadableSize(throughput)+'/s'
+      if throughput>0:
+        summary += ', ETA '+humanReadableTime((bytesTotal-bytesDownloaded)/throughput)
+    self.summaryLabel.text = summary
+    self._notify(jobs)
+
+  def _notify(self, jobs):
+    finishedStates = ['done','failed','corrupt','canceled']
+    for job in jobs:
+      if job['status'] in finishedStates and id(job) not in self._finishedJobs:
+        self._finishedJobs.add(id(job))
+        if self.jobFinishedCallback:
+          self.jobFinishedCallback(job)
+      elif job['status'] not in finishedStates:
+        self._finishedJobs.discard(id(job)) # resumed
+    for batch in list(self.batches):
+      jobs, callback = batch
+      if all(j['status'] in finishedStates+['paused'] for j in jobs) and \
+        (len(jobs)==0 or any(j['status']!='paused' for j in jobs)):
+        self.batches.remove(batch)
+        callback()
+
+class lapdMouseDatasetTableModel(qt.QAbstractTableModel):
+  # Names of the datasets, one per row; only rows whose dataset changed are
+  # reported to the views, see setDatasets.
+
+  headers = ["Dataset name"]
+
+  def __init__(self, parent=None):
+    super().__init__(parent)
+    self.datasets = []
+
+  def setDatasets(self, datasets):
+    if len(datasets)<len(self.datasets):
+      self.beginRemoveRows(qt.QModelIndex(), len(datasets), len(self.datasets)-1)
+      self.datasets = self.datasets[:len(datasets)]
+      self.endRemoveRows()
+    elif len(datasets)>len(self.datasets):
+      self.beginInsertRows(qt.QModelIndex(), len(self.datasets), len(datasets)-1)
+      self.datasets = self.datasets+list(datasets[len(self.datasets):])
+      self.endInsertRows()
+    for i, datasetname in enumerate(datasets):
+      if self.datasets[i]!=datasetname:
+        self.datasets[i] = datasetname
+        self.dataChanged(self.index(i,0), self.index(i,0))
+
+  def rowCount(self, parent=None):
+    return 0 if parent is not None and parent.isValid() else len(self.datasets)
+
+  def columnCount(self, parent=None):
+    return 0 if parent is not None and parent.isValid() else len(self.headers)
+
+  def data(self, index, role=qt.Qt.DisplayRole):
+    if not index.isValid():
+      return None
+    return self.cellData(index.row(), index.column(), role)
+
+  def cellData(self, i, column, role):
+    if i<len(self.datasets) and column==0 and role==qt.Qt.DisplayRole:
+      return self.datasets[i]
+    return None
+
+  def headerData(self, section, orientation, role=qt.Qt.DisplayRole):
+    if orientation==qt.Qt.Horizontal and role==qt.Qt.DisplayRole and section<len(self.headers):
+      return self.headers[section]
     return None
 
-def testDBAccess(db):
-  serverStatus = 'unknown'
-  if lapdMouseDBUtil._canAccess():
-    serverStatus = 'available'
-  else:
-    serverStatus = 'unavailable'
-  print('DB access status: '+serverStatus)
-  return True if serverStatus=='available' else False
+class lapdMouseFileTableModel(qt.QAbstractTableModel):
+  # Status, file name and size of the files of a dataset. A row is a dict
+  # with name, size, sizeText, status (see getStatus), toolTip and
+  # filterKey; only changed rows are reported to the views, see setRow.
+  # sortRole and filterRole data is used by the QSortFilterProxyModel of
+  # lapdMouseBrowserWindow.
+
+  headers = ["Status","Filename", "Size"]
+  statusOrder = {'downloaded':0, 'require update':1, 'require download':2}
+
+  def __init__(self, icons, sortRole, filterRole, parent=None):
+    # icons: status -> QIcon
+    super().__init__(parent)
+    self.icons = icons
+    self.sortRole = sortRole
+    self.filterRole = filterRole
+    self.rows = []
+    self.rowIndex = {} # file name -> row
+
+  def setRows(self, rows):
+    self.beginResetModel()
+    self.rows = rows
+    self.rowIndex = {row['name']:i for i, row in enumerate(rows)}
+    self.endResetModel()
+
+  def setRow(self, i, row):
+    self.rows[i] = row
+    self.dataChanged(self.index(i,0), self.index(i,len(self.headers)-1))
+
+  def rowCount(self, parent=None):
+    return 0 if parent is not None and parent.isValid() else len(self.rows)
+
+  def columnCount(self, parent=None):
+    return 0 if parent is not None and parent.isValid() else len(self.headers)
 
+  def data(self, index, role=qt.Qt.DisplayRole):
+    if not index.isValid():
+      return None
+    return self.cellData(index.row(), index.column(), role)
+
+  def cellData(self, i, column, role):
+    if i>=len(self.rows):
+      return None
+    row = self.rows[i]
+    if column==0:
+      if role==qt.Qt.DecorationRole:
+        return self.icons.get(row['status'])
+      if role==qt.Qt.ToolTipRole:
+        return row['toolTip']
+      if role==self.sortRole:
+        return self.statusOrder[row['status']]
+      if role==self.filterRole:
+        return row['filterKey']
+    elif column==1:
+      if role==qt.Qt.DisplayRole:
+        return row['name']
+      if role==self.sortRole:
+        return row['name'].lower()
+    elif column==2:
+      if role==qt.Qt.DisplayRole:
+        return row['sizeText']
+      if role==self.sortRole:
+        return row['size']
+    return None
+
+  def headerData(self, section, orientation, role=qt.Qt.DisplayRole):
+    if orientation==qt.Qt.Horizontal and role==qt.Qt.DisplayRole and section<len(self.headers):
+      return self.headers[section]
+    return None
 
 class lapdMouseBrowserWindow(qt.QMainWindow):
 
+  standardFileSelection = ['AutofluorescentSub4.mha','AerosolNormalizedSub4.mha', \
+    'Lobes.nrrd','AirwayOutlets.vtk', 'AirwayWallDeposition.vtk']
+  # download priorities, lower values are downloaded first
+  standardPriority, defaultPriority, bulkPriority = 0, 1, 2
+  # data roles of the file table used by fileFilterModel
+  sortRole, filterRole = qt.Qt.UserRole, qt.Qt.UserRole+1
+  # (label, upper bound in bytes) of the size filter
+  sizeClasses = [('< 1 MB', 1024*1024), ('1 MB - 100 MB', 100*1024*1024), ('100 MB - 1 GB', 1024*1024*1024), \
+    ('> 1 GB', None)]
+
   def __init__(self, parent=None):
     super().__init__(parent)
     self.table = None
     self.workingDirectory = None
+    self.manifest = None
+    self.downloadQueue = None
+    self.downloadQueueWidget = None
     self.isEditing = False
     self.datasets = []
-    self.remoteFolderUrl = 'https://cebs-ext.niehs.nih.gov/cahs/file/download/lapd/'
+    self.remoteFolderUrl = defaultRemoteFolderUrl
     self.localCacheFolder = os.path.join(os.path.expanduser("~"),'lapdMouse')
     self.projectUrl='https://cebs-ext.niehs.nih.gov/cahs/report/lapd/web-download-links/'
+    self.numberOfDownloadWorkers = 4
+    self.bandwidthLimit = 0 # bytes per second, 0 for no limit
+    self.bulkDownloadHours = None # (startHour, endHour) for raw data downloads
+    # finest resolution level ('Sub2' or '') loaded volumes are upgraded to
+    # in the background, None to keep the loaded level
+    self.progressiveLoading = None
+    self.sharedCacheFolder = None # see lapdMouseSharedCache
+    self.cacheSizeLimit = 0 # bytes, 0 for no limit, see enforceCacheSizeLimit
+    self.cacheUsageCallback = None # called when files were added or removed
+    self.loadedFiles = set() # remote names loaded since the scene was closed
+    self.compressVolumes = False # see setCompressVolumes
+    self.compressor = None
+    self.folderScans = {} # dataset name -> scanFolder of its local folder
+    self.changedFolders = set() # reported by fileSystemWatcher
     self.notesUrl='https://cebs-ext.niehs.nih.gov/cahs/file/lapd/pages/notes/'
     self.setupWindow()
+    self.fileSystemWatcher = qt.QFileSystemWatcher()
+    self.fileSystemWatcher.connect('directoryChanged(QString)', self.onDirectoryChanged)
+    if slicer.mrmlScene:
+      slicer.mrmlScene.AddObserver(slicer.mrmlScene.EndCloseEvent, self.onSceneClosed)
 
   def setupWindow(self):
     self.setWindowTitle("lapdMouse Data Archive Browser")
@@ -243,15 +341,15 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
     self.bannerTextBrowser.html=text
     self.banner.layout().addWidget(self.bannerTextBrowser,0,1)
 
-    self.table = qt.QTableWidget(self)
-    self.table.setRowCount(0)
-    self.table.setColumnCount(1)
+    self.datasetModel = lapdMouseDatasetTableModel(self)
+    self.table = qt.QTableView(self)
+    self.table.setModel(self.datasetModel)
     self.table.setSizePolicy(qt.QSizePolicy.Expanding,qt.QSizePolicy.Expanding)
-    self.table.setHorizontalHeaderLabels(["Dataset name"])#,"Status","Comment"])
     self.table.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
     self.table.setSelectionMode(qt.QAbstractItemView.SingleSelection)
+    self.table.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
     self.table.horizontalHeader().setStretchLastSection(True)
-    self.table.connect("itemSelectionChanged()",self.onDatasetChanged)
+    self.table.selectionModel().connect("selectionChanged(QItemSelection,QItemSelection)",self.onDatasetChanged)
 
     self.customForm = qt.QFrame()
     self.customForm.setLayout(qt.QFormLayout())
@@ -272,13 +370,48 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
     self.customFormLoadButton = qt.QPushButton("load standard file selection in Slicer", self.customFormAction)
     self.customFormAction.layout().addWidget(self.customFormLoadButton)
     self.customFormLoadButton.connect("clicked()", self.onLoadDataset)
+    self.customFormUpdateButton = qt.QPushButton("update outdated files", self.customFormAction)
+    self.customFormUpdateButton.toolTip = "Download the newer versions of downloaded files that changed in the archive."
+    self.customFormAction.layout().addWidget(self.customFormUpdateButton)
+    self.customFormUpdateButton.connect("clicked()", self.onUpdateDataset)
+    self.customFormQueueButton = qt.QPushButton("show download queue", self.customFormAction)
+    self.customFormAction.layout().addWidget(self.customFormQueueButton)
+    self.customFormQueueButton.connect("clicked()", self.showDownloadQueue)
     self.customForm.layout().addRow("Quick actions",self.customFormAction)
-    self.customFormFiles = qt.QTableWidget(self.customForm)
-    self.customFormFiles.setRowCount(0)
-    self.customFormFiles.setColumnCount(3)
-    self.customFormFiles.setHorizontalHeaderLabels(["Status","Filename", "Size"])
+    self.customFormFilter = qt.QFrame(self.customForm)
+    self.customFormFilter.setLayout(qt.QHBoxLayout())
+    self.customFormFilter.layout().setSpacing(0)
+    self.customFormFilter.layout().setMargin(0)
+    self.customFormStatusFilter = qt.QComboBox(self.customFormFilter)
+    self.customFormStatusFilter.addItem("all files", "")
+    self.customFormStatusFilter.addItem("downloaded", "downloaded")
+    self.customFormStatusFilter.addItem("newer version available", "require update")
+    self.customFormStatusFilter.addItem("available for download", "require download")
+    self.customFormFilter.layout().addWidget(self.customFormStatusFilter)
+    self.customFormSizeFilter = qt.QComboBox(self.customFormFilter)
+    self.customFormSizeFilter.addItem("any size", "")
+    for label, upperBound in self.sizeClasses:
+      self.customFormSizeFilter.addItem(label, label)
+    self.customFormFilter.layout().addWidget(self.customFormSizeFilter)
+    self.customFormStatusFilter.connect("currentIndexChanged(int)", self.onFileFilterChanged)
+    self.customFormSizeFilter.connect("currentIndexChanged(int)", self.onFileFilterChanged)
+    self.customForm.layout().addRow("Show",self.customFormFilter)
+    # rows of fileModel are updated in place, sorting and filtering is done
+    # by fileFilterModel on the sortRole and filterRole data of the rows
+    self.fileModel = lapdMouseFileTableModel({'downloaded':self.storedIcon, 'require update':self.storedIcon, \
+      'require download':self.downloadIcon}, self.sortRole, self.filterRole, self)
+    self.fileFilterModel = qt.QSortFilterProxyModel(self)
+    self.fileFilterModel.setSourceModel(self.fileModel)
+    self.fileFilterModel.sortRole = self.sortRole
+    self.fileFilterModel.filterRole = self.filterRole
+    self.fileFilterModel.filterKeyColumn = 0
+    self.customFormFiles = qt.QTableView(self.customForm)
+    self.customFormFiles.setModel(self.fileFilterModel)
     self.customFormFiles.horizontalHeader().setSectionResizeMode(1, qt.QHeaderView.Stretch)
     self.customFormFiles.setSelectionBehavior(qt.QAbstractItemView.SelectRows)
+    self.customFormFiles.setEditTriggers(qt.QAbstractItemView.NoEditTriggers)
+    self.customFormFiles.setSortingEnabled(True)
+    self.customFormFiles.horizontalHeader().setSortIndicator(-1, qt.Qt.AscendingOrder) # catalog order
     self.customFormFiles.setMinimumHeight(400)
     self.customForm.layout().addRow("Files",self.customFormFiles)
     
@@ -295,7 +428,27 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
     self.customFormLoadButton2 = qt.QPushButton("load selected files in Slicer", self.customFormAction2)
     self.customFormAction2.layout().addWidget(self.customFormLoadButton2)
     self.customFormLoadButton2.connect("clicked()", self.onLoadSelectedDataset)
+    self.customFormPinButton2 = qt.QPushButton("pin/unpin selected files", self.customFormAction2)
+    self.customFormPinButton2.toolTip = "Pinned files are never removed to keep the storage folder within its size limit."
+    self.customFormAction2.layout().addWidget(self.customFormPinButton2)
+    self.customFormPinButton2.connect("clicked()", self.onPinSelectedFiles)
     self.customForm.layout().addRow("",self.customFormAction2)
+
+    self.customFormSearch = qt.QFrame(self.customForm)
+    self.customFormSearch.setLayout(qt.QHBoxLayout())
+    self.customFormSearch.layout().setSpacing(0)
+    self.customFormSearch.layout().setMargin(0)
+    self.customFormSearchText = qt.QLineEdit(self.customFormSearch)
+    self.customFormSearchText.placeholderText = "file name in all datasets, e.g. *_LobesDeposition.csv or Sub4.mha"
+    self.customFormSearch.layout().addWidget(self.customFormSearchText)
+    self.customFormSearchText.connect("textChanged(QString)", self.onSearchChanged)
+    self.customFormSearchResult = qt.QLabel(self.customFormSearch)
+    self.customFormSearch.layout().addWidget(self.customFormSearchResult)
+    self.customFormSearchDownloadButton = qt.QPushButton("download all matches", self.customFormSearch)
+    self.customFormSearchDownloadButton.enabled = False
+    self.customFormSearch.layout().addWidget(self.customFormSearchDownloadButton)
+    self.customFormSearchDownloadButton.connect("clicked()", self.onDownloadSearchResults)
+    self.customForm.layout().addRow("Search",self.customFormSearch)
     
     splitView = qt.QSplitter(self)
     splitView.addWidget(self.table)
@@ -308,30 +461,77 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
     self.setCentralWidget(splitView)
     
   def load(self):
-    self.datasets = [d['name'] for d in lapdMouseDBUtil(self.remoteFolderUrl).listDirectory() if d["isFolder"]==True]
+    self.manifest = lapdMouseCacheManifest(self.localCacheFolder)
+    self.folderScans = {}
+    if len(self.fileSystemWatcher.directories()):
+      self.fileSystemWatcher.removePaths(self.fileSystemWatcher.directories())
+    if os.path.isdir(self.localCacheFolder):
+      self.fileSystemWatcher.addPath(self.localCacheFolder)
+    if self.downloadQueue:
+      self.downloadQueue.manifest = self.manifest
+    self.setCompressVolumes(self.compressVolumes)
+    self.updateDatasets()
+    self.refreshCatalog()
+    if self.cacheUsageCallback:
+      self.cacheUsageCallback()
+
+  def updateDatasets(self):
+    self.datasets = [d['name'] for d in self.getDB().listDirectory() if d["isFolder"]==True]
     if os.path.exists(self.localCacheFolder):
       localFolders = [d for d in os.listdir(self.localCacheFolder) if \
         os.path.isdir(os.path.join(self.localCacheFolder,d))]
       self.datasets = list(set(self.datasets).union(set(localFolders)))
     self.datasets.sort()
     self.updateTable()
-  
-  def updateTable(self):
-    self.table.setRowCount(len(self.datasets))
-    for i in range(len(self.datasets)):
-      self.updateTableElement(i)
 
-  def updateTableElement(self, identifier):
-    datasetname = self.datasets[identifier]
-    self.table.setItem(identifier,0,qt.QTableWidgetItem(datasetname))
+  def getDB(self):
+    # lapdMouseDBUtil listing the refreshed catalog of the local cache folder
+    # if there is one, the bundled one otherwise
+    db = lapdMouseDBUtil(self.remoteFolderUrl)
+    cachedCatalogFile = os.path.join(self.localCacheFolder, lapdMouseCatalog.cachedFileName)
+    if os.path.exists(cachedCatalogFile):
+      db.catalogFile = cachedCatalogFile
+    return db
+
+  def refreshCatalog(self):
+    # fetches changes of the archive's catalog in the background; until then,
+    # and when offline, the catalog of the last refresh or the bundled one
+    # is used
+    db = self.getDB()
+    cachedCatalogFile = os.path.join(self.localCacheFolder, lapdMouseCatalog.cachedFileName)
+    result = {}
+    def refresh():
+      result['changedNames'] = db.refreshCatalog(cachedCatalogFile)
+    thread = threading.Thread(target=refresh, daemon=True)
+    thread.start()
+    self.onCatalogRefreshed(thread, result)
+
+  def onCatalogRefreshed(self, thread, result):
+    if thread.is_alive():
+      qt.QTimer.singleShot(500, lambda: self.onCatalogRefreshed(thread, result))
+      return
+    if not result.get('changedNames'):
+      return
+    print('Catalog refreshed, '+str(len(result['changedNames']))+' file(s) added, changed or removed')
+    datasetId = self.getSelectedId()
+    datasetname = self.datasets[datasetId] if datasetId!=-1 else None
+    self.updateDatasets()
+    if datasetname in self.datasets:
+      self.table.selectRow(self.datasets.index(datasetname))
+      self.updateForm()
+
+  def updateTable(self):
+    # only rows whose dataset changed are updated
+    self.datasetModel.setDatasets(self.datasets)
     
   def getSelectedId(self):
     datasetId = -1
-    if len(self.table.selectedRanges()):
-      datasetId = self.table.selectedRanges()[0].bottomRow()
+    selectedRows = self.table.selectionModel().selectedRows()
+    if len(selectedRows):
+      datasetId = selectedRows[0].row()
     return datasetId
   
-  def onDatasetChanged(self):
+  def onDatasetChanged(self, selected=None, deselected=None):
     datasetId = self.getSelectedId()
     if datasetId==-1: # clear data set into
       pass
@@ -348,32 +548,107 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
     url = self.notesUrl+datasetname+'_notes.pdf'
     self.customFormDatasetInfo.text = f'<a href="{url}">{datasetname}_notes.pdf</a>'
     datasetFiles = self.listFilesForDataset(datasetname)    
-    self.customFormFiles.setRowCount(len(datasetFiles))
-    for i in range(len(datasetFiles)):
-      fname = datasetFiles[i]["name"]
-      fsize = datasetFiles[i]["size"]
-      remoteName = os.path.join(datasetname,fname.replace('/',os.sep))
-      localName = os.path.join(self.localCacheFolder,remoteName)
-      downloaded = os.path.exists(localName)
-      self.customFormFiles.setItem(i,0,qt.QTableWidgetItem())
-      self.customFormFiles.item(i,0).setIcon(self.storedIcon if downloaded else self.downloadIcon)
-      self.customFormFiles.item(i,0).setToolTip('downloaded' if downloaded else 'available for download')
-      self.customFormFiles.setItem(i,1,qt.QTableWidgetItem(fname))
-      self.customFormFiles.setItem(i,2,qt.QTableWidgetItem(self.hrSize(fsize)))
+    self.fileModel.setRows([self.getFileRow(datasetname, f) for f in datasetFiles])
+
+  def getFileRow(self, datasetname, f):
+    # row of fileModel for entry f of listFilesForDataset
+    tooltips = {'downloaded':'downloaded', 'require update':'downloaded, newer version available', \
+      'require download':'available for download'}
+    status = self.getFileStatus(datasetname, f)
+    pinned = self.manifest is not None and self.manifest.isPinned(datasetname+'/'+f['name'])
+    return {'name':f['name'], 'size':f['size'], 'sizeText':self.hrSize(f['size']), 'status':status, \
+      'toolTip':tooltips[status]+(', pinned' if pinned else ''), 'filterKey':status+';'+self.getSizeClass(f['size'])}
+
+  def getSizeClass(self, size):
+    for label, upperBound in self.sizeClasses:
+      if upperBound is None or size<upperBound:
+        return label
+
+  def onFileFilterChanged(self):
+    status = self.customFormStatusFilter.itemData(self.customFormStatusFilter.currentIndex)
+    sizeClass = self.customFormSizeFilter.itemData(self.customFormSizeFilter.currentIndex)
+    # filterRole data is '<status>;<size class>', neither contains special characters
+    self.fileFilterModel.setFilterRegularExpression('^'+(status or '.*')+';'+(sizeClass or '.*')+'$')
+
+  def updateFileRows(self, datasetname, names):
+    # updates the rows of the given files if datasetname is shown; the whole
+    # form if files were added or removed
+    datasetId = self.getSelectedId()
+    if datasetId==-1 or self.datasets[datasetId]!=datasetname:
+      return
+    if any(name not in self.fileModel.rowIndex for name in names):
+      self.updateForm()
+      return
+    datasetFiles = {f['name']:f for f in self.listFilesForDataset(datasetname)}
+    if any(name not in datasetFiles for name in names):
+      self.updateForm()
+      return
+    for name in names:
+      self.fileModel.setRow(self.fileModel.rowIndex[name], self.getFileRow(datasetname, datasetFiles[name]))
   
+  def getFileStatus(self, datasetname, f):
+    # f is an entry of listFilesForDataset, see getStatus for return values
+    item = {'remoteName':datasetname+'/'+f['name'], 'isFolder':False, \
+      'localName':os.path.join(self.localCacheFolder,datasetname,f['name'].replace('/',os.sep)), \
+      'size':f['size'], 'modificationTimestamp':f.get('modificationTimestamp',0)}
+    folderEntries = self.getFolderScan(datasetname) if '/' not in f['name'] else None
+    return getStatus(item, self.manifest, folderEntries)
+
+  def getFolderScan(self, datasetname):
+    # directory entries of the dataset's local folder, scanned once and
+    # updated when fileSystemWatcher reports changes, see onDirectoryChanged
+    if datasetname not in self.folderScans:
+      folder = os.path.join(self.localCacheFolder,datasetname)
+      self.folderScans[datasetname] = scanFolder(folder)
+      if os.path.isdir(folder) and folder not in self.fileSystemWatcher.directories():
+        self.fileSystemWatcher.addPath(folder)
+    return self.folderScans[datasetname]
+
+  def invalidateFolderScan(self, datasetname):
+    # for changes made by this window, which are seen before the watcher
+    # reports them
+    self.folderScans.pop(datasetname, None)
+
+  def onDirectoryChanged(self, path):
+    # changes are collected for a moment, downloads change folders often
+    if len(self.changedFolders)==0:
+      qt.QTimer.singleShot(300, self.onFolderChangesSettled)
+    self.changedFolders.add(os.path.normpath(path))
+
+  def onFolderChangesSettled(self):
+    changedFolders, self.changedFolders = self.changedFolders, set()
+    for path in changedFolders:
+      if path==os.path.normpath(self.localCacheFolder):
+        # a dataset folder was created or removed
+        for datasetname in list(self.folderScans.keys()):
+          if (len(self.folderScans[datasetname])==0)==os.path.isdir(os.path.join(path,datasetname)):
+            self.invalidateFolderScan(datasetname)
+            datasetId = self.getSelectedId()
+            if datasetId!=-1 and self.datasets[datasetId]==datasetname:
+              self.updateForm()
+        continue
+      datasetname = os.path.basename(path)
+      if os.path.normpath(os.path.dirname(path))!=os.path.normpath(self.localCacheFolder) or \
+        datasetname not in self.folderScans:
+        continue
+      previousScan = self.folderScans[datasetname]
+      self.invalidateFolderScan(datasetname)
+      currentScan = self.getFolderScan(datasetname)
+      changedNames = [name for name in set(previousScan).union(currentScan) \
+        if previousScan.get(name)!=currentScan.get(name) and not name.startswith('.') and \
+        not name.endswith(partialFileSuffixes)]
+      if len(changedNames):
+        self.updateFileRows(datasetname, changedNames)
+
   def listFilesForDataset(self,datasetname):
-    remoteFolderContent = lapdMouseDBUtil(self.remoteFolderUrl).listDirectory(datasetname, 0)
+    remoteFolderContent = self.getDB().listDirectory(datasetname, 0)
     files = [f for f in remoteFolderContent if not f['isFolder']]
     filenames = [f['name'] for f in files]
-    localDatasetDirectory = os.path.join(self.localCacheFolder,datasetname)
-    if os.path.exists(localDatasetDirectory):
-      localFiles = [f for f in os.listdir(localDatasetDirectory) if \
-        (os.path.isfile(os.path.join(localDatasetDirectory,f)) and \
-        not f.startswith('.'))]
-      for f in localFiles:
-        if not f in filenames:
-          files.append({'name':f, 'size':\
-            os.path.getsize(os.path.join(localDatasetDirectory,f))})
+    localFiles = [(f, size) for f, (size, modificationTime, isFolder) in self.getFolderScan(datasetname).items() \
+      if not isFolder and not f.startswith('.') and not f.endswith(partialFileSuffixes)]
+    for f, size in sorted(localFiles):
+      if not f in filenames:
+        files.append({'name':f, 'size':size})
     return files    
   
   def onDownloadDataset(self):
@@ -382,17 +657,15 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
       return
     datasetname = self.datasets[datasetId]
     selectedFiles = []
-    defaultFiles = ['AutofluorescentSub4.mha','AerosolNormalizedSub4.mha', \
-      'Lobes.nrrd','AirwayOutlets.vtk', 'AirwayWallDeposition.vtk']
-    for df in defaultFiles:
+    for df in self.standardFileSelection:
       for f in self.listFilesForDataset(datasetname):
         if f['name'].find(df)!=-1:
           selectedFiles.append(f['name'])
     self.downloadFiles(datasetname, selectedFiles)
-    self.updateForm()
     
   def getSelectedFiles(self):
-    files = [self.customFormFiles.item(index.row(),1).text() for index in self.customFormFiles.selectionModel().selectedRows()]
+    files = [self.fileModel.rows[self.fileFilterModel.mapToSource(index).row()]['name'] \
+      for index in self.customFormFiles.selectionModel().selectedRows()]
     return files    
     
   def onDownloadSelectedDataset(self):
@@ -402,8 +675,20 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
     datasetname = self.datasets[datasetId]
     files = self.getSelectedFiles()
     self.downloadFiles(datasetname, files)
-    self.updateForm()
     
+  def onUpdateDataset(self):
+    # downloads the newer versions of the files marked 'require update'
+    datasetId = self.getSelectedId()
+    if datasetId==-1:
+      return
+    datasetname = self.datasets[datasetId]
+    files = [f['name'] for f in self.listFilesForDataset(datasetname) \
+      if self.getFileStatus(datasetname, f)=='require update']
+    if len(files)==0:
+      qt.QMessageBox.information(self, 'Update', 'The downloaded files of '+datasetname+' are up to date.')
+      return
+    self.downloadFiles(datasetname, files)
+
   def onDeleteSelectedDataset(self):
     datasetId = self.getSelectedId()
     if datasetId==-1:
@@ -411,81 +696,242 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
     datasetname = self.datasets[datasetId]
     files = self.getSelectedFiles()
     self.deleteFiles(datasetname, files)
-    self.updateForm()
+    self.updateFileRows(datasetname, files)
     
-  def downloadFiles(self, datasetname, files, askForConfirmation=True):
-    if askForConfirmation:
-      filestats = self.listFilesForDataset(datasetname)
-      filesToDownload = [f for f in filestats if f['name'] in files and \
-        not os.path.exists(os.path.join(self.localCacheFolder,datasetname,f['name']))]
-      if len(filesToDownload)==0:
-        return True
-      filesToDownload.sort(key=lambda f: f['size'])
-      files = [f['name'] for f in filesToDownload]
+  def onPinSelectedFiles(self):
+    datasetId = self.getSelectedId()
+    if datasetId==-1 or self.manifest is None:
+      return
+    datasetname = self.datasets[datasetId]
+    files = self.getSelectedFiles()
+    pinned = not all(self.manifest.isPinned(datasetname+'/'+f) for f in files)
+    for f in files:
+      self.manifest.setPinned(datasetname+'/'+f, pinned)
+    self.updateFileRows(datasetname, files)
+
+  def getCatalog(self):
+    return lapdMouseCatalog.get(self.getDB().catalogFile)
+
+  def searchFiles(self, text):
+    # catalog entries of the files in all datasets whose name matches text,
+    # a glob pattern or, without wildcards, a part of the name
+    text = text.strip()
+    catalog = self.getCatalog()
+    if not text or catalog is None:
+      return []
+    pattern = text if any(c in text for c in '*?[') else '*'+text+'*'
+    return [e for e in catalog.query(pattern=pattern) if e['name'].count('/')==1]
+
+  def onSearchChanged(self):
+    matches = self.searchFiles(self.customFormSearchText.text)
+    self.customFormSearchDownloadButton.enabled = len(matches)>0
+    if self.customFormSearchText.text.strip()=='':
+      self.customFormSearchResult.text = ''
+      return
+    numberOfDatasets = len(set(e['name'].split('/')[0] for e in matches))
+    self.customFormSearchResult.text = ' %d file(s) in %d dataset(s), %s ' % (len(matches), \
+      numberOfDatasets, self.hrSize(sum(e['size'] for e in matches)))
+
+  def onDownloadSearchResults(self):
+    # queues the matching files of all datasets after a single confirmation
+    filesByDataset = {}
+    numberOfFiles, numberOfBytes = 0, 0
+    for e in self.searchFiles(self.customFormSearchText.text):
+      datasetname, name = e['name'].split('/')
+      filesByDataset.setdefault(datasetname, []).append(name)
+      if self.getFileStatus(datasetname, dict(e, name=name))=='require download' or \
+        not os.path.exists(os.path.join(self.localCacheFolder,datasetname,name)):
+        numberOfFiles += 1
+        numberOfBytes += e['size']
+    if numberOfFiles==0:
+      qt.QMessageBox.information(self, 'Download', 'All matching files are downloaded already.')
+      return
+    s = 'Downloading '+str(numberOfFiles)+' file(s) of '+str(len(filesByDataset))+' dataset(s) with '+\
+      self.hrSize(numberOfBytes)+'. This could take some time. Do you want to continue?'
+    if qt.QMessageBox.question(self, 'Download?', s, qt.QMessageBox.Yes, qt.QMessageBox.No)!=qt.QMessageBox.Yes:
+      return
+    for datasetname in sorted(filesByDataset.keys()):
+      self.downloadFiles(datasetname, filesByDataset[datasetname], askForConfirmation=False)
+
+  def getDownloadPriority(self, name):
+    if any(name.find(df)!=-1 for df in self.standardFileSelection):
+      return self.standardPriority
+    if name.find('RawCryomicrotomeData')!=-1 or name.endswith('.tar'):
+      return self.bulkPriority
+    return self.defaultPriority
+
+  def setDownloadSchedule(self, bandwidthLimit, bulkDownloadHours):
+    # bandwidthLimit in bytes per second (0 for no limit), bulkDownloadHours
+    # is (startHour, endHour) during which raw data downloads may start
+    self.bandwidthLimit = bandwidthLimit
+    self.bulkDownloadHours = bulkDownloadHours
+    if self.downloadQueue:
+      self.downloadQueue.bandwidth.setRate(bandwidthLimit)
+      self.downloadQueue.setAllowedHours(self.bulkPriority, bulkDownloadHours)
+
+  def setSharedCacheFolder(self, folder):
+    self.sharedCacheFolder = folder
+    if self.downloadQueue:
+      self.downloadQueue.db.sharedCache = lapdMouseSharedCache(folder) if folder else None
+
+  def setCacheSizeLimit(self, cacheSizeLimit):
+    self.cacheSizeLimit = cacheSizeLimit
+    self.enforceCacheSizeLimit()
+
+  def setCompressVolumes(self, compressVolumes):
+    # compresses stored .mha volumes in the background, they are loaded and
+    # reported as downloaded as before, see lapdMouseCacheCompressor
+    self.compressVolumes = compressVolumes
+    if self.compressor:
+      self.compressor.stop()
+      self.compressor = None
+    if compressVolumes and self.manifest:
+      self.compressor = lapdMouseCacheCompressor(self.manifest)
+      self.compressor.addAll()
+
+  def getCacheUsage(self):
+    return cacheUsage(self.manifest) if self.manifest else 0
+
+  def getLoadedFiles(self):
+    # remote names of the files in the local cache folder that are loaded in
+    # the scene: files of storage nodes and files loaded by loadFiles
+    loadedFiles = set(self.loadedFiles)
+    prefix = os.path.normpath(self.localCacheFolder)+os.sep
+    for node in slicer.util.getNodesByClass('vtkMRMLStorageNode'):
+      fileName = os.path.normpath(node.GetFileName() or '')
+      if fileName.startswith(prefix):
+        loadedFiles.add(fileName[len(prefix):].replace(os.sep,'/'))
+    return loadedFiles
+
+  def enforceCacheSizeLimit(self):
+    # removes least recently loaded files until the local cache folder fits
+    # in cacheSizeLimit; files loaded in the scene and pinned files are kept
+    removed = []
+    if self.cacheSizeLimit and self.manifest:
+      removed = evictFiles(self.manifest, self.cacheSizeLimit, self.getLoadedFiles())
+    for name in removed:
+      print('removed '+name+' to keep the storage folder within its size limit')
+      self.invalidateFolderScan(name.split('/')[0])
+    if removed and self.getSelectedId()!=-1:
+      self.updateForm()
+    if self.cacheUsageCallback:
+      self.cacheUsageCallback()
+    return removed
+
+  def onSceneClosed(self, caller, event):
+    self.loadedFiles = set()
+
+  def getDownloadQueue(self):
+    if self.downloadQueue is None:
+      self.downloadQueue = lapdMouseDownloadEngine(self.remoteFolderUrl, self.numberOfDownloadWorkers, self.manifest)
+      self.setSharedCacheFolder(self.sharedCacheFolder)
+      self.downloadQueue.bandwidth.setRate(self.bandwidthLimit)
+      self.downloadQueue.setAllowedHours(self.bulkPriority, self.bulkDownloadHours)
+      self.downloadQueue.start()
+      self.downloadQueueWidget = lapdMouseDownloadQueueWidget(self.downloadQueue)
+      self.downloadQueueWidget.jobFinishedCallback = self.onDownloadFinished
+    return self.downloadQueue
+
+  def showDownloadQueue(self):
+    self.getDownloadQueue()
+    self.downloadQueueWidget.show()
+    self.downloadQueueWidget.raise_()
+
+  def onDownloadFinished(self, job):
+    if self.compressor and job['status']=='done':
+      self.compressor.addFile(job['remoteName'])
+    datasetname, name = job['remoteName'].split('/', 1)
+    self.invalidateFolderScan(datasetname)
+    self.updateFileRows(datasetname, [name])
+    if self.cacheUsageCallback:
+      self.cacheUsageCallback()
+
+  def downloadFiles(self, datasetname, files, askForConfirmation=True, onFinished=None):
+    # queues the files in the background download queue and returns right
+    # away; onFinished() is called on the main thread once all of them are
+    # done. Returns False if the user declined the download.
+    filestats = self.listFilesForDataset(datasetname)
+    filesToDownload = [f for f in filestats if f['name'] in files and \
+      (self.getFileStatus(datasetname, f) in ['require download', 'require update'] or \
+      not os.path.exists(os.path.join(self.localCacheFolder,datasetname,f['name'])))]
+    queue = self.getDownloadQueue()
+    jobs = []
+    for f in list(filesToDownload):
+      job = queue.findJob(os.path.normpath(os.path.join(self.localCacheFolder,datasetname,f['name'])))
+      if job is not None: # already queued
+        if job['status']=='paused':
+          queue.resumeJob(job)
+        jobs.append(job)
+        filesToDownload.remove(f)
+    if len(filesToDownload)>0 and askForConfirmation:
       s = 'Downloading '+str(len(filesToDownload))+' file(s) with '+\
         self.hrSize(sum(f['size'] for f in filesToDownload))+'.'+\
         ' This could take some time. Do you want to continue?'
       confirmDownload = qt.QMessageBox.question(self,'Download?', s, qt.QMessageBox.Yes, qt.QMessageBox.No)
       if confirmDownload!=qt.QMessageBox.Yes:
         return False
-      
-    errMsg = []
-    pd = qt.QProgressDialog('Downloading file(s)...', 'Cancel', 0, len(files)+2, slicer.util.mainWindow())
-    pd.setModal(True)
-    pd.setMinimumDuration(0)
-    pd.show()
-    slicer.app.processEvents()
-    for f in files:
-      if pd.wasCanceled:
-        break
-      pd.setLabelText('Downloading: ' + f)
-      pd.setValue(files.index(f)+1)
-      slicer.app.processEvents() 
-      remoteName = datasetname + '/' + f
+
+    for f in filesToDownload:
+      remoteName = datasetname + '/' + f['name']
       localName = os.path.normpath(os.path.join(self.localCacheFolder,remoteName))
-      if not os.path.exists(localName):
-        print('Downloading '+remoteName)
-        t0 = time.time()
-        lapdMouseDBUtil(self.remoteFolderUrl).downloadFile(remoteName, localName)
-        t1 = time.time()
-        downloadSucceeded = os.path.exists(localName)
-        print( ( '[DONE]' if downloadSucceeded else '[ERROR]')+' time: '+time.strftime("%M:%S", time.gmtime(t1-t0))+'\n')
-        if not downloadSucceeded:
-          errMsg.append(f)
-          if os.path.exists(localName):
-            os.remove(localName)
+      jobs.append(queue.addJob(remoteName, localName, f['size'], f.get('modificationTimestamp'), \
+        self.getDownloadPriority(f['name'])))
+    if len(filesToDownload)>0:
+      print('Downloading '+str(len(filesToDownload))+' file(s) in the background')
+      self.showDownloadQueue()
+    self.downloadQueueWidget.addBatch(jobs, lambda: self.onBatchFinished(jobs, onFinished))
+    return True
 
-    pd.setValue(len(files)+2)
+  def onBatchFinished(self, jobs, onFinished=None):
+    for job in jobs:
+      print(job['remoteName']+' ['+job['status']+']')
+    errMsg = [os.path.basename(j['localName'])+(' (checksum mismatch)' if j['status']=='corrupt' else '') \
+      for j in jobs if j['status'] in ['failed','corrupt']]
     if len(errMsg) > 0:
       qt.QMessageBox.information(self, 'Error!',
                                  'Error(s) downloading files:\n\n' + '\n'.join(errMsg) +
                                  '\n\nSee Python console for errors.\n')
       slicer.util.setPythonConsoleVisible(visible = True)
-    return True
-    
+    if onFinished:
+      onFinished()
+    self.enforceCacheSizeLimit() # after loading, loaded files are kept
+
   def deleteFiles(self, datasetname, files):
     for f in files:
       remoteName = os.path.join(datasetname,f.replace('/',os.sep))
       localName = os.path.join(self.localCacheFolder,remoteName)
+      job = self.downloadQueue.findJob(os.path.normpath(localName)) if self.downloadQueue else None
+      if job is not None:
+        self.downloadQueue.cancelJob(job)
       if os.path.exists(localName):
         print("deleting file "+localName)
         os.remove(localName)
-      
+      if localName.endswith('.tar') and os.path.isdir(unpackedFolderName(localName)):
+        print("deleting folder "+unpackedFolderName(localName))
+        shutil.rmtree(unpackedFolderName(localName))
+      if self.manifest:
+        self.manifest.remove(datasetname+'/'+f)
+      for partName in [localName+suffix for suffix in partialFileSuffixes]:
+        if os.path.isdir(partName):
+          shutil.rmtree(partName)
+        elif os.path.exists(partName):
+          os.remove(partName)
+    self.invalidateFolderScan(datasetname)
+    if self.cacheUsageCallback:
+      self.cacheUsageCallback()
+
   def onLoadDataset(self):
     datasetId = self.getSelectedId()
     if datasetId==-1:
       return
     datasetname = self.datasets[datasetId]
     selectedFiles = []
-    defaultFiles = ['AutofluorescentSub4.mha','AerosolNormalizedSub4.mha', \
-      'Lobes.nrrd','AirwayOutlets.vtk', 'AirwayWallDeposition.vtk']
-    for df in defaultFiles:
+    for df in self.standardFileSelection:
       for f in self.listFilesForDataset(datasetname):
         if f['name'].find(df)!=-1:
           selectedFiles.append(f['name'])
-    if self.downloadFiles(datasetname, selectedFiles):
-      self.updateForm()
-      self.loadFiles(datasetname, selectedFiles)
+    self.downloadFiles(datasetname, selectedFiles, \
+      onFinished=lambda: self.loadFiles(datasetname, selectedFiles))
   
   def onLoadSelectedDataset(self):
     datasetId = self.getSelectedId()
@@ -493,9 +939,8 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
       return
     datasetname = self.datasets[datasetId]
     files = self.getSelectedFiles()
-    if self.downloadFiles(datasetname, files):
-      self.updateForm()
-      self.loadFiles(datasetname, files)
+    self.downloadFiles(datasetname, files, \
+      onFinished=lambda: self.loadFiles(datasetname, files))
   
   def loadFiles(self, datasetname, files):
     pd = qt.QProgressDialog('Loading file(s) in Slicer...', 'Cancel', 0, len(files)+2, slicer.util.mainWindow())
@@ -515,7 +960,12 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
         continue
       try:
         print('loading '+localName)
-        self.loadFile(localName)
+        node = self.loadFile(localName)
+        self.loadedFiles.add(datasetname+'/'+f)
+        if self.manifest:
+          self.manifest.setLastLoaded(datasetname+'/'+f)
+        if node and self.progressiveLoading is not None:
+          self.upgradeVolume(datasetname, f, node)
       except:
         print('error loading file: ')
         print(sys.exc_info()[0])
@@ -523,10 +973,9 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
     pd.hide()
   
   def loadFile(self, filename):
-    lapdMouseDBBrowser.loadColorTables()
     name, extension = os.path.splitext(filename)
     if extension=='.mha':
-      self.loadVolume(filename)
+      return self.loadVolume(filename)
     elif extension=='.nrrd':
       self.loadLabelmap(filename)
     elif extension=='.vtk':
@@ -567,6 +1016,48 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
         nd.SetAndObserveColorNodeID(colorLUT.GetID())
       nd.SetAutoWindowLevel(False)
       nd.SetWindowLevel(3000,1500)
+    return node
+
+  def upgradeVolume(self, datasetname, f, node):
+    # progressive loading: fetches the next finer resolution of volume f in
+    # the background and swaps it into node when it is there
+    finerFile = finerResolutionFileName(f, self.progressiveLoading)
+    if finerFile is None or finerFile not in [d['name'] for d in self.listFilesForDataset(datasetname)]:
+      return
+    self.downloadFiles(datasetname, [finerFile], askForConfirmation=False, \
+      onFinished=lambda: self.onFinerResolutionDownloaded(datasetname, finerFile, node))
+
+  def onFinerResolutionDownloaded(self, datasetname, f, node):
+    localName = os.path.join(self.localCacheFolder,datasetname,f.replace('/',os.sep))
+    if not os.path.exists(localName) or not slicer.mrmlScene.IsNodePresent(node):
+      return # download failed or volume closed in the meantime
+    try:
+      print('upgrading '+node.GetName()+' to '+localName)
+      self.replaceVolumeData(node, localName)
+    except:
+      print('error loading file: ')
+      print(sys.exc_info()[0])
+      return
+    self.upgradeVolume(datasetname, f, node)
+
+  def replaceVolumeData(self, node, filename):
+    # puts image data and geometry of filename into node; its display node,
+    # and with it window/level and color table, stays as it is
+    newNode = slicer.util.loadVolume(filename, {'show':False})
+    try:
+      ijkToRAS = vtk.vtkMatrix4x4()
+      newNode.GetIJKToRASMatrix(ijkToRAS)
+      node.SetIJKToRASMatrix(ijkToRAS)
+      node.SetAndObserveImageData(newNode.GetImageData())
+      node.SetName(os.path.splitext(os.path.basename(filename))[0])
+      if node.GetStorageNode():
+        node.GetStorageNode().SetFileName(filename)
+    finally:
+      helperNodes = [newNode.GetNthDisplayNode(i) for i in range(newNode.GetNumberOfDisplayNodes())]
+      helperNodes += [newNode.GetStorageNode(), newNode]
+      for helperNode in helperNodes:
+        if helperNode:
+          slicer.mrmlScene.RemoveNode(helperNode)
 
 
  # .nrrd 
@@ -581,9 +1072,9 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
     
     colorLUT = None
     if (str(os.path.basename(filename)).find('Lobes.nrrd')!=-1):
-      colorLUT = slicer.util.getFirstNodeByClassByName('vtkMRMLColorTableNode','lapdMouseLobes')
+      colorLUT = lapdMouseDBBrowser.getColorTable('lapdMouseLobes')
     else:
-      colorLUT = slicer.util.getFirstNodeByClassByName('vtkMRMLColorTableNode','lapdMouseSegments')
+      colorLUT = lapdMouseDBBrowser.getColorTable('lapdMouseSegments')
     if colorLUT:
       nd=node.GetDisplayNode()
       nd.SetAndObserveColorNodeID(colorLUT.GetID())
@@ -634,13 +1125,13 @@ class lapdMouseBrowserWindow(qt.QMainWindow):
       nd.SetScalarRange(0,1)
     
     if (str(os.path.basename(filename)).find('AirwaySegments')!=-1):
-      colorLUT = slicer.util.getFirstNodeByClassByName('vtkMRMLColorTableNode','lapdMouseSegments')
+      colorLUT = lapdMouseDBBrowser.getColorTable('lapdMouseSegments')
       if colorLUT:
         nd.SetAndObserveColorNodeID(colorLUT.GetID())
       nd.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseColorNodeScalarRange)
     
     if (str(os.path.basename(filename)).find('AirwayOutlets')!=-1):
-      colorLUT = slicer.util.getFirstNodeByClassByName('vtkMRMLColorTableNode','lapdMouseOutlets')
+      colorLUT = lapdMouseDBBrowser.getColorTable('lapdMouseOutlets')
       if colorLUT:
         nd.SetAndObserveColorNodeID(colorLUT.GetID())
       nd.SetScalarRangeFlag(slicer.vtkMRMLDisplayNode.UseColorNodeScalarRange)
@@ -743,7 +1234,6 @@ class lapdMouseDBBrowser(ScriptedLoadableModule):
     self.parent.acknowledgementText = """
     This work was supported in part by NIH project R01ES023863.
 """ # replace with organization, grant and thanks.
-    lapdMouseDBBrowser.loadColorTables()
     
   @staticmethod
   def loadColorTables():
@@ -751,10 +1241,20 @@ class lapdMouseDBBrowser(ScriptedLoadableModule):
     lapdMouseDBBrowser.setupSegmentsColorTable()
     lapdMouseDBBrowser.setupOutletsColorTable()
     
+  @staticmethod
+  def getColorTable(name):
+    # color table node 'lapdMouseLobes', 'lapdMouseSegments' or
+    # 'lapdMouseOutlets', added to the scene when it is first used
+    setup = {'lapdMouseLobes': lapdMouseDBBrowser.setupLobesColorTable, \
+      'lapdMouseSegments': lapdMouseDBBrowser.setupSegmentsColorTable, \
+      'lapdMouseOutlets': lapdMouseDBBrowser.setupOutletsColorTable}[name]
+    return setup()
+    
   @staticmethod
   def setupLobesColorTable():
-    if len(slicer.util.getNodes('lapdMouseLobes'))>0:
-      return
+    existing = slicer.mrmlScene.GetFirstNodeByName('lapdMouseLobes')
+    if existing:
+      return existing
     colors = slicer.vtkMRMLColorTableNode()
     colors.SetTypeToUser()
     colors.SetAttribute("Category", "lapdMouse")
@@ -769,48 +1269,54 @@ class lapdMouseDBBrowser(ScriptedLoadableModule):
     colors.SetColor(3,'right middle lobe',0,0,1,1)
     colors.SetColor(4,'right caudal lobe',1,1,0,1)
     colors.SetColor(5,'right accessory lobe',0,1,1,1)
-    slicer.mrmlScene.AddNode(colors)
+    return slicer.mrmlScene.AddNode(colors)
 
     
   @staticmethod
-  def setupSegmentsColorTable():
-    if len(slicer.util.getNodes('lapdMouseSegments'))>0:
-      return
-    numSegments = 5000
+  def randomColors(numberOfColors, seed=3):
+    # RGBA table (numberOfColors x 4, unsigned char) of the random colors of
+    # the segments and outlets color tables, identical to setting color i to
+    # (random.uniform(0.0,1.0), random.uniform(0.0,1.0),
+    # random.uniform(0.0,1.0), 1) for i>=1 after random.seed(seed) with
+    # vtkLookupTable.SetTableValue; row 0 is opaque white.
+    # seed 3: nothing too dark and first few generations reasonably well contrasted
+    import random, numpy
+    version, internalState, gauss = random.Random(seed).getstate()
+    generator = numpy.random.RandomState()
+    generator.set_state(('MT19937', numpy.array(internalState[:-1], dtype=numpy.uint32), internalState[-1]))
+    rgba = numpy.ones((numberOfColors, 4))
+    rgba[1:,:3] = generator.random_sample((numberOfColors-1, 3)) # same draws as random.random()
+    return (rgba*255.0+0.5).astype(numpy.uint8)
+
+  @staticmethod
+  def setupRandomColorTable(name, firstColorName, firstColor, numberOfColors=5000):
+    existing = slicer.mrmlScene.GetFirstNodeByName(name)
+    if existing:
+      return existing
+    import vtk.util.numpy_support
     colors = slicer.vtkMRMLColorTableNode()
     colors.SetTypeToUser()
     colors.SetAttribute("Category", "lapdMouse")
-    colors.SetName('lapdMouseSegments')
+    colors.SetName(name)
     colors.SetHideFromEditors(True)
-    colors.SetNumberOfColors(numSegments)
+    colors.SetNumberOfColors(numberOfColors)
     colors.NamesInitialisedOn()
-    colors.GetLookupTable().SetRange(0,numSegments)
-    colors.SetColor(0,'background',0,0,0,0)
-    import random
-    random.seed(3) # seed 3: nothing too dark and first few generations reasonably well contrasted
-    for i in range (1,numSegments):
-      colors.SetColor(i, str(i),random.uniform(0.0,1.0),random.uniform(0.0,1.0),random.uniform(0.0,1.0),1)
-    slicer.mrmlScene.AddNode(colors)
+    lookupTable = colors.GetLookupTable()
+    lookupTable.SetRange(0,numberOfColors)
+    lookupTable.SetTable(vtk.util.numpy_support.numpy_to_vtk(lapdMouseDBBrowser.randomColors(numberOfColors), \
+      deep=True, array_type=vtk.VTK_UNSIGNED_CHAR))
+    for i in range(1,numberOfColors):
+      colors.SetColorName(i, str(i))
+    colors.SetColor(0,firstColorName,*firstColor)
+    return slicer.mrmlScene.AddNode(colors)
+
+  @staticmethod
+  def setupSegmentsColorTable():
+    return lapdMouseDBBrowser.setupRandomColorTable('lapdMouseSegments', 'background', (0,0,0,0))
   
   @staticmethod
   def setupOutletsColorTable():
-    if len(slicer.util.getNodes('lapdMouseOutlets'))>0:
-      return
-    numSegments = 5000
-    colors = slicer.vtkMRMLColorTableNode()
-    colors.SetTypeToUser()
-    colors.SetAttribute("Category", "lapdMouse")
-    colors.SetName('lapdMouseOutlets')
-    colors.SetHideFromEditors(True)
-    colors.SetNumberOfColors(numSegments)
-    colors.NamesInitialisedOn()
-    colors.GetLookupTable().SetRange(0,numSegments)
-    colors.SetColor(0,'wall',1,0.67,0,1)
-    import random
-    random.seed(3) # seed 3: nothing too dark and first few generations reasonably well contrasted
-    for i in range (1,numSegments):
-      colors.SetColor(i, str(i),random.uniform(0.0,1.0),random.uniform(0.0,1.0),random.uniform(0.0,1.0),1)
-    slicer.mrmlScene.AddNode(colors)
+    return lapdMouseDBBrowser.setupRandomColorTable('lapdMouseOutlets', 'wall', (1,0.67,0,1))
 
 #
 # lapdMouseDBBrowserWidget
@@ -822,6 +1328,7 @@ class lapdMouseDBBrowserWidget(ScriptedLoadableModuleWidget):
   """
 
   def setup(self):
+    startupTimes.append(('module setup', None, time.perf_counter()))
     ScriptedLoadableModuleWidget.setup(self)
     
     settings = qt.QSettings()
@@ -830,10 +1337,9 @@ class lapdMouseDBBrowserWidget(ScriptedLoadableModuleWidget):
       settings.sync()
     databaseDirectory = settings.value("lapdMouseDBBrowserLocalCacheFolder")
     
-    self.browserWindow = lapdMouseBrowserWindow()
-    self.browserWindow.localCacheFolder = databaseDirectory
-    self.browserWindow.load()
-    self.browserWindow.show()
+    # built, and the catalog and storage folder read, on first "Show
+    # browser", see getBrowserWindow
+    self.browserWindow = None
     self.logic = lapdMouseDBBrowserLogic()
 
     # Instantiate and connect widgets ...
@@ -851,7 +1357,7 @@ class lapdMouseDBBrowserWidget(ScriptedLoadableModuleWidget):
     # extract/merge
     self.openBrowserWindowButton = qt.QPushButton("Show browser")
     self.openBrowserWindowButton.toolTip = "Open lapdMouse database browser window."
-    self.openBrowserWindowButton.connect('clicked()', self.browserWindow.show)
+    self.openBrowserWindowButton.connect('clicked()', self.onShowBrowser)
     parametersFormLayout.addRow("Window:",self.openBrowserWindowButton)
     
     settingsCollapsibleButton = ctk.ctkCollapsibleButton()
@@ -860,7 +1366,7 @@ class lapdMouseDBBrowserWidget(ScriptedLoadableModuleWidget):
     settingsGridLayout = qt.QGridLayout(settingsCollapsibleButton)
     settingsCollapsibleButton.collapsed = False
     
-    self.storagePath = self.browserWindow.localCacheFolder
+    self.storagePath = databaseDirectory
     storagePathLabel = qt.QLabel("Storage Folder: ")
     self.storagePathButton = ctk.ctkDirectoryButton()
     self.storagePathButton.directory = self.storagePath
@@ -869,13 +1375,181 @@ class lapdMouseDBBrowserWidget(ScriptedLoadableModuleWidget):
       
     self.storagePathButton.connect('directoryChanged(const QString &)',self.onStorageChanged)
 
+    bandwidthLimitLabel = qt.QLabel("Bandwidth limit: ")
+    self.bandwidthLimitSpinBox = qt.QDoubleSpinBox()
+    self.bandwidthLimitSpinBox.setRange(0, 10000)
+    self.bandwidthLimitSpinBox.setDecimals(1)
+    self.bandwidthLimitSpinBox.suffix = " MB/s"
+    self.bandwidthLimitSpinBox.specialValueText = "unlimited"
+    self.bandwidthLimitSpinBox.toolTip = "Maximum total download rate, shared by all downloads."
+    self.bandwidthLimitSpinBox.value = float(settings.value("lapdMouseDBBrowserBandwidthLimit", 0))
+    settingsGridLayout.addWidget(bandwidthLimitLabel,1,0,1,1)
+    settingsGridLayout.addWidget(self.bandwidthLimitSpinBox,1,1,1,4)
+
+    bulkDownloadHours = settings.value("lapdMouseDBBrowserBulkDownloadHours", "")
+    bulkDownloadLabel = qt.QLabel("Raw data downloads: ")
+    self.bulkDownloadCheckBox = qt.QCheckBox("only between")
+    self.bulkDownloadCheckBox.toolTip = "Start downloads of raw cryomicrotome data only during these hours, e.g. overnight."
+    self.bulkDownloadCheckBox.checked = bulkDownloadHours!=""
+    startHour, endHour = [int(h) for h in bulkDownloadHours.split('-')] if bulkDownloadHours else [22, 6]
+    self.bulkDownloadStartSpinBox = qt.QSpinBox()
+    self.bulkDownloadEndSpinBox = qt.QSpinBox()
+    for spinBox, hour in [(self.bulkDownloadStartSpinBox, startHour), (self.bulkDownloadEndSpinBox, endHour)]:
+      spinBox.setRange(0, 23)
+      spinBox.suffix = ":00"
+      spinBox.value = hour
+    settingsGridLayout.addWidget(bulkDownloadLabel,2,0,1,1)
+    settingsGridLayout.addWidget(self.bulkDownloadCheckBox,2,1,1,1)
+    settingsGridLayout.addWidget(self.bulkDownloadStartSpinBox,2,2,1,1)
+    settingsGridLayout.addWidget(qt.QLabel("and"),2,3,1,1)
+    settingsGridLayout.addWidget(self.bulkDownloadEndSpinBox,2,4,1,1)
+
+    self.bandwidthLimitSpinBox.connect('valueChanged(double)', self.onDownloadScheduleChanged)
+    self.bulkDownloadCheckBox.connect('toggled(bool)', self.onDownloadScheduleChanged)
+    self.bulkDownloadStartSpinBox.connect('valueChanged(int)', self.onDownloadScheduleChanged)
+    self.bulkDownloadEndSpinBox.connect('valueChanged(int)', self.onDownloadScheduleChanged)
+    self.onDownloadScheduleChanged()
+
+    progressiveLoadingLabel = qt.QLabel("Progressive loading: ")
+    self.progressiveLoadingComboBox = qt.QComboBox()
+    self.progressiveLoadingComboBox.addItem("off", "off")
+    self.progressiveLoadingComboBox.addItem("upgrade volumes to Sub2", "Sub2")
+    self.progressiveLoadingComboBox.addItem("upgrade volumes to full resolution", "full")
+    self.progressiveLoadingComboBox.toolTip = "Show loaded Sub4 volumes right away and replace them with finer resolutions downloaded in the background."
+    self.progressiveLoadingComboBox.currentIndex = max(0, \
+      self.progressiveLoadingComboBox.findData(settings.value("lapdMouseDBBrowserProgressiveLoading", "off")))
+    settingsGridLayout.addWidget(progressiveLoadingLabel,3,0,1,1)
+    settingsGridLayout.addWidget(self.progressiveLoadingComboBox,3,1,1,4)
+    self.progressiveLoadingComboBox.connect('currentIndexChanged(int)', self.onProgressiveLoadingChanged)
+    self.onProgressiveLoadingChanged()
+
+    sharedCacheFolder = settings.value("lapdMouseDBBrowserSharedCacheFolder", "")
+    self.sharedCacheCheckBox = qt.QCheckBox("Shared cache: ")
+    self.sharedCacheCheckBox.toolTip = "Folder shared with other users (e.g. on a network drive) that holds every downloaded file once. Files in the storage folder link to it."
+    self.sharedCacheCheckBox.checked = sharedCacheFolder!=""
+    self.sharedCacheButton = ctk.ctkDirectoryButton()
+    self.sharedCacheButton.directory = sharedCacheFolder or os.path.dirname(self.storagePath)
+    settingsGridLayout.addWidget(self.sharedCacheCheckBox,4,0,1,1)
+    settingsGridLayout.addWidget(self.sharedCacheButton,4,1,1,4)
+    self.sharedCacheCheckBox.connect('toggled(bool)', self.onSharedCacheChanged)
+    self.sharedCacheButton.connect('directoryChanged(const QString &)', self.onSharedCacheChanged)
+    self.onSharedCacheChanged()
+
+    cacheSizeLimitLabel = qt.QLabel("Storage size limit: ")
+    self.cacheSizeLimitSpinBox = qt.QDoubleSpinBox()
+    self.cacheSizeLimitSpinBox.setRange(0, 100000)
+    self.cacheSizeLimitSpinBox.setDecimals(1)
+    self.cacheSizeLimitSpinBox.suffix = " GB"
+    self.cacheSizeLimitSpinBox.specialValueText = "unlimited"
+    self.cacheSizeLimitSpinBox.toolTip = "Least recently loaded files are removed from the storage folder to stay within this size. Files loaded in the scene and pinned files are kept."
+    self.cacheSizeLimitSpinBox.value = float(settings.value("lapdMouseDBBrowserCacheSizeLimit", 0))
+    self.cacheUsageLabel = qt.QLabel()
+    settingsGridLayout.addWidget(cacheSizeLimitLabel,5,0,1,1)
+    settingsGridLayout.addWidget(self.cacheSizeLimitSpinBox,5,1,1,2)
+    settingsGridLayout.addWidget(self.cacheUsageLabel,5,3,1,2)
+    self.cacheSizeLimitSpinBox.connect('valueChanged(double)', self.onCacheSizeLimitChanged)
+    self.onCacheSizeLimitChanged()
+
+    self.compressVolumesCheckBox = qt.QCheckBox("Compress stored volumes")
+    self.compressVolumesCheckBox.toolTip = "Compress downloaded .mha volumes in the background to save disk space. They load as before but take a moment longer to read."
+    self.compressVolumesCheckBox.checked = settings.value("lapdMouseDBBrowserCompressVolumes", "false")=="true"
+    settingsGridLayout.addWidget(self.compressVolumesCheckBox,6,1,1,4)
+    self.compressVolumesCheckBox.connect('toggled(bool)', self.onCompressVolumesChanged)
+    self.onCompressVolumesChanged()
+
     self.layout.addStretch(1)
+    startupTimes.append(('module setup', 'settings panel', time.perf_counter()))
+    reportStartupTimes(['module import', 'module setup'])
+
+  def getBrowserWindow(self):
+    if self.browserWindow is None:
+      startupTimes.append(('first show', None, time.perf_counter()))
+      self.browserWindow = lapdMouseBrowserWindow()
+      self.browserWindow.localCacheFolder = self.storagePath
+      self.browserWindow.cacheUsageCallback = self.updateCacheUsage
+      startupTimes.append(('first show', 'browser window', time.perf_counter()))
+      self.browserWindow.load()
+      startupTimes.append(('first show', 'catalog and storage folder', time.perf_counter()))
+      self.onDownloadScheduleChanged()
+      self.onProgressiveLoadingChanged()
+      self.onSharedCacheChanged()
+      self.onCacheSizeLimitChanged()
+      self.onCompressVolumesChanged()
+      startupTimes.append(('first show', 'settings', time.perf_counter()))
+      reportStartupTimes(['first show'])
+    return self.browserWindow
+
+  def onShowBrowser(self):
+    self.getBrowserWindow().show()
+
+  def onDownloadScheduleChanged(self):
+    bandwidthLimit = self.bandwidthLimitSpinBox.value
+    bulkDownloadHours = None
+    if self.bulkDownloadCheckBox.checked:
+      bulkDownloadHours = (self.bulkDownloadStartSpinBox.value, self.bulkDownloadEndSpinBox.value)
+    if self.browserWindow:
+      self.browserWindow.setDownloadSchedule(int(bandwidthLimit*1024*1024), bulkDownloadHours)
+    settings = qt.QSettings()
+    settings.setValue("lapdMouseDBBrowserBandwidthLimit", bandwidthLimit)
+    settings.setValue("lapdMouseDBBrowserBulkDownloadHours", \
+      '%d-%d' % bulkDownloadHours if bulkDownloadHours else "")
+    settings.sync()
   
+  def onProgressiveLoadingChanged(self):
+    progressiveLoading = self.progressiveLoadingComboBox.itemData(self.progressiveLoadingComboBox.currentIndex)
+    if self.browserWindow:
+      self.browserWindow.progressiveLoading = {'off':None, 'Sub2':'Sub2', 'full':''}[progressiveLoading]
+    settings = qt.QSettings()
+    settings.setValue("lapdMouseDBBrowserProgressiveLoading", progressiveLoading)
+    settings.sync()
+
+  def onSharedCacheChanged(self):
+    sharedCacheFolder = self.sharedCacheButton.directory if self.sharedCacheCheckBox.checked else ""
+    self.sharedCacheButton.enabled = self.sharedCacheCheckBox.checked
+    if self.browserWindow:
+      self.browserWindow.setSharedCacheFolder(sharedCacheFolder or None)
+    settings = qt.QSettings()
+    settings.setValue("lapdMouseDBBrowserSharedCacheFolder", sharedCacheFolder)
+    settings.sync()
+
+  def onCacheSizeLimitChanged(self):
+    cacheSizeLimit = self.cacheSizeLimitSpinBox.value
+    if self.browserWindow:
+      self.browserWindow.setCacheSizeLimit(int(cacheSizeLimit*1024*1024*1024))
+    self.updateCacheUsage()
+    settings = qt.QSettings()
+    settings.setValue("lapdMouseDBBrowserCacheSizeLimit", cacheSizeLimit)
+    settings.sync()
+
+  def onCompressVolumesChanged(self):
+    compressVolumes = self.compressVolumesCheckBox.checked
+    if self.browserWindow:
+      self.browserWindow.setCompressVolumes(compressVolumes)
+    settings = qt.QSettings()
+    settings.setValue("lapdMouseDBBrowserCompressVolumes", "true" if compressVolumes else "false")
+    settings.sync()
+
+  def updateCacheUsage(self):
+    # before the browser window is opened, usage is read from the manifest
+    # of the storage folder
+    if self.browserWindow:
+      usage = self.browserWindow.getCacheUsage()
+    else:
+      usage = cacheUsage(lapdMouseCacheManifest(self.storagePath))
+    text = humanReadableSize(usage)+" used"
+    cacheSizeLimit = self.cacheSizeLimitSpinBox.value
+    if cacheSizeLimit:
+      text += " of "+humanReadableSize(int(cacheSizeLimit*1024*1024*1024))
+    self.cacheUsageLabel.text = text
+
   def onStorageChanged(self):
-    self.browserWindow.localCacheFolder = self.storagePathButton.directory
-    self.browserWindow.load()
+    self.storagePath = self.storagePathButton.directory
+    if self.browserWindow:
+      self.browserWindow.localCacheFolder = self.storagePath
+      self.browserWindow.load()
+    self.updateCacheUsage()
     settings = qt.QSettings() 
-    settings.setValue("lapdMouseDBBrowserLocalCacheFolder", self.browserWindow.localCacheFolder)
+    settings.setValue("lapdMouseDBBrowserLocalCacheFolder", self.storagePath)
     settings.sync()
 
 #
@@ -911,7 +1585,1043 @@ class lapdMouseDBBrowserTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_lapdMouseDBBrowser1()
+    self.test_lapdMouseDBBrowserConcurrentDownload()
+    self.test_lapdMouseDBBrowserCancelDownload()
+    self.test_lapdMouseDBBrowserResumeDownload()
+    self.test_lapdMouseDBBrowserSegmentedDownload()
+    self.test_lapdMouseDBBrowserConnectionReuse()
+    self.test_lapdMouseDBBrowserInvalidResponse()
+    self.test_lapdMouseDBBrowserServerErrors()
+    self.test_lapdMouseDBBrowserChecksums()
+    self.test_lapdMouseDBBrowserManifest()
+    self.test_lapdMouseDBBrowserFailedUpdate()
+    self.test_lapdMouseDBBrowserPauseResume()
+    self.test_lapdMouseDBBrowserScheduler()
+    self.test_lapdMouseDBBrowserSyntheticArchive()
+    self.test_lapdMouseDBBrowserPreallocation()
+    self.test_lapdMouseDBBrowserUnpack()
+    self.test_lapdMouseDBBrowserRegion()
+    self.test_lapdMouseDBBrowserResolutionLevels()
+    self.test_lapdMouseDBBrowserSync()
+    self.test_lapdMouseDBBrowserSharedCache()
+    self.test_lapdMouseDBBrowserCacheEviction()
+    self.test_lapdMouseDBBrowserCompressedStorage()
+    self.test_lapdMouseDBBrowserCatalog()
+    self.test_lapdMouseDBBrowserCatalogQuery()
+    self.test_lapdMouseDBBrowserCatalogRefresh()
+    self.test_lapdMouseDBBrowserFolderScan()
+    self.test_lapdMouseDBBrowserColorTables()
+    self.test_lapdMouseDBBrowserDatasetTableModel()
+    self.test_lapdMouseDBBrowserFileTableModel()
+    self.test_lapdMouseDBBrowserStartupTimes()
 
   def test_lapdMouseDBBrowser1(self):
     self.delayDisplay('Test passed!')
 
+  def test_lapdMouseDBBrowserSyntheticArchive(self):
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    # catalog layout served with generated content and injected failures;
+    # interrupted transfers have to be resumed and verified
+    import tempfile, shutil
+    with open(os.path.join(os.path.dirname(__file__),'Resources','allfiles.json')) as f:
+      catalog = json.load(f)
+    files = {e['name']:e['size'] for e in catalog \
+      if os.path.dirname(e['name'])=='m01' and not e['isFolder'] and e['size']<20000 \
+      and os.path.basename(e['name'])!='MD5SUMS'}
+    localFolder = tempfile.mkdtemp()
+    try:
+      with lapdMouseDBBrowserTestServer(syntheticFiles=files, failureRate=0.3, seed=2) as server:
+        db = lapdMouseDBUtil(server.url)
+        db.connectionPool = lapdMouseConnectionPool()
+        for name, size in files.items():
+          localName = os.path.join(localFolder, name)
+          self.assertTrue(db.downloadFile(name, localName, size))
+          with open(localName, 'rb') as f:
+            self.assertEqual(f.read(), server.syntheticContent(name, size).read())
+        self.assertTrue(server.failureCount>0)
+        self.assertEqual(len(db.md5sums[server.url+'m01']), len(files))
+        db.connectionPool.clear()
+    finally:
+      shutil.rmtree(localFolder)
+
+  def test_lapdMouseDBBrowserPreallocation(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder, files = self._createRemoteFolder([5*1024*1024+3])
+    name, content = list(files.items())[0]
+    localFolder = tempfile.mkdtemp()
+    try:
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        db = lapdMouseDBUtil(server.url)
+        db.connectionPool = lapdMouseConnectionPool()
+        db.preallocationThreshold = 0
+        db.minimumBufferSize = db.maximumBufferSize = 64*1024
+        localName = os.path.join(localFolder, name)
+        # an aborted transfer leaves only the data received so far
+        received = []
+        def abortAfterOneMB(numberOfBytes, transferred=True):
+          received.append(numberOfBytes)
+          return sum(received)<1024*1024
+        self.assertFalse(db.downloadFile(name, localName, len(content), abortAfterOneMB))
+        self.assertEqual(os.path.getsize(localName+'.part'), sum(received))
+        self.assertFalse(os.path.exists(localName+'.part.offset'))
+        # preallocated file of a process that did not finish
+        with open(localName+'.part', 'wb') as f:
+          f.write(content[:1000]+bytes(len(content)-1000))
+        with open(localName+'.part.offset', 'w') as f:
+          f.write('1000')
+        self.assertTrue(db.downloadFile(name, localName, len(content)))
+        self.assertEqual(server.rangeRequests[-1], 'bytes=1000-')
+        with open(localName, 'rb') as f:
+          self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(localName+'.part.offset'))
+        db.connectionPool.clear()
+    finally:
+      shutil.rmtree(localFolder)
+      shutil.rmtree(remoteFolder)
+
+  def test_lapdMouseDBBrowserUnpack(self):
+    import tempfile, shutil, io
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder = tempfile.mkdtemp()
+    localFolder = tempfile.mkdtemp()
+    try:
+      members = {'slices/slice%03d.png'%i:os.urandom(100000+i) for i in range(20)}
+      name = 'm01/m01_RawCryomicrotomeData/m01_RawCryoImages_mt.tar'
+      os.makedirs(os.path.join(remoteFolder, os.path.dirname(name)))
+      with tarfile.open(os.path.join(remoteFolder, name), 'w') as archive:
+        for memberName, content in members.items():
+          info = tarfile.TarInfo(memberName)
+          info.size = len(content)
+          archive.addfile(info, io.BytesIO(content))
+      with open(os.path.join(remoteFolder, name), 'rb') as f:
+        archiveContent = f.read()
+      with open(os.path.join(remoteFolder, os.path.dirname(name), 'MD5SUMS'), 'w') as f:
+        f.write(hashlib.md5(archiveContent).hexdigest()+'  '+os.path.basename(name)+'\n')
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        db = lapdMouseDBUtil(server.url)
+        db.connectionPool = lapdMouseConnectionPool()
+        localName = os.path.join(localFolder, name)
+        folder = unpackedFolderName(localName)
+        # uninterrupted: members written, checksum verified, no archive kept
+        self.assertTrue(db.downloadAndUnpack(name, localName, len(archiveContent)))
+        for memberName, content in members.items():
+          with open(os.path.join(folder, memberName), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists(localName))
+        self.assertFalse(os.path.exists(localName+'.part.unpack'))
+        item = {'remoteName':name, 'localName':localName, 'isFolder':False, \
+          'size':len(archiveContent), 'modificationTimestamp':0}
+        self.assertEqual(getStatus(item), 'downloaded')
+        # aborted half way, resumed at the next member
+        shutil.rmtree(folder)
+        received = []
+        def abortHalfWay(numberOfBytes, transferred=True):
+          received.append(numberOfBytes)
+          return sum(received)<len(archiveContent)//2
+        self.assertFalse(db.downloadAndUnpack(name, localName, len(archiveContent), abortHalfWay))
+        self.assertEqual(getStatus(item), 'require download')
+        extracted = os.listdir(os.path.join(folder, 'slices'))
+        self.assertTrue(0<len(extracted)<len(members))
+        self.assertFalse(any(f.endswith('.part') for f in extracted))
+        offset = db._readUnpackOffset(localName+'.part.unpack')
+        self.assertEqual(offset%tarfile.BLOCKSIZE, 0)
+        self.assertTrue(db.downloadAndUnpack(name, localName, len(archiveContent)))
+        self.assertEqual(server.rangeRequests[-1], 'bytes='+str(offset)+'-')
+        for memberName, content in members.items():
+          with open(os.path.join(folder, memberName), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        # damaged archive
+        db.md5sums.clear()
+        with open(os.path.join(remoteFolder, os.path.dirname(name), 'MD5SUMS'), 'w') as f:
+          f.write('0'*32+'  '+os.path.basename(name)+'\n')
+        shutil.rmtree(folder)
+        self.assertFalse(db.downloadAndUnpack(name, localName, len(archiveContent)))
+        self.assertTrue(os.path.isdir(localName+'.corrupt'))
+        self.assertFalse(os.path.exists(folder))
+        db.connectionPool.clear()
+    finally:
+      shutil.rmtree(localFolder)
+      shutil.rmtree(remoteFolder)
+
+  def test_lapdMouseDBBrowserRegion(self):
+    import tempfile, shutil, array
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder = tempfile.mkdtemp()
+    localFolder = tempfile.mkdtemp()
+    try:
+      # voxel value encodes its index: 100*k+10*j+i
+      dimensions = (7, 5, 6)
+      voxels = array.array('H', [100*k+10*j+i for k in range(dimensions[2]) \
+        for j in range(dimensions[1]) for i in range(dimensions[0])])
+      header = 'ObjectType = Image\nNDims = 3\nBinaryData = True\nBinaryDataByteOrderMSB = False\n'+\
+        'CompressedData = False\nTransformMatrix = 0 1 0 -1 0 0 0 0 1\nOffset = 10 20 30\n'+\
+        'ElementSpacing = 0.5 2 3\nDimSize = 7 5 6\nElementType = MET_USHORT\nElementDataFile = LOCAL\n'
+      name = 'm01/m01_Aerosol.mha'
+      os.makedirs(os.path.join(remoteFolder, 'm01'))
+      with open(os.path.join(remoteFolder, name), 'wb') as f:
+        f.write(header.encode()+voxels.tobytes())
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        db = lapdMouseDBUtil(server.url)
+        db.connectionPool = lapdMouseConnectionPool()
+        fields, headerSize = db.readMetaImageHeader(name)
+        self.assertEqual(headerSize, len(header))
+        self.assertEqual(dict(fields)['DimSize'], '7 5 6')
+        def readRegion(localName):
+          with open(localName, 'rb') as f:
+            content = f.read()
+          headerEnd = content.index(b'ElementDataFile = LOCAL\n')+len(b'ElementDataFile = LOCAL\n')
+          values = dict(line.split(' = ') for line in content[:headerEnd].decode().splitlines())
+          return values, array.array('H', content[headerEnd:])
+        # box, the gap between its rows is larger than maximumRangeGap
+        del server.rangeRequests[:]
+        db.maximumRangeGap = 0
+        localName = os.path.join(localFolder, 'm01', 'm01_AerosolROI.mha')
+        self.assertTrue(db.downloadRegion(name, localName, (2, 1, 3), (5, 3, 100)))
+        values, data = readRegion(localName)
+        self.assertEqual(values['DimSize'], '3 2 3')
+        self.assertEqual([float(v) for v in values['Offset'].split()], [10-2, 20+1, 30+9])
+        self.assertEqual(list(data), [100*k+10*j+i for k in range(3, 6) for j in range(1, 3) for i in range(2, 5)])
+        self.assertEqual(len(server.rangeRequests), 1+3*2)
+        # slices are contiguous and need a single request
+        del server.rangeRequests[:]
+        db.maximumRangeGap = 64*1024
+        self.assertTrue(db.downloadSlices(name, localName, 1, 2))
+        values, data = readRegion(localName)
+        self.assertEqual(values['DimSize'], '7 5 2')
+        self.assertEqual(list(data), list(voxels[7*5:3*7*5]))
+        self.assertEqual(len(server.rangeRequests), 2)
+        db.connectionPool.clear()
+    finally:
+      shutil.rmtree(localFolder)
+      shutil.rmtree(remoteFolder)
+
+  def test_lapdMouseDBBrowserResolutionLevels(self):
+    self.assertEqual(finerResolutionFileName('m01_AerosolNormalizedSub4.mha'), 'm01_AerosolNormalizedSub2.mha')
+    self.assertEqual(finerResolutionFileName('m01_AerosolNormalizedSub2.mha'), 'm01_AerosolNormalized.mha')
+    self.assertEqual(finerResolutionFileName('m01_AerosolNormalized.mha'), None)
+    self.assertEqual(finerResolutionFileName('m01_AutofluorescentSub4.mha', 'Sub2'), 'm01_AutofluorescentSub2.mha')
+    self.assertEqual(finerResolutionFileName('m01_AutofluorescentSub2.mha', 'Sub2'), None)
+    self.assertEqual(finerResolutionFileName('m01_Lobes.nrrd', 'Sub2'), None)
+
+  def test_lapdMouseDBBrowserSync(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    from lapdMouseDBBrowserLib import Sync
+    files = {'m01/m01_Lobes.nrrd':1000, 'm01/m01_AerosolSub4.mha':300000, \
+      'm01/m01_RawCryomicrotomeData/spacing.json':87, 'm02/m02_Lobes.nrrd':2000}
+    catalog = [{'name':'m01', 'isFolder':True, 'size':0, 'modificationTimestamp':0}, \
+      {'name':'m02', 'isFolder':True, 'size':0, 'modificationTimestamp':0}]
+    catalog += [{'name':name, 'isFolder':False, 'size':size, 'modificationTimestamp':1500929216969} \
+      for name, size in files.items()]
+    workFolder = tempfile.mkdtemp()
+    try:
+      catalogFile = os.path.join(workFolder, 'allfiles.json')
+      with open(catalogFile, 'w') as f:
+        json.dump(catalog, f)
+      localFolder = os.path.join(workFolder, 'lapdMouse')
+      with lapdMouseDBBrowserTestServer(syntheticFiles=files) as server:
+        arguments = ['--remote-url', server.url, '--catalog', catalogFile, '--local-folder', localFolder, \
+          '--datasets', 'm01', '--progress-interval', '0.1']
+        self.assertEqual(Sync.main(arguments+['--dry-run']), 0)
+        self.assertFalse(os.path.exists(os.path.join(localFolder, 'm01')))
+        self.assertEqual(Sync.main(arguments+['--files', '*.nrrd,spacing.json']), 0)
+        self.assertTrue(os.path.exists(os.path.join(localFolder, 'm01', 'm01_Lobes.nrrd')))
+        self.assertTrue(os.path.exists(os.path.join(localFolder, 'm01', 'm01_RawCryomicrotomeData', 'spacing.json')))
+        self.assertFalse(os.path.exists(os.path.join(localFolder, 'm01', 'm01_AerosolSub4.mha')))
+        self.assertFalse(os.path.exists(os.path.join(localFolder, 'm02')))
+        db = lapdMouseDBUtil(server.url)
+        db.catalogFile = catalogFile
+        items = Sync.listItems(db, localFolder, ['m0*'], ['*'], lapdMouseCacheManifest(localFolder))
+        self.assertEqual(sorted((i['remoteName'], i['status']) for i in items), \
+          [('m01/m01_AerosolSub4.mha', 'require download'), \
+          ('m01/m01_Lobes.nrrd', 'downloaded'), \
+          ('m01/m01_RawCryomicrotomeData/spacing.json', 'downloaded'), \
+          ('m02/m02_Lobes.nrrd', 'require download')])
+        # a second sync of the same folder has to wait for the first one
+        lockFile = Sync.lockFolder(localFolder)
+        self.assertEqual(Sync.main(arguments), 3)
+        lockFile.close()
+        self.assertEqual(Sync.main(arguments+['--workers', '2']), 0)
+        self.assertTrue(os.path.exists(os.path.join(localFolder, 'm01', 'm01_AerosolSub4.mha')))
+    finally:
+      shutil.rmtree(workFolder)
+
+  def test_lapdMouseDBBrowserSharedCache(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder, files = self._createRemoteFolder([1000, 200000])
+    with open(os.path.join(remoteFolder, 'm01', 'MD5SUMS'), 'w') as f:
+      for name, content in files.items():
+        f.write(hashlib.md5(content).hexdigest()+'  '+os.path.basename(name)+'\n')
+    workFolder = tempfile.mkdtemp()
+    try:
+      sharedCache = lapdMouseSharedCache(os.path.join(workFolder, 'shared'))
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        url = server.url
+        db = lapdMouseDBUtil(url)
+        db.connectionPool = lapdMouseConnectionPool()
+        db.sharedCache = sharedCache
+        for name, content in files.items():
+          localName = os.path.join(workFolder, 'user1', name)
+          self.assertTrue(db.downloadFile(name, localName, len(content)))
+          md5 = hashlib.md5(content).hexdigest()
+          self.assertTrue(sharedCache.contains(md5, len(content)))
+          self.assertTrue(os.path.samefile(localName, sharedCache.path(md5)))
+        db.connectionPool.clear()
+      # a second user gets the files without the archive being reachable
+      db = lapdMouseDBUtil(url)
+      db.sharedCache = sharedCache
+      db.maxRetries = 0
+      for name, content in files.items():
+        localName = os.path.join(workFolder, 'user2', name)
+        reported = []
+        self.assertTrue(db.downloadFile(name, localName, len(content), \
+          lambda numberOfBytes, transferred=True: reported.append((numberOfBytes, transferred))))
+        self.assertEqual(reported, [(len(content), False)])
+        with open(localName, 'rb') as f:
+          self.assertEqual(f.read(), content)
+      # deleting a user's file leaves the shared copy
+      os.remove(os.path.join(workFolder, 'user2', name))
+      self.assertTrue(sharedCache.contains(hashlib.md5(content).hexdigest()))
+      # a failed download over a symbolic link into the shared cache keeps
+      # both the link and the shared copy
+      md5 = hashlib.md5(content).hexdigest()
+      localName = os.path.join(workFolder, 'user3', name)
+      os.makedirs(os.path.dirname(localName))
+      os.symlink(sharedCache.path(md5), localName)
+      db = lapdMouseDBUtil(url)
+      db.maxRetries = 0
+      item = {'remoteName':name, 'localName':localName, 'isFolder':False, 'size':len(content)+1, \
+        'modificationTimestamp':0, 'status':'require update'}
+      self.assertIsNotNone(downloadItem(item, db))
+      self.assertTrue(sharedCache.contains(md5, len(content)))
+      self.assertTrue(os.path.islink(localName))
+      with open(localName, 'rb') as f:
+        self.assertEqual(f.read(), content)
+    finally:
+      shutil.rmtree(workFolder)
+      shutil.rmtree(remoteFolder)
+
+  def test_lapdMouseDBBrowserCacheEviction(self):
+    import tempfile, shutil
+    localFolder = tempfile.mkdtemp()
+    try:
+      manifest = lapdMouseCacheManifest(localFolder)
+      os.makedirs(os.path.join(localFolder, 'm01'))
+      for i in range(5):
+        name = 'm01/m01_File'+str(i)+'.bin'
+        with open(os.path.join(localFolder, name), 'wb') as f:
+          f.write(b'x'*1000)
+        manifest.setComplete(name, 1000, 1500929216969)
+        manifest.setLastLoaded(name, 1000+i)
+      self.assertEqual(cacheUsage(manifest), 5000)
+      self.assertEqual(evictFiles(manifest, 5000), [])
+      manifest.setLastLoaded('m01/m01_File0.bin', 2000)
+      manifest.setPinned('m01/m01_File1.bin')
+      # pinning and loading survive a new download of the file
+      manifest.setComplete('m01/m01_File1.bin', 1000, 1600000000000)
+      self.assertTrue(manifest.isPinned('m01/m01_File1.bin'))
+      removed = evictFiles(manifest, 2500, keep=['m01/m01_File2.bin'])
+      self.assertEqual(removed, ['m01/m01_File3.bin', 'm01/m01_File4.bin', 'm01/m01_File0.bin'])
+      self.assertEqual(cacheUsage(manifest), 2000)
+      self.assertFalse(os.path.exists(os.path.join(localFolder, 'm01', 'm01_File0.bin')))
+      manifest = lapdMouseCacheManifest(localFolder)
+      self.assertEqual(sorted(manifest.entries.keys()), ['m01/m01_File1.bin', 'm01/m01_File2.bin'])
+      self.assertEqual(manifest.get('m01/m01_File2.bin')['lastLoaded'], 1002)
+    finally:
+      shutil.rmtree(localFolder)
+
+  def test_lapdMouseDBBrowserCompressedStorage(self):
+    import tempfile, shutil, zlib
+    localFolder = tempfile.mkdtemp()
+    try:
+      header = 'ObjectType = Image\nNDims = 3\nBinaryData = True\nBinaryDataByteOrderMSB = False\n'+\
+        'CompressedData = False\nDimSize = 64 64 64\nElementType = MET_USHORT\nElementDataFile = LOCAL\n'
+      data = bytearray(2*64*64*64)
+      data[1000:1100] = os.urandom(100)
+      name = 'm01/m01_AerosolSub4.mha'
+      localName = os.path.join(localFolder, 'm01', 'm01_AerosolSub4.mha')
+      os.makedirs(os.path.dirname(localName))
+      with open(localName, 'wb') as f:
+        f.write(header.encode('latin-1')+bytes(data))
+      size = os.path.getsize(localName)
+      os.utime(localName, (1500929216, 1500929216))
+      manifest = lapdMouseCacheManifest(localFolder)
+      manifest.setComplete(name, size, 1500929216000, 'd41d8cd98f00b204e9800998ecf8427e')
+      compressor = lapdMouseCacheCompressor(manifest)
+      compressor.addAll()
+      compressor.wait()
+      storedSize = os.path.getsize(localName)
+      self.assertLess(storedSize, size/10)
+      self.assertEqual(manifest.get(name)['storedSize'], storedSize)
+      self.assertEqual(manifest.get(name)['size'], size)
+      self.assertEqual(os.path.getmtime(localName), 1500929216)
+      item = {'remoteName':name, 'localName':localName, 'isFolder':False, 'size':size, \
+        'modificationTimestamp':1500929216000}
+      self.assertEqual(getStatus(item, lapdMouseCacheManifest(localFolder)), 'downloaded')
+      with open(localName, 'rb') as f:
+        content = f.read()
+      headerSize = content.index(b'ElementDataFile = LOCAL\n')+len('ElementDataFile = LOCAL\n')
+      fields = dict(l.split(' = ') for l in content[:headerSize].decode('latin-1').splitlines())
+      self.assertEqual(fields['CompressedData'], 'True')
+      self.assertEqual(int(fields['CompressedDataSize']), storedSize-headerSize)
+      self.assertEqual(fields['DimSize'], '64 64 64')
+      self.assertEqual(zlib.decompress(content[headerSize:]), bytes(data))
+      # compressed files are not compressed again
+      self.assertFalse(compressor.compressFile(name))
+      self.assertEqual(compressMetaImage(localName), None)
+    finally:
+      shutil.rmtree(localFolder)
+
+  def test_lapdMouseDBBrowserCatalog(self):
+    import tempfile, shutil
+    workFolder = tempfile.mkdtemp()
+    try:
+      catalogFile = os.path.join(workFolder, 'allfiles.json')
+      entries = [{'name':'m01', 'isFolder':True, 'size':0, 'modificationTimestamp':1}, \
+        {'name':'m01/m01_Lobes.nrrd', 'isFolder':False, 'size':10, 'modificationTimestamp':1}, \
+        {'name':'m01/m01_Raw', 'isFolder':True, 'size':0, 'modificationTimestamp':1}, \
+        {'name':'m01/m01_Raw/m01_Images.tar', 'isFolder':False, 'size':20, 'modificationTimestamp':1}, \
+        {'name':'m02', 'isFolder':True, 'size':0, 'modificationTimestamp':1}]
+      with open(catalogFile, 'w') as f:
+        json.dump(entries, f)
+      db = lapdMouseDBUtil('')
+      db.catalogFile = catalogFile
+      self.assertEqual([e['name'] for e in db.listDirectory()], ['m01', 'm02'])
+      self.assertEqual([e['name'] for e in db.listDirectory('m01')], ['m01', 'm01_Lobes.nrrd', 'm01_Raw'])
+      self.assertEqual([e['name'] for e in db.listDirectory('m01', 1)], \
+        ['m01', 'm01_Lobes.nrrd', 'm01_Raw', 'm01_Raw/m01_Images.tar'])
+      self.assertEqual(db.listDirectory('m03'), [])
+      # parsed once, entries are copies
+      catalog = lapdMouseCatalog.get(catalogFile)
+      self.assertIs(lapdMouseCatalog.get(catalogFile), catalog)
+      db.listDirectory('m01')[1]['size'] = 0
+      self.assertEqual(db.listDirectory('m01')[1]['size'], 10)
+      # a changed file is read again
+      entries[1]['size'] = 11
+      with open(catalogFile, 'w') as f:
+        json.dump(entries, f)
+      os.utime(catalogFile, ns=(0, os.stat(catalogFile).st_mtime_ns+1000000000))
+      self.assertIsNot(lapdMouseCatalog.get(catalogFile), catalog)
+      self.assertEqual(db.listDirectory('m01')[1]['size'], 11)
+      db.catalogFile = os.path.join(workFolder, 'missing.json')
+      self.assertEqual(db.listDirectory(), [])
+    finally:
+      shutil.rmtree(workFolder)
+
+  def test_lapdMouseDBBrowserCatalogQuery(self):
+    catalog = lapdMouseCatalog.get(lapdMouseDBUtil('').catalogFile)
+    entries = [e for e in catalog.entries if not e['isFolder'] and '/' in e['name']]
+    lobesDeposition = catalog.query(suffix='_LobesDeposition.csv')
+    self.assertEqual(sorted(e['name'] for e in lobesDeposition), \
+      sorted(e['name'] for e in entries if e['name'].endswith('_LobesDeposition.csv')))
+    self.assertEqual(catalog.query(pattern='*_LobesDeposition.csv'), lobesDeposition)
+    sub4 = catalog.summarize(pattern='*Sub4.mha')
+    self.assertEqual(sum(size for n, size in sub4.values()), \
+      sum(e['size'] for e in entries if e['name'].endswith('Sub4.mha')))
+    self.assertEqual(sorted(sub4.keys()), sorted(set(e['name'].split('/')[0] for e in entries \
+      if e['name'].endswith('Sub4.mha'))))
+    large = catalog.query(datasets=['m01', 'm02'], minimumSize=1024*1024*1024, modifiedAfter=0)
+    self.assertEqual(sorted(e['name'] for e in large), sorted(e['name'] for e in entries \
+      if e['name'].split('/')[0] in ['m01', 'm02'] and e['size']>=1024*1024*1024))
+    self.assertEqual(catalog.query(maximumSize=-1), [])
+    self.assertEqual(catalog.summarize(datasets=['m01'], modifiedBefore=0), {})
+
+  def test_lapdMouseDBBrowserCatalogRefresh(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    workFolder = tempfile.mkdtemp()
+    try:
+      def entry(name, size, modificationTimestamp=1500929216969):
+        return {'name':name, 'isFolder':False, 'size':size, 'modificationTimestamp':modificationTimestamp}
+      bundledCatalogFile = os.path.join(workFolder, 'bundled.json')
+      with open(bundledCatalogFile, 'w') as f:
+        json.dump([entry('m01/m01_A.nrrd', 10), entry('m01/m01_B.nrrd', 20), entry('m01/m01_D.nrrd', 40)], f)
+      remoteFolder = os.path.join(workFolder, 'remote')
+      os.makedirs(remoteFolder)
+      remoteCatalog = [entry('m01/m01_A.nrrd', 12), entry('m01/m01_B.nrrd', 20), entry('m01/m01_C.nrrd', 30)]
+      with open(os.path.join(remoteFolder, 'allfiles.json'), 'w') as f:
+        json.dump(remoteCatalog, f)
+      localFolder = os.path.join(workFolder, 'local')
+      cachedCatalogFile = os.path.join(localFolder, lapdMouseCatalog.cachedFileName)
+      manifest = lapdMouseCacheManifest(localFolder)
+      os.makedirs(os.path.join(localFolder, 'm01'))
+      with open(os.path.join(localFolder, 'm01', 'm01_A.nrrd'), 'wb') as f:
+        f.write(b'x'*10)
+      manifest.setComplete('m01/m01_A.nrrd', 10, 1500929216969)
+      def status(db, name):
+        e = [e for e in db.listDirectory('m01') if e['name']==os.path.basename(name)][0]
+        item = {'remoteName':name, 'localName':os.path.join(localFolder, name), 'isFolder':False, \
+          'size':e['size'], 'modificationTimestamp':e['modificationTimestamp']}
+        return getStatus(item, manifest)
+      # offline without an earlier refresh: bundled catalog
+      db = lapdMouseDBUtil('http://127.0.0.1:1/')
+      db.catalogFile = bundledCatalogFile
+      self.assertEqual(db.refreshCatalog(cachedCatalogFile), None)
+      self.assertEqual(db.catalogFile, bundledCatalogFile)
+      self.assertEqual(status(db, 'm01/m01_A.nrrd'), 'downloaded')
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        db = lapdMouseDBUtil(server.url)
+        db.catalogFile = bundledCatalogFile
+        self.assertEqual(sorted(db.refreshCatalog(cachedCatalogFile)), \
+          ['m01/m01_A.nrrd', 'm01/m01_C.nrrd', 'm01/m01_D.nrrd'])
+        self.assertEqual(db.catalogFile, cachedCatalogFile)
+        self.assertEqual(sorted(e['name'] for e in db.listDirectory('m01')), \
+          ['m01_A.nrrd', 'm01_B.nrrd', 'm01_C.nrrd'])
+        # changed size with the same timestamp: the refresh time is recorded
+        self.assertEqual(status(db, 'm01/m01_A.nrrd'), 'require update')
+        # unchanged catalog: conditional request answered with 304
+        db = lapdMouseDBUtil(server.url)
+        self.assertEqual(db.refreshCatalog(cachedCatalogFile), [])
+        self.assertEqual(server.notModifiedCount, 1)
+        remoteCatalog[1] = entry('m01/m01_B.nrrd', 20, 1600000000000)
+        with open(os.path.join(remoteFolder, 'allfiles.json'), 'w') as f:
+          json.dump(remoteCatalog, f)
+        os.utime(os.path.join(remoteFolder, 'allfiles.json'), (1600000000, 1600000000))
+        self.assertEqual(db.refreshCatalog(cachedCatalogFile), ['m01/m01_B.nrrd'])
+        self.assertEqual(status(db, 'm01/m01_A.nrrd'), 'require update')
+      # offline after a refresh: refreshed catalog
+      db = lapdMouseDBUtil('http://127.0.0.1:1/')
+      db.catalogFile = bundledCatalogFile
+      self.assertEqual(db.refreshCatalog(cachedCatalogFile), None)
+      self.assertEqual(db.catalogFile, cachedCatalogFile)
+    finally:
+      shutil.rmtree(workFolder)
+
+  def test_lapdMouseDBBrowserFolderScan(self):
+    import tempfile, shutil
+    localFolder = tempfile.mkdtemp()
+    try:
+      datasetFolder = os.path.join(localFolder, 'm01')
+      os.makedirs(os.path.join(datasetFolder, 'm01_RawCryoImages_fl'))
+      for name, size in [('m01_A.nrrd', 10), ('m01_B.nrrd', 5), ('m01_C.nrrd.part', 3)]:
+        with open(os.path.join(datasetFolder, name), 'wb') as f:
+          f.write(b'x'*size)
+        os.utime(os.path.join(datasetFolder, name), (1500929216, 1500929216))
+      folderEntries = scanFolder(datasetFolder)
+      self.assertEqual(sorted(folderEntries.keys()), \
+        ['m01_A.nrrd', 'm01_B.nrrd', 'm01_C.nrrd.part', 'm01_RawCryoImages_fl'])
+      self.assertEqual(folderEntries['m01_A.nrrd'][0], 10)
+      self.assertTrue(folderEntries['m01_RawCryoImages_fl'][2])
+      self.assertEqual(scanFolder(os.path.join(localFolder, 'm02')), {})
+      # same results as with separate calls per file
+      for name, size, modificationTimestamp in [('m01_A.nrrd', 10, 1500929216000), ('m01_B.nrrd', 10, 0), \
+        ('m01_A.nrrd', 10, 1600000000000), ('m01_C.nrrd', 3, 0), ('m01_RawCryoImages_fl.tar', 100, 0)]:
+        item = {'remoteName':'m01/'+name, 'localName':os.path.join(datasetFolder, name), 'isFolder':False, \
+          'size':size, 'modificationTimestamp':modificationTimestamp}
+        self.assertEqual(getStatus(item, None, folderEntries), getStatus(item))
+      self.assertEqual(getStatus(dict(item, localName=os.path.join(datasetFolder, 'm01_A.nrrd'), size=10), \
+        None, folderEntries), 'downloaded')
+    finally:
+      shutil.rmtree(localFolder)
+
+  def test_lapdMouseDBBrowserColorTables(self):
+    # the precomputed palette has the colors of the former per-entry setup
+    import random, numpy
+    random.seed(3)
+    expected = [[1,1,1,1]]+[[random.uniform(0.0,1.0),random.uniform(0.0,1.0),random.uniform(0.0,1.0),1] \
+      for i in range(1,5000)]
+    expected = numpy.array([[int(v*255.0+0.5) for v in rgba] for rgba in expected], dtype=numpy.uint8)
+    colors = lapdMouseDBBrowser.randomColors(5000)
+    self.assertEqual(colors.shape, (5000,4))
+    self.assertTrue(numpy.array_equal(colors, expected))
+    # no dependence on the global random state
+    random.seed(0)
+    self.assertTrue(numpy.array_equal(lapdMouseDBBrowser.randomColors(5000), expected))
+
+  def test_lapdMouseDBBrowserDatasetTableModel(self):
+    # the dataset list keeps its rows, changed names are replaced in place
+    model = lapdMouseDatasetTableModel()
+    model.setDatasets(['m01', 'm02'])
+    self.assertEqual(model.rowCount(), 2)
+    self.assertEqual(model.columnCount(), 1)
+    self.assertEqual(model.headerData(0, qt.Qt.Horizontal, qt.Qt.DisplayRole), 'Dataset name')
+    self.assertEqual(model.cellData(1, 0, qt.Qt.DisplayRole), 'm02')
+    datasets = ['m01', 'm03', 'm04']
+    model.setDatasets(datasets)
+    self.assertEqual([model.cellData(i, 0, qt.Qt.DisplayRole) for i in range(model.rowCount())], datasets)
+    datasets.append('m05') # the model keeps its own list
+    self.assertEqual(model.rowCount(), 3)
+    model.setDatasets(['m02'])
+    self.assertEqual(model.datasets, ['m02'])
+    self.assertIsNone(model.cellData(0, 0, qt.Qt.ToolTipRole))
+
+  def test_lapdMouseDBBrowserFileTableModel(self):
+    # file table rows are plain dicts, a changed row is replaced in place
+    sortRole, filterRole = qt.Qt.UserRole, qt.Qt.UserRole+1
+    model = lapdMouseFileTableModel({'downloaded':'stored', 'require update':'stored', \
+      'require download':'download'}, sortRole, filterRole)
+    rows = [{'name':'m01_B.nrrd', 'size':2048, 'sizeText':'2.0KB', 'status':'require download', \
+      'toolTip':'available for download', 'filterKey':'require download;small'}, \
+      {'name':'m01_A.nrrd', 'size':10, 'sizeText':'10B', 'status':'downloaded', \
+      'toolTip':'downloaded', 'filterKey':'downloaded;small'}]
+    model.setRows(rows)
+    self.assertEqual(model.rowCount(), 2)
+    self.assertEqual(model.columnCount(), 3)
+    self.assertEqual(model.rowIndex, {'m01_B.nrrd':0, 'm01_A.nrrd':1})
+    self.assertEqual(model.headerData(1, qt.Qt.Horizontal, qt.Qt.DisplayRole), 'Filename')
+    self.assertEqual(model.cellData(0, 0, qt.Qt.DecorationRole), 'download')
+    self.assertEqual(model.cellData(0, 0, sortRole), 2)
+    self.assertEqual(model.cellData(0, 0, filterRole), 'require download;small')
+    self.assertEqual(model.cellData(1, 1, qt.Qt.DisplayRole), 'm01_A.nrrd')
+    self.assertEqual(model.cellData(1, 1, sortRole), 'm01_a.nrrd')
+    self.assertEqual(model.cellData(0, 2, sortRole), 2048)
+    self.assertIsNone(model.cellData(0, 1, qt.Qt.DecorationRole))
+    model.setRow(0, dict(rows[0], status='downloaded', toolTip='downloaded', filterKey='downloaded;small'))
+    self.assertEqual(model.cellData(0, 0, qt.Qt.DecorationRole), 'stored')
+    self.assertEqual(model.cellData(0, 0, qt.Qt.ToolTipRole), 'downloaded')
+    self.assertEqual(model.cellData(0, 0, sortRole), 0)
+    self.assertEqual(model.rowIndex['m01_B.nrrd'], 0)
+
+  def test_lapdMouseDBBrowserStartupTimes(self):
+    times = [('module import', None, 1.0), ('module import', 'libraries', 1.25), ('module setup', None, 5.0), \
+      ('module import', 'definitions', 1.5), ('module setup', 'settings panel', 5.125)]
+    lines = startupTimeReport(times)
+    self.assertEqual([line.split() for line in lines], [['module', 'import:', 'libraries', '0.250', 's'], \
+      ['module', 'import:', 'definitions', '0.250', 's'], ['module', 'setup:', 'settings', 'panel', '0.125', 's'], \
+      ['module', 'import', 'total', '0.500', 's'], ['module', 'setup', 'total', '0.125', 's']])
+    self.assertEqual(len(startupTimeReport(times, ['module setup'])), 2)
+    # steps recorded while importing this module
+    self.assertEqual([step for phase, step, t in startupTimes if phase=='module import'][:3], \
+      [None, 'Slicer and standard library modules', 'lapdMouseDBBrowserLib'])
+
+  def _createRemoteFolder(self, sizes):
+    # synthetic dataset m01 with one file per entry in sizes
+    import tempfile
+    remoteFolder = tempfile.mkdtemp()
+    os.makedirs(os.path.join(remoteFolder,'m01'))
+    files = {}
+    for i, size in enumerate(sizes):
+      name = 'm01/m01_File'+str(i)+'.bin'
+      content = os.urandom(size)
+      with open(os.path.join(remoteFolder,name), 'wb') as f:
+        f.write(content)
+      files[name] = content
+    return remoteFolder, files
+
+  def test_lapdMouseDBBrowserConcurrentDownload(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder, files = self._createRemoteFolder([0, 10, 1024, 3*1024*1024+7, 200000, 5])
+    localFolder = tempfile.mkdtemp()
+    try:
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        engine = lapdMouseDownloadEngine(server.url, numberOfWorkers=3)
+        for name, content in files.items():
+          engine.addJob(name, os.path.join(localFolder,name), len(content))
+        engine.addJob('m01/missing.bin', os.path.join(localFolder,'m01','missing.bin'), 1)
+        engine.start()
+        self.assertTrue(engine.wait(60))
+      for name, content in files.items():
+        with open(os.path.join(localFolder,name), 'rb') as f:
+          self.assertEqual(f.read(), content)
+      self.assertEqual([j['remoteName'] for j in engine.failedJobs()], ['m01/missing.bin'])
+      filesFinished, filesTotal, bytesDownloaded, bytesTotal = engine.progress()
+      self.assertEqual(filesFinished, filesTotal)
+      self.assertEqual(bytesDownloaded, sum(len(c) for c in files.values()))
+    finally:
+      shutil.rmtree(remoteFolder)
+      shutil.rmtree(localFolder)
+    self.delayDisplay('Concurrent download test passed!')
+
+  def test_lapdMouseDBBrowserCancelDownload(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder, files = self._createRemoteFolder([4*1024*1024]*6)
+    localFolder = tempfile.mkdtemp()
+    try:
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        engine = lapdMouseDownloadEngine(server.url, numberOfWorkers=2)
+        for name, content in files.items():
+          engine.addJob(name, os.path.join(localFolder,name), len(content))
+        engine.start()
+        engine.cancel()
+        self.assertTrue(engine.wait(60))
+      self.assertEqual(engine.failedJobs(), [])
+      self.assertIn('canceled', [j['status'] for j in engine.jobs])
+      for job in engine.jobs:
+        self.assertIn(job['status'], ['done','canceled'])
+        if job['status']=='canceled':
+          self.assertFalse(os.path.exists(job['localName']))
+    finally:
+      shutil.rmtree(remoteFolder)
+      shutil.rmtree(localFolder)
+    self.delayDisplay('Cancel download test passed!')
+
+  def test_lapdMouseDBBrowserResumeDownload(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder, files = self._createRemoteFolder([1000000, 5000])
+    localFolder = tempfile.mkdtemp()
+    try:
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        db = lapdMouseDBUtil(server.url)
+        for name, content in files.items():
+          localName = os.path.join(localFolder,name)
+          os.makedirs(os.path.dirname(localName), exist_ok=True)
+          with open(localName+'.part', 'wb') as f:
+            f.write(content[:len(content)//3])
+          self.assertTrue(db.downloadFile(name, localName, len(content)))
+          self.assertFalse(os.path.exists(localName+'.part'))
+          with open(localName, 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(server.rangeRequests, ['bytes=333333-', 'bytes=1666-'])
+        # a partial file that is longer than the catalog size gets discarded
+        name = 'm01/m01_File1.bin'
+        localName = os.path.join(localFolder,name)
+        os.remove(localName)
+        with open(localName+'.part', 'wb') as f:
+          f.write(b'x'*6000)
+        self.assertTrue(db.downloadFile(name, localName, len(files[name])))
+        with open(localName, 'rb') as f:
+          self.assertEqual(f.read(), files[name])
+        # incomplete download does not end up under the final name
+        db.maxRetries = 1
+        self.assertFalse(db.downloadFile(name, localName+'2', len(files[name])+1))
+    finally:
+      shutil.rmtree(remoteFolder)
+      shutil.rmtree(localFolder)
+    self.delayDisplay('Resume download test passed!')
+
+  def test_lapdMouseDBBrowserSegmentedDownload(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder, files = self._createRemoteFolder([1000000])
+    name, content = list(files.items())[0]
+    localFolder = tempfile.mkdtemp()
+    try:
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        db = lapdMouseDBUtil(server.url)
+        db.segmentedDownloadThreshold = 500000
+        db.segmentSize = 300000
+        db.numberOfSegmentConnections = 3
+        localName = os.path.join(localFolder,name)
+        self.assertTrue(db.downloadFile(name, localName, len(content)))
+        with open(localName, 'rb') as f:
+          self.assertEqual(f.read(), content)
+        self.assertEqual(sorted(server.rangeRequests[1:]), \
+          ['bytes=0-299999', 'bytes=300000-599999', 'bytes=600000-899999', 'bytes=900000-999999'])
+        # resume with segments 0 and 2 already completed
+        os.remove(localName)
+        with open(localName+'.part', 'wb') as f:
+          f.write(content[:300000]+bytes(300000)+content[600000:900000]+bytes(100000))
+        with open(localName+'.part.segments', 'w') as f:
+          json.dump([0,2], f)
+        del server.rangeRequests[:]
+        self.assertTrue(db.downloadFile(name, localName, len(content)))
+        with open(localName, 'rb') as f:
+          self.assertEqual(f.read(), content)
+        self.assertEqual(sorted(server.rangeRequests[1:]), ['bytes=300000-599999', 'bytes=900000-999999'])
+        self.assertFalse(os.path.exists(localName+'.part.segments'))
+    finally:
+      shutil.rmtree(remoteFolder)
+      shutil.rmtree(localFolder)
+    self.delayDisplay('Segmented download test passed!')
+
+  def test_lapdMouseDBBrowserConnectionReuse(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder, files = self._createRemoteFolder([100, 0, 20000, 3000000])
+    with open(os.path.join(remoteFolder,'m01','MD5SUMS'), 'w') as f:
+      for name, content in files.items():
+        f.write(hashlib.md5(content).hexdigest()+'  '+os.path.basename(name)+'\n')
+    localFolder = tempfile.mkdtemp()
+    certificateFile = lapdMouseDBBrowserTestServer.createCertificate(localFolder)
+    try:
+      for certificate in [None, certificateFile]:
+        with lapdMouseDBBrowserTestServer(remoteFolder, certificate) as server:
+          db = lapdMouseDBUtil(server.url)
+          db.connectionPool = lapdMouseConnectionPool()
+          if certificate:
+            db.connectionPool.sslContext = ssl.create_default_context(cafile=certificate)
+          for name, content in files.items():
+            localName = os.path.join(localFolder,name)
+            self.assertTrue(db.downloadFile(name, localName, len(content)))
+            with open(localName, 'rb') as f:
+              self.assertEqual(f.read(), content)
+            os.remove(localName)
+          self.assertTrue(db._canAccess())
+          self.assertEqual(server.connectionCount, 1)
+          self.assertFalse(db.downloadFile('m01/missing.bin', os.path.join(localFolder,'missing.bin')))
+          db.connectionPool.clear()
+    finally:
+      shutil.rmtree(remoteFolder)
+      shutil.rmtree(localFolder)
+    self.delayDisplay('Connection reuse test passed!')
+
+  def test_lapdMouseDBBrowserServerErrors(self):
+    # 5xx and 429 responses are retried, other error codes are not
+    import tempfile, shutil, http.server
+    content = os.urandom(1000)
+    requests = []
+    class ErrorHandler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def log_message(self, format, *args):
+        pass
+      def do_GET(self):
+        requests.append((self.path, self.headers.get('Range')))
+        codes = {'/m01/m01_A.nrrd':[503, 429, 200], '/m01/m01_B.nrrd':[404, 200]}[self.path]
+        code = codes[min(len([r for r in requests if r[0]==self.path]), len(codes))-1]
+        body = content if code==200 else b''
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ErrorHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    localFolder = tempfile.mkdtemp()
+    try:
+      db = lapdMouseDBUtil('http://127.0.0.1:'+str(httpd.server_address[1])+'/')
+      db.connectionPool = lapdMouseConnectionPool()
+      db.verifyChecksums = False
+      db.maxRetries = 2
+      localName = os.path.join(localFolder,'m01','m01_A.nrrd')
+      self.assertTrue(db.downloadFile('m01/m01_A.nrrd', localName, len(content)))
+      with open(localName, 'rb') as f:
+        self.assertEqual(f.read(), content)
+      self.assertEqual(len(requests), 3)
+      self.assertFalse(db.downloadFile('m01/m01_B.nrrd', os.path.join(localFolder,'m01','m01_B.nrrd'), len(content)))
+      self.assertEqual(len(requests), 4)
+      db.connectionPool.clear()
+    finally:
+      httpd.shutdown()
+      httpd.server_close()
+      shutil.rmtree(localFolder)
+
+  def test_lapdMouseDBBrowserInvalidResponse(self):
+    # a server answering with a garbage status line fails like an unreachable
+    # one: URLError from the pool, retries and False from downloadFile
+    import tempfile, shutil, socketserver
+    class GarbageHandler(socketserver.StreamRequestHandler):
+      def handle(self):
+        self.rfile.readline()
+        self.wfile.write(b'garbage\r\n\r\n')
+    httpd = socketserver.ThreadingTCPServer(('127.0.0.1', 0), GarbageHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    localFolder = tempfile.mkdtemp()
+    try:
+      db = lapdMouseDBUtil('http://127.0.0.1:'+str(httpd.server_address[1])+'/')
+      db.connectionPool = lapdMouseConnectionPool()
+      db.maxRetries = 1
+      with self.assertRaises(urllib.error.URLError):
+        db.connectionPool.request(db.gdriveURL+'m01/MD5SUMS')
+      self.assertFalse(db.downloadFile('m01/m01_A.nrrd', os.path.join(localFolder,'m01','m01_A.nrrd'), 100))
+      self.assertFalse(os.path.exists(os.path.join(localFolder,'m01','m01_A.nrrd')))
+    finally:
+      httpd.shutdown()
+      httpd.server_close()
+      shutil.rmtree(localFolder)
+
+  def test_lapdMouseDBBrowserChecksums(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder, files = self._createRemoteFolder([300000, 300000, 1000000, 1000000])
+    names = sorted(files.keys())
+    with open(os.path.join(remoteFolder,'m01','MD5SUMS'), 'w') as f:
+      for i, name in enumerate(names):
+        digest = hashlib.md5(files[name]).hexdigest() if i%2==0 else 32*'0'
+        f.write(digest+'  '+os.path.basename(name)+'\n')
+    localFolder = tempfile.mkdtemp()
+    try:
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        db = lapdMouseDBUtil(server.url)
+        db.segmentedDownloadThreshold = 500000
+        db.segmentSize = 300000
+        for i, name in enumerate(names):
+          localName = os.path.join(localFolder,name)
+          os.makedirs(os.path.dirname(localName), exist_ok=True)
+          with open(localName+'.part', 'wb') as f: # resumed download
+            f.write(files[name][:1000])
+          self.assertEqual(db.downloadFile(name, localName, len(files[name])), i%2==0)
+          self.assertEqual(os.path.exists(localName), i%2==0)
+          self.assertEqual(os.path.exists(localName+'.corrupt'), i%2==1)
+          self.assertFalse(os.path.exists(localName+'.part'))
+    finally:
+      shutil.rmtree(remoteFolder)
+      shutil.rmtree(localFolder)
+    self.delayDisplay('Checksum test passed!')
+
+  def test_lapdMouseDBBrowserManifest(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder, files = self._createRemoteFolder([1000, 2000])
+    localFolder = tempfile.mkdtemp()
+    try:
+      manifest = lapdMouseCacheManifest(localFolder)
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        engine = lapdMouseDownloadEngine(server.url, 2, manifest)
+        for name, content in files.items():
+          engine.addJob(name, os.path.join(localFolder,name), len(content), 1500929216969)
+        engine.addJob('m01/missing.bin', os.path.join(localFolder,'m01','missing.bin'), 1, 1500929216969)
+        engine.start()
+        engine.wait(60)
+      manifest.setPartial('m01/m01_Crashed.bin', 10, 1500929216969)
+      with open(manifest.path, 'a') as f:
+        f.write('{"name": "m01/m01_Torn') # simulated crash while writing
+      manifest = lapdMouseCacheManifest(localFolder)
+      self.assertEqual(sorted(manifest.entries.keys()), sorted(list(files.keys())+['m01/m01_Crashed.bin']))
+      item = {'remoteName':'m01/m01_File0.bin', 'localName':os.path.join(localFolder,'m01','m01_File0.bin'), \
+        'isFolder':False, 'size':1000, 'modificationTimestamp':1500929216969}
+      self.assertEqual(getStatus(item, manifest), 'downloaded')
+      self.assertEqual(getStatus(dict(item, size=1001), manifest), 'require update')
+      self.assertEqual(getStatus(dict(item, modificationTimestamp=1600000000000), manifest), 'require update')
+      self.assertEqual(getStatus(dict(item, remoteName='m01/m01_Crashed.bin'), manifest), 'require download')
+      # removed outside the browser
+      item1 = dict(item, remoteName='m01/m01_File1.bin', localName=os.path.join(localFolder,'m01','m01_File1.bin'), \
+        size=2000)
+      self.assertEqual(getStatus(item1, manifest, scanFolder(os.path.join(localFolder,'m01'))), 'downloaded')
+      os.remove(item1['localName'])
+      self.assertEqual(getStatus(item1, manifest, scanFolder(os.path.join(localFolder,'m01'))), 'require download')
+      self.assertEqual(manifest.get('m01/m01_File1.bin'), None)
+      manifest.setComplete('m01/m01_File1.bin', 2000, 1500929216969)
+      self.assertEqual(getStatus(item1, manifest), 'require download')
+      self.assertEqual(lapdMouseCacheManifest(localFolder).get('m01/m01_File1.bin'), None)
+      with open(item1['localName'], 'wb') as f:
+        f.write(files['m01/m01_File1.bin'])
+      manifest.setComplete('m01/m01_File1.bin', 2000, 1500929216969)
+      manifest.remove('m01/m01_File0.bin')
+      manifest.compact()
+      manifest = lapdMouseCacheManifest(localFolder)
+      self.assertEqual(manifest.get('m01/m01_File0.bin'), None)
+      self.assertEqual(manifest.get('m01/m01_File1.bin')['state'], 'complete')
+      with open(manifest.path) as f:
+        self.assertEqual(len(f.readlines()), 2)
+    finally:
+      shutil.rmtree(remoteFolder)
+      shutil.rmtree(localFolder)
+    self.delayDisplay('Manifest test passed!')
+
+  def test_lapdMouseDBBrowserFailedUpdate(self):
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    # a newer version that fails to download or is corrupt must not make
+    # the outdated copy on disk look up to date
+    import tempfile, shutil
+    remoteFolder, files = self._createRemoteFolder([300000, 300000])
+    names = sorted(files.keys())
+    with open(os.path.join(remoteFolder,'m01','MD5SUMS'), 'w') as f:
+      f.write(32*'0'+'  '+os.path.basename(names[0])+'\n')
+      f.write(hashlib.md5(files[names[1]]).hexdigest()+'  '+os.path.basename(names[1])+'\n')
+    localFolder = tempfile.mkdtemp()
+    try:
+      manifest = lapdMouseCacheManifest(localFolder)
+      for name in names:
+        os.makedirs(os.path.join(localFolder,'m01'), exist_ok=True)
+        with open(os.path.join(localFolder,name), 'wb') as f:
+          f.write(b'outdated')
+        manifest.setComplete(name, 8, 1500929216969)
+      jobs = []
+      for name, failureRate in [(names[0], 0), (names[1], 1.0)]:
+        with lapdMouseDBBrowserTestServer(remoteFolder, failureRate=failureRate) as server:
+          engine = lapdMouseDownloadEngine(server.url, 1, manifest)
+          engine.db.maxRetries = 1
+          jobs.append(engine.addJob(name, os.path.join(localFolder,name), len(files[name]), 1600000000000))
+          engine.start()
+          engine.wait(60)
+      self.assertEqual([job['status'] for job in jobs], ['corrupt', 'failed'])
+      for name in names:
+        with open(os.path.join(localFolder,name), 'rb') as f:
+          self.assertEqual(f.read(), b'outdated')
+        item = {'remoteName':name, 'localName':os.path.join(localFolder,name), 'isFolder':False, \
+          'size':len(files[name]), 'modificationTimestamp':1600000000000}
+        self.assertEqual(getStatus(item, manifest), 'require update')
+        self.assertEqual(getStatus(item, lapdMouseCacheManifest(localFolder)), 'require update')
+      # same for downloadItem
+      for name, failureRate, error in [(names[0], 0, 'ERROR: checksum mismatch'), \
+        (names[1], 1.0, 'ERROR: download failed')]:
+        with lapdMouseDBBrowserTestServer(remoteFolder, failureRate=failureRate) as server:
+          db = lapdMouseDBUtil(server.url)
+          db.connectionPool = lapdMouseConnectionPool()
+          db.maxRetries = 1
+          item = {'remoteName':name, 'localName':os.path.join(localFolder,name), 'isFolder':False, \
+            'size':len(files[name]), 'modificationTimestamp':1600000000000, 'status':'require update'}
+          self.assertTrue(downloadItem(item, db, manifest).startswith(error))
+          db.connectionPool.clear()
+        with open(os.path.join(localFolder,name), 'rb') as f:
+          self.assertEqual(f.read(), b'outdated')
+        self.assertEqual(getStatus(item, manifest), 'require update')
+    finally:
+      shutil.rmtree(remoteFolder)
+      shutil.rmtree(localFolder)
+    self.delayDisplay('Failed update test passed!')
+
+  def test_lapdMouseDBBrowserPauseResume(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder, files = self._createRemoteFolder([100000, 200000, 300000])
+    names = sorted(files.keys())
+    localFolder = tempfile.mkdtemp()
+    try:
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        engine = lapdMouseDownloadEngine(server.url, numberOfWorkers=1)
+        jobs = [engine.addJob(name, os.path.join(localFolder,name), len(files[name])) for name in names]
+        engine.pauseJob(jobs[1])
+        engine.pauseJob(jobs[2])
+        localName = jobs[2]['localName']
+        os.makedirs(os.path.dirname(localName), exist_ok=True)
+        with open(localName+'.part', 'wb') as f:
+          f.write(files[names[2]][:1000])
+        engine.start()
+        self.assertTrue(engine.wait(60))
+        self.assertEqual([j['status'] for j in jobs], ['done','paused','paused'])
+        engine.cancelJob(jobs[2])
+        self.assertEqual(jobs[2]['status'], 'canceled')
+        self.assertFalse(os.path.exists(localName+'.part'))
+        engine.resumeJob(jobs[1]) # workers are started again on demand
+        self.assertTrue(engine.wait(60))
+        self.assertEqual([j['status'] for j in jobs], ['done','done','canceled'])
+        engine.addJob(names[2], localName, len(files[names[2]]))
+        self.assertTrue(engine.wait(60))
+        with open(localName, 'rb') as f:
+          self.assertEqual(f.read(), files[names[2]])
+      filesFinished, filesTotal, bytesDownloaded, bytesTotal = engine.progress()
+      self.assertEqual(filesFinished, 4)
+      self.assertEqual(bytesDownloaded, sum(len(c) for c in files.values()))
+      self.assertTrue(engine.jobThroughput(jobs[0])>0)
+    finally:
+      shutil.rmtree(remoteFolder)
+      shutil.rmtree(localFolder)
+    self.delayDisplay('Pause and resume test passed!')
+
+  def test_lapdMouseDBBrowserScheduler(self):
+    import tempfile, shutil
+    from lapdMouseDBBrowserLib.TestServer import lapdMouseDBBrowserTestServer
+    remoteFolder, files = self._createRemoteFolder([400000, 300000, 200000, 100000])
+    names = sorted(files.keys())
+    localFolder = tempfile.mkdtemp()
+    try:
+      with lapdMouseDBBrowserTestServer(remoteFolder) as server:
+        engine = lapdMouseDownloadEngine(server.url, numberOfWorkers=1)
+        jobs = [engine.addJob(name, os.path.join(localFolder,name), len(files[name]), priority=i%2) \
+          for i, name in enumerate(names)]
+        # bulk jobs are never allowed during a one hour window that ended already
+        hour = time.localtime().tm_hour
+        jobs.append(engine.addJob(names[0], os.path.join(localFolder,'bulk.bin'), 1, priority=2))
+        engine.setAllowedHours(2, ((hour+1)%24, (hour+2)%24))
+        engine.bandwidth = lapdMouseTokenBucket(2*1000*1000, burst=100000)
+        t0 = time.time()
+        engine.start()
+        while any(j['status']!='done' for j in jobs[:4]):
+          time.sleep(0.05)
+        elapsed = time.time()-t0
+        self.assertEqual(jobs[4]['status'], 'queued')
+        self.assertTrue(engine.isRunning())
+        engine.cancelJob(jobs[4])
+        self.assertTrue(engine.wait(60))
+      # priority 0 first, then by size
+      order = sorted(jobs[:4], key=lambda j: j['startTime'])
+      self.assertEqual([j['remoteName'] for j in order], [names[2], names[0], names[3], names[1]])
+      # 1 MB in total at 2 MB/s with a burst of 0.1 MB
+      self.assertTrue(elapsed>=0.45)
+    finally:
+      shutil.rmtree(remoteFolder)
+      shutil.rmtree(localFolder)
+    self.delayDisplay('Scheduler test passed!')
+
+startupTimes.append(('module import', 'module definitions', time.perf_counter()))
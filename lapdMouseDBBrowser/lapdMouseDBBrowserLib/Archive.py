@@ -0,0 +1,968 @@
+# Access to the lapdMouse archive: HTTP connection pool and downloads of
+# whole files, byte ranges and tar archives. No Slicer dependencies, so that
+# it can be used from plain Python (see Sync.py).
+
+import os, sys, json, time, ssl, shutil, hashlib, tarfile, threading, collections, email.utils
+import urllib.request, urllib.error, urllib.parse, http.client
+
+from .Catalog import lapdMouseCatalog, mergeCatalogEntries
+
+defaultRemoteFolderUrl = 'https://cebs-ext.niehs.nih.gov/cahs/file/download/lapd/'
+
+# files next to a download that hold unfinished or rejected data
+partialFileSuffixes = ('.part', '.part.segments', '.part.offset', '.part.unpack', '.part.compress', \
+  '.corrupt', '.link')
+
+def unpackedFolderName(localName):
+  # folder the members of archive localName are written to when it is
+  # downloaded with lapdMouseDBUtil.downloadAndUnpack
+  return os.path.splitext(localName)[0]
+
+class lapdMouseConnectionPool():
+  # Thread-safe pool of keep-alive HTTP(S) connections, idle connections are
+  # kept per (scheme, host, port) and reused by later requests. All HTTPS
+  # connections share one SSL context.
+
+  def __init__(self, maxIdleConnectionsPerHost=8):
+    self.maxIdleConnectionsPerHost = maxIdleConnectionsPerHost
+    self.sslContext = None
+    self.maxRedirects = 5
+    self._idle = {}
+    self._lock = threading.Lock()
+
+  def getSSLContext(self):
+    with self._lock:
+      if self.sslContext is None:
+        self.sslContext = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        self.sslContext.options |= 0x4  # OP_LEGACY_SERVER_CONNECT
+      return self.sslContext
+
+  def request(self, url, headers=None, timeout=60):
+    # GET url and return a lapdMousePooledResponse; raises
+    # urllib.error.HTTPError for error codes and urllib.error.URLError if the
+    # server cannot be reached, same as urllib.request.urlopen
+    for redirect in range(self.maxRedirects+1):
+      parsedUrl = urllib.parse.urlsplit(url)
+      key = (parsedUrl.scheme, parsedUrl.hostname, parsedUrl.port)
+      path = parsedUrl.path or '/'
+      if parsedUrl.query:
+        path += '?'+parsedUrl.query
+      connection, reused = self._acquire(key, timeout)
+      try:
+        connection.request('GET', path, headers=headers or {})
+        response = connection.getresponse()
+      except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError) as e:
+        connection.close()
+        if not reused: # only a stale keep-alive connection is worth a retry
+          raise urllib.error.URLError(e)
+        connection, reused = self._acquire(key, timeout, reuse=False)
+        try:
+          connection.request('GET', path, headers=headers or {})
+          response = connection.getresponse()
+        except (OSError, http.client.HTTPException) as e:
+          connection.close()
+          raise urllib.error.URLError(e)
+      except (OSError, http.client.HTTPException) as e: # e.g. BadStatusLine, LineTooLong
+        connection.close()
+        raise urllib.error.URLError(e)
+      pooledResponse = lapdMousePooledResponse(self, key, connection, response, url)
+      if response.status in [301, 302, 303, 307, 308] and response.getheader('Location'):
+        pooledResponse.read()
+        pooledResponse.close()
+        url = urllib.parse.urljoin(url, response.getheader('Location'))
+        continue
+      if response.status>=400:
+        pooledResponse.read()
+        pooledResponse.close()
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+      return pooledResponse
+    raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers, None)
+
+  def clear(self):
+    with self._lock:
+      for connections in self._idle.values():
+        for connection in connections:
+          connection.close()
+      self._idle = {}
+
+  def _acquire(self, key, timeout, reuse=True):
+    with self._lock:
+      connections = self._idle.get(key, [])
+      if reuse and len(connections):
+        connection = connections.pop()
+        connection.timeout = timeout
+        if connection.sock is not None:
+          connection.sock.settimeout(timeout)
+        return connection, True
+    scheme, host, port = key
+    if scheme=='https':
+      connection = http.client.HTTPSConnection(host, port, timeout=timeout, context=self.getSSLContext())
+    else:
+      connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    return connection, False
+
+  def _release(self, key, connection):
+    with self._lock:
+      connections = self._idle.setdefault(key, [])
+      if len(connections)<self.maxIdleConnectionsPerHost:
+        connections.append(connection)
+        return
+    connection.close()
+
+class lapdMousePooledResponse():
+  # Wraps a http.client.HTTPResponse; closing it hands the connection back
+  # to the pool if the body was read completely, otherwise the connection
+  # is closed.
+
+  def __init__(self, pool, key, connection, response, url):
+    self.pool = pool
+    self.key = key
+    self.connection = connection
+    self.response = response
+    self.url = url
+    self.headers = response.headers
+
+  def getcode(self):
+    return self.response.status
+
+  def read(self, amt=None):
+    return self.response.read(amt)
+
+  def readinto(self, buffer):
+    return self.response.readinto(buffer)
+
+  def close(self):
+    if self.connection is None:
+      return
+    if self.response.isclosed():
+      self.pool._release(self.key, self.connection)
+    else:
+      self.response.close()
+      self.connection.close()
+    self.connection = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+class lapdMouseDBUtil():
+
+  # shared by all instances, so that connections are reused across files
+  connectionPool = lapdMouseConnectionPool()
+  # parsed MD5SUMS files by remote folder url
+  md5sums = {}
+  md5sumsLock = threading.Lock()
+
+  def __init__(self, remoteFolderUrl):
+    self.gdriveURL = remoteFolderUrl
+    self.maxRetries = 3
+    self.timeout = 60
+    # files of at least segmentedDownloadThreshold bytes are fetched as
+    # byte ranges of segmentSize over numberOfSegmentConnections connections
+    self.segmentedDownloadThreshold = 1024*1024*1024
+    self.segmentSize = 64*1024*1024
+    self.numberOfSegmentConnections = 4
+    # byte ranges of a region less than maximumRangeGap bytes apart are
+    # fetched with a single request (of at most segmentSize bytes)
+    self.maximumRangeGap = 64*1024
+    # streamed files of at least preallocationThreshold bytes get their disk
+    # space reserved up front; the read buffer is resized between
+    # minimumBufferSize and maximumBufferSize depending on throughput
+    self.preallocationThreshold = 16*1024*1024
+    self.minimumBufferSize = 64*1024
+    self.maximumBufferSize = 16*1024*1024
+    self.verifyChecksums = True
+    # lapdMouseSharedCache files are linked from instead of downloaded, and
+    # verified downloads are added to
+    self.sharedCache = None
+    self.modulePath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    self.catalogFile = os.path.join(self.modulePath,'Resources','allfiles.json')
+    # up-to-date catalog in the archive, in the format of allfiles.json
+    self.remoteCatalogName = 'allfiles.json'
+
+  def _openUrl(self, src, headers=None):
+    return self.connectionPool.request(self.gdriveURL + src, headers, self.timeout)
+
+  def _canAccess(self):
+    try:
+      with self._openUrl('m01/MD5SUMS') as response:
+        response.read()
+        httpCode = response.getcode()
+      if (httpCode == 200):
+        return True
+      else:
+        print(f"Unexpected HTTP error ({httpCode}.")
+        return False
+    except urllib.error.HTTPError as e:
+      print('The server couldn\'t fulfill the request.')
+      print('Error code: ', e.code)
+      return False
+    except urllib.error.URLError as e:
+      print('We failed to reach a server.')
+      print('Reason: ', e.reason)
+      return False
+    except:
+      print("Unexpected error:", sys.exc_info()[0])
+      return False
+
+  def listDirectory(self, dirname='',depth=0):
+    return self._listFolderRemote(dirname, depth)
+
+  def refreshCatalog(self, cachedCatalogFile):
+    # updates cachedCatalogFile (starting from catalogFile) with the changes
+    # of the archive's catalog and makes it the catalogFile. The request is
+    # conditional on the ETag/Last-Modified of the previous refresh, stored
+    # in cachedCatalogFile+'.validators'. Returns the names of the added,
+    # changed and removed entries (see mergeCatalogEntries), or None if the
+    # archive's catalog could not be read; an earlier refreshed catalog is
+    # used then, otherwise catalogFile is left as it is
+    validatorsFile = cachedCatalogFile+'.validators'
+    headers = {}
+    if os.path.exists(cachedCatalogFile):
+      self.catalogFile = cachedCatalogFile
+      try:
+        with open(validatorsFile) as f:
+          validators = json.load(f)
+      except (OSError, ValueError):
+        validators = {}
+      if validators.get('ETag'):
+        headers['If-None-Match'] = validators['ETag']
+      if validators.get('Last-Modified'):
+        headers['If-Modified-Since'] = validators['Last-Modified']
+    try:
+      with self._openUrl(self.remoteCatalogName, headers) as response:
+        content = response.read()
+        if response.getcode()==304:
+          return []
+        validators = {key:response.headers.get(key) for key in ['ETag', 'Last-Modified'] \
+          if response.headers.get(key)}
+      remoteEntries = json.loads(content.decode('utf-8'))
+      if not isinstance(remoteEntries, list) or not all('name' in e for e in remoteEntries):
+        raise ValueError('unexpected content')
+    except (OSError, http.client.HTTPException, ValueError) as e:
+      print('Could not refresh the catalog, using '+self.catalogFile+': ', e, flush=True)
+      return None
+    try:
+      timestamp = int(1000*email.utils.parsedate_to_datetime(validators['Last-Modified']).timestamp())
+    except (KeyError, TypeError, ValueError):
+      timestamp = int(1000*time.time())
+    catalog = lapdMouseCatalog.get(self.catalogFile)
+    entries, changedNames = mergeCatalogEntries(catalog.entries if catalog else [], remoteEntries, timestamp)
+    folder = os.path.dirname(os.path.abspath(cachedCatalogFile))
+    if not os.path.exists(folder):
+      os.makedirs(folder, exist_ok=True)
+    for fileName, content in [(cachedCatalogFile, entries), (validatorsFile, validators)]:
+      with open(fileName+'.tmp', 'w') as f:
+        json.dump(content, f)
+      os.replace(fileName+'.tmp', fileName)
+    self.catalogFile = cachedCatalogFile
+    if len(changedNames):
+      with self.md5sumsLock:
+        self.md5sums.clear() # checksums of changed files
+    return changedNames
+
+  def getExpectedMD5(self, src):
+    # md5 digest of src as listed in the MD5SUMS file of its remote folder,
+    # None if the folder has no MD5SUMS or it does not list src
+    folder, name = os.path.split(src)
+    if name=='MD5SUMS':
+      return None
+    with self.md5sumsLock:
+      if self.gdriveURL+folder not in self.md5sums:
+        self.md5sums[self.gdriveURL+folder] = self._readMD5SUMS(folder)
+      return self.md5sums[self.gdriveURL+folder].get(name)
+
+  def _readMD5SUMS(self, folder):
+    # lines in md5sum format: "<digest>  <name>" or "<digest> *<name>"
+    checksums = {}
+    try:
+      with self._openUrl(folder+'/MD5SUMS') as response:
+        content = response.read().decode('utf-8', 'replace')
+    except (OSError, http.client.HTTPException):
+      return checksums
+    for line in content.splitlines():
+      tokens = line.strip().split(None, 1)
+      if len(tokens)==2 and len(tokens[0])==32:
+        checksums[os.path.basename(tokens[1].lstrip('*'))] = tokens[0].lower()
+    return checksums
+
+  def _md5OfFile(self, filename, digest=None):
+    digest = digest or hashlib.md5()
+    with open(filename, 'rb') as f:
+      while True:
+        buffer = f.read(1024*1024)
+        if not buffer:
+          break
+        digest.update(buffer)
+    return digest
+
+  def _acceptDownload(self, src, partName, destination, digest):
+    # moves a complete .part file into place if its digest matches MD5SUMS,
+    # a mismatching file is kept as destination+'.corrupt'
+    expectedMD5 = self.getExpectedMD5(src) if self.verifyChecksums else None
+    if expectedMD5 is not None:
+      if digest is None:
+        digest = self._md5OfFile(partName)
+      if digest.hexdigest()!=expectedMD5:
+        print('Checksum mismatch for '+src+': expected '+expectedMD5+\
+          ', got '+digest.hexdigest()+'. Kept as '+destination+'.corrupt', flush=True)
+        os.replace(partName, destination+'.corrupt')
+        return False
+    os.replace(partName, destination)
+    return True
+    
+  def downloadFile(self, src, dst, size=None, progressCallback=None):
+    # progressCallback(numberOfBytes, transferred=True) is called for every
+    # chunk written; data found on disk from an earlier attempt is reported
+    # with transferred=False (negative if it had to be discarded). Returning
+    # False from it aborts the transfer and keeps the partial file for resuming
+    if not os.path.exists(os.path.dirname(dst)):
+      os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if self.sharedCache and self._linkFromSharedCache(src, dst, size):
+      if progressCallback:
+        progressCallback(os.path.getsize(dst), False)
+      return True
+    if size is not None and size>=self.segmentedDownloadThreshold and \
+      self.numberOfSegmentConnections>1 and self._supportsRanges(src):
+      succeeded = self._downloadFileSegmented(src, dst, size, progressCallback)
+    else:
+      succeeded = self._downloadFileFromRemote(src, dst, size, progressCallback)
+    if succeeded and self.sharedCache:
+      self._addToSharedCache(src, dst)
+    return succeeded
+
+  def _linkFromSharedCache(self, src, dst, size=None):
+    expectedMD5 = self.getExpectedMD5(src)
+    if expectedMD5 is None or not self.sharedCache.contains(expectedMD5, size):
+      return False
+    return self.sharedCache.link(expectedMD5, dst)
+
+  def _addToSharedCache(self, src, dst):
+    # only verified files are shared
+    expectedMD5 = self.getExpectedMD5(src) if self.verifyChecksums else None
+    if expectedMD5 is None:
+      return
+    try:
+      self.sharedCache.add(expectedMD5, dst)
+    except OSError as e:
+      print('Could not add '+src+' to the shared cache: ', e, flush=True)
+
+  def _supportsRanges(self, src):
+    try:
+      with self._openUrl(src, {'Range':'bytes=0-0'}) as response:
+        response.read()
+        return response.getcode()==206
+    except (OSError, http.client.HTTPException):
+      return False
+
+  def _downloadFileFromRemote(self, src, destination, size=None, progressCallback=None):
+    # data is written to destination+'.part' and only renamed to destination
+    # once complete; an existing .part file is resumed with a Range request
+    partName = destination + '.part'
+    self._removeCorruptCopy(destination)
+    if os.path.exists(partName+'.segments'): # preallocated by a segmented download
+      self._discardPartialFile(partName)
+      os.remove(partName+'.segments')
+    self._recoverPreallocatedFile(partName)
+    if os.path.exists(partName) and progressCallback:
+      progressCallback(os.path.getsize(partName), False)
+    # the digest is updated with every chunk written, data already present
+    # from an earlier attempt is hashed once before appending to it
+    digest = None
+    for attempt in range(self.maxRetries+1):
+      if attempt>0:
+        print('Retrying ('+str(attempt)+'/'+str(self.maxRetries)+') '+src, flush=True)
+        time.sleep(attempt)
+      offset = os.path.getsize(partName) if os.path.exists(partName) else 0
+      if size is not None and offset>size: # not a prefix of this file
+        self._discardPartialFile(partName, progressCallback)
+        offset = 0
+      if size is None or offset<size or not os.path.exists(partName):
+        try:
+          response = self._openUrl(src, {'Range':'bytes='+str(offset)+'-'} if offset>0 else None)
+        except urllib.error.HTTPError as e:
+          if e.code==416 and offset>0: # range not satisfiable, start over
+            self._discardPartialFile(partName, progressCallback)
+            continue
+          if e.code>=500 or e.code==429: # e.g. a gateway timeout, keep the .part file
+            print('Server error: ', e.code, flush=True)
+            continue
+          print('The server couldn\'t fulfill the request.')
+          print('Error code: ', e.code, flush=True)
+          return False
+        except urllib.error.URLError as e:
+          print('We failed to reach a server.')
+          print('Reason: ', e.reason, flush=True)
+          continue
+        except OSError as e:
+          print('Connection error: ', e, flush=True)
+          continue
+        if response.getcode()==200 and offset>0: # server ignored the range
+          self._discardPartialFile(partName, progressCallback)
+        if response.getcode()==206:
+          digest = digest if digest is not None else self._md5OfFile(partName)
+        else:
+          digest = hashlib.md5()
+        try:
+          if not self._downloadURLStreaming(response, partName, progressCallback, digest, size):
+            return False
+        except (OSError, http.client.HTTPException) as e:
+          print('Transfer interrupted: ', e, flush=True)
+          digest = None # unknown how much of the last chunk made it to disk
+          continue
+        finally:
+          response.close()
+      localSize = os.path.getsize(partName) if os.path.exists(partName) else 0
+      if size is None or localSize==size:
+        return self._acceptDownload(src, partName, destination, digest)
+    print('Giving up on '+src+' after '+str(self.maxRetries+1)+' attempts', flush=True)
+    return False
+
+  def _downloadFileSegmented(self, src, destination, size, progressCallback=None):
+    # fetches the byte ranges of a preallocated destination+'.part' file in
+    # parallel; completed segment indices are kept in
+    # destination+'.part.segments' so that an interrupted download resumes
+    # with the missing segments only
+    partName = destination + '.part'
+    segmentsName = partName + '.segments'
+    self._removeCorruptCopy(destination)
+    numberOfSegments = (size+self.segmentSize-1)//self.segmentSize
+    segments = [(i*self.segmentSize, min(size, (i+1)*self.segmentSize)) \
+      for i in range(numberOfSegments)]
+    completed = set()
+    self._recoverPreallocatedFile(partName)
+    if os.path.exists(segmentsName):
+      try:
+        with open(segmentsName) as f:
+          completed = set(json.load(f))
+      except (OSError, ValueError):
+        completed = set()
+    elif os.path.exists(partName) and os.path.getsize(partName)<=size:
+      # continue a streamed download, everything before its end is complete
+      prefix = os.path.getsize(partName)
+      completed = {i for i, s in enumerate(segments) if s[1]<=prefix}
+    if not os.path.exists(partName):
+      completed = set()
+      open(partName, 'wb').close()
+    with open(partName, 'r+b') as f:
+      f.truncate(size)
+      self._preallocate(f, 0, size)
+    if progressCallback and len(completed):
+      progressCallback(sum(segments[i][1]-segments[i][0] for i in completed), False)
+
+    lock = threading.Lock()
+    aborted = threading.Event()
+    pending = collections.deque(i for i in range(numberOfSegments) if i not in completed)
+    failed = []
+
+    def saveCompleted():
+      with open(segmentsName+'.tmp', 'w') as f:
+        json.dump(sorted(completed), f)
+      os.replace(segmentsName+'.tmp', segmentsName)
+
+    def fetchSegment(partFile, start, end):
+      # returns number of bytes written; stops early on errors
+      response = self._openUrl(src, {'Range':'bytes='+str(start)+'-'+str(end-1)})
+      written = 0
+      try:
+        if response.getcode()!=206:
+          raise http.client.HTTPException('expected partial content, got '+str(response.getcode()))
+        partFile.seek(start)
+        while written<end-start and not aborted.is_set():
+          buffer = response.read(min(1024*1024, end-start-written))
+          if not buffer:
+            break
+          partFile.write(buffer)
+          written += len(buffer)
+          if progressCallback and progressCallback(len(buffer))==False:
+            aborted.set()
+      finally:
+        response.close()
+      return written
+
+    def worker():
+      with open(partName, 'r+b') as partFile:
+        while not aborted.is_set():
+          with lock:
+            if len(pending)==0:
+              return
+            index = pending.popleft()
+          start, end = segments[index]
+          position = start
+          for attempt in range(self.maxRetries+1):
+            if attempt>0:
+              time.sleep(attempt)
+            try:
+              position += fetchSegment(partFile, position, end)
+            except (OSError, http.client.HTTPException) as e:
+              print('Segment '+str(index)+' of '+src+' interrupted: ', e, flush=True)
+            if position>=end or aborted.is_set():
+              break
+          if aborted.is_set():
+            return
+          if position<end:
+            with lock:
+              failed.append(index)
+            aborted.set()
+            return
+          partFile.flush()
+          with lock:
+            completed.add(index)
+            saveCompleted()
+
+    threads = [threading.Thread(target=worker) for i in range(min(self.numberOfSegmentConnections, len(pending)))]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    if len(failed):
+      print('Giving up on '+src+' after '+str(self.maxRetries+1)+' attempts for segment(s) '+str(failed), flush=True)
+      return False
+    if len(completed)<numberOfSegments:
+      return False
+    if os.path.exists(segmentsName):
+      os.remove(segmentsName)
+    # segments arrive out of order, so the checksum needs a pass over the file
+    return self._acceptDownload(src, partName, destination, None)
+
+  def _removeCorruptCopy(self, destination):
+    # left from an earlier attempt, a file or an unpacked archive
+    corruptName = destination+'.corrupt'
+    if os.path.isdir(corruptName):
+      shutil.rmtree(corruptName)
+    elif os.path.exists(corruptName):
+      os.remove(corruptName)
+
+  def _discardPartialFile(self, partName, progressCallback=None):
+    if os.path.exists(partName):
+      if progressCallback:
+        progressCallback(-os.path.getsize(partName), False)
+      os.remove(partName)
+    if os.path.exists(partName+'.offset'):
+      os.remove(partName+'.offset')
+
+  def _preallocate(self, f, offset, size):
+    # reserves disk space for bytes offset..size of f in as few extents as
+    # possible; returns False where this is not supported
+    if not hasattr(os, 'posix_fallocate'):
+      return False
+    try:
+      os.posix_fallocate(f.fileno(), offset, size-offset)
+    except OSError:
+      return False
+    return True
+
+  def _recoverPreallocatedFile(self, partName):
+    # a preallocated file left behind by an interrupted process is cut back
+    # to the data known to be written, as recorded in partName+'.offset'
+    offsetName = partName+'.offset'
+    if not os.path.exists(offsetName):
+      return
+    try:
+      with open(offsetName) as f:
+        offset = int(f.read())
+    except (OSError, ValueError):
+      offset = 0
+    if os.path.exists(partName):
+      with open(partName, 'r+b') as f:
+        f.truncate(min(offset, os.path.getsize(partName)))
+    os.remove(offsetName)
+
+  def _downloadURLStreaming(self,response,destination,progressCallback=None,digest=None,size=None):
+    # appends to destination for partial content (206), overwrites otherwise;
+    # every chunk written is also added to digest (a hashlib object) if given;
+    # returns False if the transfer was aborted by progressCallback.
+    # If the final size of destination is known, the rest of the file is
+    # preallocated; while it is, the number of bytes actually written is
+    # kept in destination+'.offset' in case the process does not finish
+    if response.getcode() not in [200, 206]:
+      return False
+    if response.getcode()==206 and os.path.exists(destination):
+      destinationFile = open(destination, 'r+b')
+      destinationFile.seek(0, os.SEEK_END)
+    else:
+      destinationFile = open(destination, 'wb')
+    position = destinationFile.tell()
+    offsetName = destination+'.offset'
+    preallocated = False
+    if size is not None and size-position>=max(1, self.preallocationThreshold):
+      with open(offsetName, 'w') as f:
+        f.write(str(position))
+      preallocated = self._preallocate(destinationFile, position, size)
+      if not preallocated:
+        os.remove(offsetName)
+    nextOffsetUpdate = position+64*1024*1024
+    # data is read into one reused buffer; it grows while chunks arrive
+    # faster than 10 ms and shrinks when they take longer than 250 ms
+    bufferSize = min(max(1024*1024, self.minimumBufferSize), self.maximumBufferSize)
+    buffer = memoryview(bytearray(bufferSize))
+    try:
+      while True:
+        t0 = time.perf_counter()
+        numberOfBytes = response.readinto(buffer)
+        if not numberOfBytes:
+          break
+        elapsed = time.perf_counter()-t0
+        chunk = buffer[:numberOfBytes]
+        destinationFile.write(chunk)
+        position += numberOfBytes
+        if digest is not None:
+          digest.update(chunk)
+        if preallocated and position>=nextOffsetUpdate:
+          destinationFile.flush()
+          with open(offsetName, 'w') as f:
+            f.write(str(position))
+          nextOffsetUpdate = position+64*1024*1024
+        if progressCallback and progressCallback(numberOfBytes)==False:
+          return False
+        if numberOfBytes==bufferSize:
+          if elapsed<0.01 and bufferSize<self.maximumBufferSize:
+            bufferSize = min(2*bufferSize, self.maximumBufferSize)
+            buffer = memoryview(bytearray(bufferSize))
+          elif elapsed>0.25 and bufferSize>self.minimumBufferSize:
+            bufferSize = max(bufferSize//2, self.minimumBufferSize)
+            buffer = memoryview(bytearray(bufferSize))
+    finally:
+      if preallocated:
+        destinationFile.truncate(position)
+      destinationFile.close()
+      if preallocated:
+        os.remove(offsetName)
+    return True
+
+  def downloadAndUnpack(self, src, dst, size=None, progressCallback=None):
+    # streams tar archive src into unpackedFolderName(dst) without storing
+    # the archive itself; members are available as soon as they are received.
+    # The stream position after the last member written is kept in
+    # dst+'.part.unpack', an interrupted transfer continues from there with
+    # a Range request. The archive checksum can only be verified if it was
+    # received in one go; on a mismatch the folder is kept as dst+'.corrupt'.
+    # progressCallback as for downloadFile, returns True on success
+    folder = unpackedFolderName(dst)
+    stateName = dst+'.part.unpack'
+    os.makedirs(folder, exist_ok=True)
+    self._removeCorruptCopy(dst)
+    offset = self._readUnpackOffset(stateName)
+    if offset>0 and progressCallback:
+      progressCallback(offset, False)
+    digest = hashlib.md5() if offset==0 else None
+    for attempt in range(self.maxRetries+1):
+      if attempt>0:
+        print('Retrying ('+str(attempt)+'/'+str(self.maxRetries)+') '+src, flush=True)
+        time.sleep(attempt)
+      try:
+        response = self._openUrl(src, {'Range':'bytes='+str(offset)+'-'} if offset>0 else None)
+      except urllib.error.HTTPError as e:
+        print('The server couldn\'t fulfill the request.')
+        print('Error code: ', e.code, flush=True)
+        return False
+      except urllib.error.URLError as e:
+        print('We failed to reach a server.')
+        print('Reason: ', e.reason, flush=True)
+        continue
+      stream = None
+      try:
+        if response.getcode()==200 and offset>0: # server ignored the range
+          if progressCallback:
+            progressCallback(-offset, False)
+          offset = 0
+          digest = hashlib.md5()
+        stream = lapdMouseStreamReader(response, offset, digest, progressCallback)
+        offset = self._unpackStream(stream, folder, stateName)
+        if stream.aborted:
+          return False
+        stream.readToEnd()
+        offset = stream.position
+      except (OSError, EOFError, tarfile.TarError, http.client.HTTPException) as e:
+        if stream is not None and stream.aborted:
+          return False
+        print('Transfer interrupted: ', e, flush=True)
+        digest = None # the stream continues after the last complete member
+        offset = self._readUnpackOffset(stateName)
+        continue
+      finally:
+        response.close()
+      if size is not None and offset!=size:
+        print('Archive '+src+' ended after '+str(offset)+' of '+str(size)+' bytes', flush=True)
+        return False
+      os.remove(stateName)
+      expectedMD5 = self.getExpectedMD5(src) if self.verifyChecksums else None
+      if expectedMD5 and digest is None:
+        print('Archive '+src+' was received in parts, its checksum cannot be verified', flush=True)
+      elif expectedMD5 and digest.hexdigest()!=expectedMD5:
+        print('Checksum mismatch for '+src+': expected '+expectedMD5+\
+          ', got '+digest.hexdigest()+'. Kept as '+dst+'.corrupt', flush=True)
+        os.replace(folder, dst+'.corrupt')
+        return False
+      return True
+    print('Giving up on '+src+' after '+str(self.maxRetries+1)+' attempts', flush=True)
+    return False
+
+  def _unpackStream(self, stream, folder, stateName):
+    # writes regular files and folders of the tar stream below folder and
+    # returns the stream position after the last one; the position is also
+    # saved to stateName after every member
+    base = stream.position
+    position = base
+    self._writeUnpackOffset(stateName, position)
+    with tarfile.open(fileobj=stream, mode='r|') as archive:
+      for member in archive:
+        name = os.path.normpath(member.name)
+        if os.path.isabs(name) or name.split(os.sep)[0]=='..':
+          print('Skipping archive member outside of '+folder+': '+member.name, flush=True)
+        elif member.isdir():
+          os.makedirs(os.path.join(folder, name), exist_ok=True)
+        elif member.isfile():
+          path = os.path.join(folder, name)
+          os.makedirs(os.path.dirname(path), exist_ok=True)
+          complete = False
+          try:
+            with archive.extractfile(member) as source, open(path+'.part', 'wb') as destination:
+              shutil.copyfileobj(source, destination, 1024*1024)
+            complete = not stream.aborted
+          finally:
+            if complete:
+              os.replace(path+'.part', path)
+            elif os.path.exists(path+'.part'):
+              os.remove(path+'.part')
+        if stream.aborted:
+          break
+        position = base+member.offset_data+ \
+          (member.size+tarfile.BLOCKSIZE-1)//tarfile.BLOCKSIZE*tarfile.BLOCKSIZE
+        self._writeUnpackOffset(stateName, position)
+    return position
+
+  def _readUnpackOffset(self, stateName):
+    try:
+      with open(stateName) as f:
+        return int(f.read())
+    except (OSError, ValueError):
+      return 0
+
+  def _writeUnpackOffset(self, stateName, offset):
+    with open(stateName+'.tmp', 'w') as f:
+      f.write(str(offset))
+    os.replace(stateName+'.tmp', stateName)
+
+  metaImageElementSizes = {'MET_CHAR':1, 'MET_UCHAR':1, 'MET_SHORT':2, 'MET_USHORT':2, \
+    'MET_INT':4, 'MET_UINT':4, 'MET_LONG':4, 'MET_ULONG':4, 'MET_LONG_LONG':8, 'MET_ULONG_LONG':8, \
+    'MET_FLOAT':4, 'MET_DOUBLE':8}
+
+  def readMetaImageHeader(self, src, maximumHeaderSize=64*1024):
+    # fetches the header of remote MetaImage src with Range requests; returns
+    # ([(key, value), ...], header size in bytes) or None on failure
+    content = b''
+    while len(content)<maximumHeaderSize:
+      requestSize = max(4096, len(content))
+      try:
+        with self._openUrl(src, {'Range':'bytes='+str(len(content))+'-'+str(len(content)+requestSize-1)}) as response:
+          if response.getcode()!=206:
+            print('The server does not support Range requests for '+src, flush=True)
+            return None
+          chunk = response.read()
+      except (OSError, http.client.HTTPException) as e:
+        print('Failed to read header of '+src+': ', e, flush=True)
+        return None
+      if not chunk:
+        break
+      content += chunk
+      fields = []
+      position = 0
+      while True:
+        end = content.find(b'\n', position)
+        if end==-1:
+          break
+        key, separator, value = content[position:end].decode('latin-1').partition('=')
+        position = end+1
+        if separator:
+          fields.append((key.strip(), value.strip()))
+          if key.strip()=='ElementDataFile':
+            return fields, position
+    print('No MetaImage header found in '+src, flush=True)
+    return None
+
+  def downloadRegion(self, src, dst, ijkMin, ijkMax, progressCallback=None):
+    # writes the voxels ijkMin<=ijk<ijkMax (clamped to the image) of remote
+    # MetaImage src to dst as a new MetaImage, fetching only the byte ranges
+    # of that box. src has to hold uncompressed data in the same file
+    # (ElementDataFile = LOCAL). progressCallback(numberOfBytes) as for
+    # downloadFile; returns True on success
+    header = self.readMetaImageHeader(src)
+    if header is None:
+      return False
+    fields, headerSize = header
+    values = dict(fields)
+    if values.get('ElementDataFile')!='LOCAL' or values.get('CompressedData', 'False')!='False' or \
+      values.get('ElementType') not in self.metaImageElementSizes or values.get('NDims')!='3':
+      print('Region download requires an uncompressed 3D MetaImage with local data: '+src, flush=True)
+      return False
+    dimensions = [int(v) for v in values['DimSize'].split()]
+    elementSize = self.metaImageElementSizes[values['ElementType']]*int(values.get('ElementNumberOfChannels', 1))
+    ijkMin = [max(0, min(int(v), d)) for v, d in zip(ijkMin, dimensions)]
+    ijkMax = [max(m, min(int(v), d)) for v, m, d in zip(ijkMax, ijkMin, dimensions)]
+    if any(m>=n for m, n in zip(ijkMin, ijkMax)):
+      print('Empty region requested for '+src, flush=True)
+      return False
+    requests = self._coalesceRanges(self._regionRanges(headerSize, dimensions, elementSize, ijkMin, ijkMax))
+    if not os.path.exists(os.path.dirname(dst)):
+      os.makedirs(os.path.dirname(dst), exist_ok=True)
+    partName = dst+'.part'
+    with open(partName, 'wb') as f:
+      f.write(self._regionHeader(fields, ijkMin, ijkMax).encode('latin-1'))
+      succeeded = self._writeRegion(src, requests, f, progressCallback)
+    if not succeeded:
+      os.remove(partName)
+      return False
+    os.replace(partName, dst)
+    return True
+
+  def downloadSlices(self, src, dst, firstSlice, lastSlice, progressCallback=None):
+    # axial slices firstSlice..lastSlice (inclusive), see downloadRegion
+    return self.downloadRegion(src, dst, (0, 0, firstSlice), (sys.maxsize, sys.maxsize, lastSlice+1), \
+      progressCallback)
+
+  def _writeRegion(self, src, requests, outputFile, progressCallback=None):
+    # fetches the requests of _coalesceRanges one after the other, appending
+    # their pieces to outputFile; returns False if aborted or failed
+    for start, end, pieces in requests:
+      position = outputFile.tell()
+      for attempt in range(self.maxRetries+1):
+        if attempt>0:
+          print('Retrying ('+str(attempt)+'/'+str(self.maxRetries)+') '+src, flush=True)
+          time.sleep(attempt)
+          outputFile.seek(position)
+          outputFile.truncate()
+        try:
+          if not self._fetchRanges(src, start, end, pieces, outputFile, progressCallback):
+            return False
+          break
+        except (OSError, http.client.HTTPException) as e:
+          print('Transfer interrupted: ', e, flush=True)
+      else:
+        print('Giving up on '+src+' after '+str(self.maxRetries+1)+' attempts', flush=True)
+        return False
+    return True
+
+  def _regionRanges(self, headerSize, dimensions, elementSize, ijkMin, ijkMax):
+    # (offset, length) of the image rows inside the region, in file order
+    rowLength = (ijkMax[0]-ijkMin[0])*elementSize
+    for k in range(ijkMin[2], ijkMax[2]):
+      for j in range(ijkMin[1], ijkMax[1]):
+        yield headerSize+((k*dimensions[1]+j)*dimensions[0]+ijkMin[0])*elementSize, rowLength
+
+  def _coalesceRanges(self, ranges):
+    # [(start, end, [(offset, length), ...]), ...] requests covering the
+    # given ranges; adjacent ranges are joined into one piece
+    requests = []
+    for offset, length in ranges:
+      if len(requests) and offset-requests[-1][1]<=self.maximumRangeGap and \
+        offset+length-requests[-1][0]<=self.segmentSize:
+        request = requests[-1]
+        lastOffset, lastLength = request[2][-1]
+        if lastOffset+lastLength==offset:
+          request[2][-1] = (lastOffset, lastLength+length)
+        else:
+          request[2].append((offset, length))
+        request[1] = offset+length
+      else:
+        requests.append([offset, offset+length, [(offset, length)]])
+    return requests
+
+  def _fetchRanges(self, src, start, end, pieces, outputFile, progressCallback=None):
+    # writes the pieces of byte range start..end of src to outputFile,
+    # skipping the gaps between them; returns False if aborted
+    response = self._openUrl(src, {'Range':'bytes='+str(start)+'-'+str(end-1)})
+    try:
+      if response.getcode()!=206:
+        raise http.client.HTTPException('expected partial content, got '+str(response.getcode()))
+      position = start
+      for offset, length in pieces:
+        for copy, numberOfBytes in [(False, offset-position), (True, length)]:
+          while numberOfBytes>0:
+            buffer = response.read(min(numberOfBytes, 1024*1024))
+            if not buffer:
+              raise http.client.IncompleteRead(b'', numberOfBytes)
+            numberOfBytes -= len(buffer)
+            if progressCallback and progressCallback(len(buffer))==False:
+              return False
+            if copy:
+              outputFile.write(buffer)
+        position = offset+length
+    finally:
+      response.close()
+    return True
+
+  def _regionHeader(self, fields, ijkMin, ijkMax):
+    # header of the cropped image: new size, origin moved to ijkMin along
+    # the axes given by TransformMatrix (rows are the axis directions)
+    values = dict(fields)
+    spacing = [float(v) for v in (values.get('ElementSpacing') or values.get('ElementSize') or '1 1 1').split()]
+    matrix = [float(v) for v in (values.get('TransformMatrix') or values.get('Rotation') or \
+      values.get('Orientation') or '1 0 0 0 1 0 0 0 1').split()]
+    origin = [float(v) for v in (values.get('Offset') or values.get('Position') or \
+      values.get('Origin') or '0 0 0').split()]
+    for axis in range(3):
+      for i in range(3):
+        origin[i] += ijkMin[axis]*spacing[axis]*matrix[3*axis+i]
+    lines = []
+    for key, value in fields:
+      if key=='DimSize':
+        value = ' '.join(str(n-m) for m, n in zip(ijkMin, ijkMax))
+      elif key in ['Offset', 'Position', 'Origin']:
+        value = ' '.join(repr(v) for v in origin)
+      elif key in ['HeaderSize', 'CompressedDataSize']:
+        continue
+      lines.append(key+' = '+value+'\n')
+    if not any(key in ['Offset', 'Position', 'Origin'] for key, value in fields):
+      lines.insert(len(lines)-1, 'Offset = '+' '.join(repr(v) for v in origin)+'\n')
+    return ''.join(lines)
+
+  def _listFolderRemote(self,dirname,depth=0):
+    # entries are copies named relative to dirname, e.g. listDirectory('m01', 1)
+    # contains 'm01_RawCryomicrotomeData/m01_RawCryoImages_fl.tar'
+    catalog = lapdMouseCatalog.get(self.catalogFile)
+    return catalog.listDirectory(dirname, depth) if catalog else []
+
+  def _splitPath(self, p):
+    a,b = os.path.split(p)
+    return (self._splitPath(a) if len(a) and len(b) else []) + [b]
+
+class lapdMouseStreamReader():
+  # file object for tarfile's stream mode reading from a response, keeping
+  # track of the position in the remote file. Every chunk is added to digest
+  # and reported to progressCallback; if that returns False the stream ends
+  # early with aborted set.
+
+  def __init__(self, response, position=0, digest=None, progressCallback=None):
+    self.response = response
+    self.position = position
+    self.digest = digest
+    self.progressCallback = progressCallback
+    self.aborted = False
+
+  def read(self, amt=-1):
+    if self.aborted:
+      return b''
+    buffer = self.response.read(amt if amt>=0 else None)
+    self.position += len(buffer)
+    if self.digest is not None:
+      self.digest.update(buffer)
+    if self.progressCallback and len(buffer) and self.progressCallback(len(buffer))==False:
+      self.aborted = True
+    return buffer
+
+  def readToEnd(self):
+    # padding after the end of archive marker
+    while self.read(1024*1024):
+      pass
+
+def testDBAccess(db):
+  serverStatus = 'unknown'
+  if db._canAccess():
+    serverStatus = 'available'
+  else:
+    serverStatus = 'unavailable'
+  print('DB access status: '+serverStatus)
+  return True if serverStatus=='available' else False
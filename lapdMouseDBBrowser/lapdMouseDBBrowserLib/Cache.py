@@ -0,0 +1,516 @@
+# Local cache folder: manifest of downloaded files, file status, size
+# limit, compression of stored volumes and command line style
+# listing/download of catalog items.
+
+import os, sys, json, time, zlib, shutil, threading, collections
+
+from .Archive import unpackedFolderName
+
+def humanReadableSize(size):
+  if size==None:
+    return ""
+  sizeString = "%.1f B"%size
+  if (size>pow(1024.0,1)):
+    sizeString="%.1f KB"%(size/pow(1024.0,1))
+  if (size>pow(1024.0,2)):
+    sizeString="%.1f MB"%(size/pow(1024.0,2))
+  if (size>pow(1024.0,3)):
+    sizeString="%.1f GB"%(size/pow(1024.0,3))
+  if (size>pow(1024.0,4)):
+    sizeString="%.1f TB"%(size/pow(1024.0,4))
+  return sizeString
+
+def humanReadableTime(seconds):
+  return time.strftime("%H:%M:%S", time.gmtime(seconds))
+
+class lapdMouseCacheManifest():
+  # Journal of the files in a local cache folder, stored as JSON lines in
+  # <folder>/.lapdMouseManifest.jsonl. Every change appends one line that is
+  # flushed to disk before returning, a line torn by a crash is skipped when
+  # reading. Entries are keyed by remote name ('m01/m01_Lobes.nrrd') and hold
+  # size, modificationTimestamp (from the catalog), md5 and state
+  # ('partial' or 'complete'), and optionally lastLoaded (time.time() of the
+  # last load in Slicer), pinned (never evicted, see evictFiles) and
+  # storedSize (size on disk after compression, see
+  # lapdMouseCacheCompressor). size and md5 are always those of the file
+  # as downloaded.
+
+  fileName = '.lapdMouseManifest.jsonl'
+
+  def __init__(self, folder):
+    self.folder = folder
+    self.path = os.path.join(folder, self.fileName)
+    self.entries = {}
+    self._numberOfLines = 0
+    self._lock = threading.Lock()
+    self._read()
+
+  def get(self, name):
+    return self.entries.get(name)
+
+  def setPartial(self, name, size, modificationTimestamp):
+    self._append(dict(self._usage(name), name=name, size=size, \
+      modificationTimestamp=modificationTimestamp, md5=None, state='partial'))
+
+  def setComplete(self, name, size, modificationTimestamp, md5=None):
+    self._append(dict(self._usage(name), name=name, size=size, \
+      modificationTimestamp=modificationTimestamp, md5=md5, state='complete'))
+
+  def setLastLoaded(self, name, timestamp=None):
+    if name in self.entries:
+      self._append(dict(self.entries[name], lastLoaded=timestamp or time.time()))
+
+  def setPinned(self, name, pinned=True):
+    if name in self.entries:
+      self._append(dict(self.entries[name], pinned=pinned))
+
+  def setCompressed(self, name, storedSize):
+    if name in self.entries:
+      self._append(dict(self.entries[name], storedSize=storedSize))
+
+  def isPinned(self, name):
+    return name in self.entries and self.entries[name].get('pinned', False)
+
+  def restore(self, entry):
+    # entry as returned by get before the file was changed
+    self._append(dict(entry))
+
+  def remove(self, name):
+    if name in self.entries:
+      self._append({'name':name, 'state':'removed'})
+
+  def compact(self):
+    # rewrite the journal with one line per entry, atomically replacing it
+    with self._lock:
+      temporaryPath = self.path+'.tmp'
+      with open(temporaryPath, 'w') as f:
+        for entry in self.entries.values():
+          f.write(json.dumps(entry)+'\n')
+        f.flush()
+        os.fsync(f.fileno())
+      os.replace(temporaryPath, self.path)
+      self._numberOfLines = len(self.entries)
+
+  def _usage(self, name):
+    # fields kept when a file is downloaded again
+    entry = self.entries.get(name, {})
+    return {k:entry[k] for k in ['lastLoaded', 'pinned'] if k in entry}
+
+  def _read(self):
+    if not os.path.exists(self.path):
+      return
+    with open(self.path) as f:
+      for line in f:
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue # incomplete write
+        self._numberOfLines += 1
+        self._apply(entry)
+    if self._numberOfLines>2*len(self.entries)+100:
+      self.compact()
+
+  def _apply(self, entry):
+    if entry.get('state')=='removed':
+      self.entries.pop(entry['name'], None)
+    else:
+      self.entries[entry['name']] = entry
+
+  def _append(self, entry):
+    with self._lock:
+      if not os.path.exists(self.folder):
+        os.makedirs(self.folder, exist_ok=True)
+      with open(self.path, 'a') as f:
+        f.write(json.dumps(entry)+'\n')
+        f.flush()
+        os.fsync(f.fileno())
+      self._numberOfLines += 1
+      self._apply(entry)
+
+class lapdMouseSharedCache():
+  # Cache folder shared by several users (e.g. on NFS) holding each file
+  # once, named by its MD5 digest: <folder>/ab/abcdef... Files in the users'
+  # cache folders are hardlinks to these or, across file systems, symlinks.
+  # Files are made read-only when added and never change afterwards.
+
+  def __init__(self, folder):
+    self.folder = folder
+
+  def path(self, md5):
+    return os.path.join(self.folder, md5[:2], md5)
+
+  def contains(self, md5, size=None):
+    path = self.path(md5)
+    return os.path.isfile(path) and (size is None or os.path.getsize(path)==size)
+
+  def link(self, md5, localName):
+    # replaces localName by a link to the file with digest md5; returns False
+    # if links are not supported
+    path = self.path(md5)
+    if os.path.exists(localName) and os.path.samefile(path, localName):
+      return True
+    temporaryName = localName+'.link'
+    if os.path.lexists(temporaryName):
+      os.remove(temporaryName)
+    try:
+      os.link(path, temporaryName)
+    except OSError:
+      try:
+        os.symlink(path, temporaryName)
+      except OSError:
+        return False
+    os.replace(temporaryName, localName)
+    return True
+
+  def add(self, md5, localName):
+    # adds verified file localName unless the digest is known already, and
+    # replaces localName by a link to the shared copy
+    path = self.path(md5)
+    if not os.path.isfile(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      temporaryName = path+'.'+str(os.getpid())+'.tmp'
+      try:
+        os.link(localName, temporaryName)
+      except OSError:
+        shutil.copyfile(localName, temporaryName)
+      os.chmod(temporaryName, 0o444)
+      os.replace(temporaryName, path) # concurrent adds have the same content
+    return self.link(md5, localName)
+
+def compressMetaImage(localName, compressionLevel=1, chunkSize=4*1024*1024):
+  # rewrites the uncompressed MetaImage localName with zlib compressed data
+  # in the same file (CompressedData = True), as read by ITK and Slicer.
+  # Modification time is kept. Returns the new size, or None if localName is
+  # no uncompressed MetaImage with local data or changed while compressing.
+  with open(localName, 'rb') as f:
+    content = f.read(64*1024)
+  fields = []
+  headerSize = None
+  position = 0
+  while headerSize is None:
+    end = content.find(b'\n', position)
+    if end==-1:
+      return None
+    key, separator, value = content[position:end].decode('latin-1').partition('=')
+    position = end+1
+    if separator:
+      fields.append((key.strip(), value.strip()))
+      if key.strip()=='ElementDataFile':
+        headerSize = position
+  values = dict(fields)
+  if values['ElementDataFile']!='LOCAL' or values.get('CompressedData', 'False')!='False':
+    return None
+  # CompressedDataSize is written with fixed width and filled in at the end
+  header = ''.join(key+' = '+value+'\n' for key, value in fields[:-1] \
+    if key not in ['CompressedData', 'CompressedDataSize', 'HeaderSize'])
+  header += 'CompressedData = True\nCompressedDataSize = '
+  stat = os.stat(localName)
+  partName = localName+'.part.compress'
+  try:
+    compressor = zlib.compressobj(compressionLevel)
+    compressedSize = 0
+    with open(localName, 'rb') as source, open(partName, 'wb') as destination:
+      destination.write(header.encode('latin-1'))
+      sizePosition = destination.tell()
+      destination.write(('%020d\n' % 0 + 'ElementDataFile = LOCAL\n').encode('latin-1'))
+      source.seek(headerSize)
+      while True:
+        buffer = source.read(chunkSize)
+        data = compressor.compress(buffer) if buffer else compressor.flush()
+        destination.write(data)
+        compressedSize += len(data)
+        if not buffer:
+          break
+      destination.seek(sizePosition)
+      destination.write(('%020d' % compressedSize).encode('latin-1'))
+    current = os.stat(localName)
+    if (current.st_size, current.st_mtime_ns, current.st_ino)!=(stat.st_size, stat.st_mtime_ns, stat.st_ino):
+      os.remove(partName)
+      return None
+    os.utime(partName, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    os.replace(partName, localName)
+  except OSError as e:
+    print('Could not compress '+localName+': ', e, flush=True)
+    if os.path.exists(partName):
+      os.remove(partName)
+    return None
+  return os.path.getsize(localName)
+
+class lapdMouseCacheCompressor():
+  # Compresses complete .mha volumes of a cache manifest one after the other
+  # in a background thread, see compressMetaImage. The manifest keeps size
+  # and md5 of the downloaded file, so the status of compressed files is
+  # unchanged. Files linked from a shared cache are left alone, as are
+  # volumes that are compressed already.
+
+  def __init__(self, manifest, compressionLevel=1):
+    self.manifest = manifest
+    self.compressionLevel = compressionLevel
+    self._queue = collections.deque()
+    self._lock = threading.Lock()
+    self._thread = None
+    self._stopped = False
+
+  def addFile(self, name):
+    with self._lock:
+      if name in self._queue or not name.endswith('.mha'):
+        return
+      self._queue.append(name)
+      self._stopped = False
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+  def addAll(self):
+    for name, entry in list(self.manifest.entries.items()):
+      if entry['state']=='complete' and entry.get('storedSize') is None:
+        self.addFile(name)
+
+  def stop(self):
+    # the file being compressed is finished first
+    with self._lock:
+      self._stopped = True
+      self._queue.clear()
+
+  def wait(self, timeout=None):
+    thread = self._thread
+    if thread is not None:
+      thread.join(timeout)
+    return self._thread is None
+
+  def compressFile(self, name):
+    # returns True if the file was compressed
+    entry = self.manifest.get(name)
+    if entry is None or entry['state']!='complete' or entry.get('storedSize') is not None:
+      return False
+    localName = os.path.join(self.manifest.folder, name.replace('/',os.sep))
+    if not os.path.isfile(localName) or os.path.islink(localName) or \
+      os.stat(localName).st_nlink>1 or os.path.getsize(localName)!=entry['size']:
+      return False
+    storedSize = compressMetaImage(localName, self.compressionLevel)
+    if storedSize is None:
+      return False
+    current = self.manifest.get(name)
+    if current is None or (current['state'], current['size'], current['modificationTimestamp'])!= \
+      (entry['state'], entry['size'], entry['modificationTimestamp']): # downloaded again meanwhile
+      return False
+    self.manifest.setCompressed(name, storedSize)
+    return True
+
+  def _run(self):
+    while True:
+      with self._lock:
+        if self._stopped or len(self._queue)==0:
+          self._thread = None
+          return
+        name = self._queue.popleft()
+      try:
+        self.compressFile(name)
+      except:
+        print('Unexpected error compressing '+name+':', sys.exc_info()[0], flush=True)
+
+def _diskUsage(localName, entry):
+  # bytes a manifest entry takes in the local cache folder; links into a
+  # shared cache take none, unpacked archives are counted with archive size
+  for path in [localName, localName+'.part']:
+    if os.path.islink(path):
+      return 0
+    if os.path.isfile(path):
+      return os.path.getsize(path)
+  if localName.endswith('.tar') and os.path.isdir(unpackedFolderName(localName)):
+    return entry.get('size') or 0
+  return 0
+
+def cacheUsage(manifest):
+  # bytes taken by the files in the manifest's folder
+  return sum(_diskUsage(os.path.join(manifest.folder, name.replace('/',os.sep)), entry) \
+    for name, entry in list(manifest.entries.items()))
+
+def evictFiles(manifest, sizeLimit, keep=()):
+  # removes least recently loaded complete files (never loaded ones by
+  # download time) until cacheUsage is at most sizeLimit bytes. Pinned files
+  # and files whose remote names are in keep are not removed. Returns the
+  # remote names of the removed files.
+  usage = cacheUsage(manifest)
+  if usage<=sizeLimit:
+    return []
+  candidates = []
+  for name, entry in list(manifest.entries.items()):
+    if entry['state']!='complete' or entry.get('pinned') or name in keep:
+      continue
+    localName = os.path.join(manifest.folder, name.replace('/',os.sep))
+    lastUsed = entry.get('lastLoaded')
+    if lastUsed is None:
+      path = localName if os.path.lexists(localName) else unpackedFolderName(localName)
+      lastUsed = os.lstat(path).st_mtime if os.path.lexists(path) else 0
+    candidates.append((lastUsed, name, localName))
+  candidates.sort()
+  removed = []
+  for lastUsed, name, localName in candidates:
+    if usage<=sizeLimit:
+      break
+    usage -= _diskUsage(localName, manifest.entries[name])
+    if os.path.lexists(localName):
+      os.remove(localName)
+    if localName.endswith('.tar') and os.path.isdir(unpackedFolderName(localName)):
+      shutil.rmtree(unpackedFolderName(localName))
+    manifest.remove(name)
+    removed.append(name)
+  return removed
+
+def scanFolder(folder):
+  # {name: (size, modification time, isFolder)} of the entries of folder,
+  # read in one pass with symbolic links followed; {} if folder does not
+  # exist. Used by getStatus instead of separate calls per file, which are
+  # slow on network file systems
+  entries = {}
+  try:
+    with os.scandir(folder) as iterator:
+      for entry in iterator:
+        try:
+          stat = entry.stat()
+        except OSError:
+          continue # broken link
+        entries[entry.name] = (stat.st_size, stat.st_mtime, entry.is_dir())
+  except OSError:
+    pass
+  return entries
+
+def getStatus(item, manifest=None, folderEntries=None):
+  # with a manifest, size and time of the files it knows about are those
+  # recorded when the download completed; only their existence is checked,
+  # entries of files removed outside the browser are dropped.
+  # folderEntries (see scanFolder) of the folder containing the item are
+  # used instead of the file system if given
+  remoteSize = item['size']
+  remoteModificationTime = item['modificationTimestamp']/1000
+  entry = manifest.get(item['remoteName']) if manifest and not item['isFolder'] else None
+  if entry is not None and entry['state']=='complete' and not _exists(item['localName'], folderEntries):
+    manifest.remove(item['remoteName'])
+    return 'require download'
+  if entry is not None:
+    if entry['state']!='complete':
+      return 'require download'
+    if entry['size']!=remoteSize or \
+      (entry['modificationTimestamp'] or 0)<item['modificationTimestamp']:
+      return 'require update'
+    return 'downloaded'
+  if folderEntries is not None:
+    return _statusFromFolderEntries(item, folderEntries)
+  realPath = os.path.realpath(os.path.expanduser(item['localName']))
+  status = 'require download'
+  if not item['isFolder'] and not os.path.exists(realPath) and \
+    os.path.isdir(unpackedFolderName(realPath)) and not os.path.exists(realPath+'.part.unpack'):
+    return 'downloaded' # archive was unpacked while downloading
+  if os.path.exists(realPath):
+    localModificationTime = os.path.getmtime(realPath)
+    status = 'downloaded'
+    if not item['isFolder']:
+      localSize = os.path.getsize(realPath)
+      if remoteSize!=localSize or \
+        remoteModificationTime>localModificationTime:
+        status = 'require update'
+  return status
+
+def _exists(localName, folderEntries=None):
+  # localName or the folder it was unpacked into (see downloadAndUnpack)
+  # exists; files missing in folderEntries are looked up again, the scan
+  # may predate a download that just finished
+  if folderEntries is not None and (os.path.basename(localName) in folderEntries or \
+    os.path.basename(unpackedFolderName(localName)) in folderEntries):
+    return True
+  return os.path.exists(localName) or os.path.isdir(unpackedFolderName(localName))
+
+def _statusFromFolderEntries(item, folderEntries):
+  name = os.path.basename(item['localName'])
+  if not item['isFolder'] and name not in folderEntries and name+'.part.unpack' not in folderEntries and \
+    folderEntries.get(os.path.basename(unpackedFolderName(name)), (0, 0, False))[2]:
+    return 'downloaded' # archive was unpacked while downloading
+  if name not in folderEntries:
+    return 'require download'
+  size, modificationTime, isFolder = folderEntries[name]
+  if not item['isFolder'] and (item['size']!=size or item['modificationTimestamp']/1000>modificationTime):
+    return 'require update'
+  return 'downloaded'
+
+def summarizeItems(items):
+  summaryString = ''
+  remoteFiles = items
+  summaryString += 'Matching files/folders: total='+str(len(remoteFiles))
+  if len(remoteFiles)>0:
+    summaryString+='('+humanReadableSize(sum(i['size'] for i in remoteFiles))+')'
+  filesAlreadyDownloaded = [i for i in remoteFiles if i['status']=='downloaded']
+  summaryString += ', downloaded='+str(len(filesAlreadyDownloaded))
+  if len(filesAlreadyDownloaded)>0:
+    summaryString+='('+humanReadableSize(sum(i['size'] for i in filesAlreadyDownloaded))+')'
+  filesForDownload = [i for i in remoteFiles if i['status']=='require download']
+  summaryString += ', require download='+str(len(filesForDownload))
+  if len(filesForDownload)>0:
+    summaryString+='('+humanReadableSize(sum(i['size'] for i in filesForDownload))+')'
+  filesOutOfDate = [i for i in remoteFiles if i['status']=='require update']
+  summaryString += ', require update='+str(len(filesOutOfDate))
+  if len(filesOutOfDate)>0:
+    summaryString+='('+humanReadableSize(sum(i['size'] for i in filesOutOfDate))+')'
+  print(summaryString)
+
+def listItem(item):
+  remoteName = item['remoteName'] 
+  localName = item['localName']
+  message = remoteName
+  if item['isFolder']:
+    message+=' -> '+localName+' (folder)'
+  else:
+    message+=' -> '+localName+' ('+item['status']+'; '+humanReadableSize(item['size'])+')'
+  print(message)
+
+def downloadItem(item, db, manifest=None, unpack=False):
+  # with unpack, tar archives are unpacked while downloading, see
+  # lapdMouseDBUtil.downloadAndUnpack
+  listItem(item)
+  remoteName = item['remoteName']
+  localName = item['localName']
+  # not resolved, localName may be a link into the shared cache; the
+  # download replaces the link, never the file it points to
+  path = os.path.abspath(os.path.expanduser(localName))
+  isFolder = item['isFolder']
+  if isFolder and not(os.path.exists(path)):
+    os.makedirs(path)
+    return
+  if not isFolder and not(os.path.exists(os.path.dirname(path))):
+    os.makedirs(os.path.dirname(path))
+
+  sys.stdout.write('  Downloading ...')
+  sys.stdout.flush()
+  t0 = time.time()
+  previousEntry = None
+  if manifest:
+    previousEntry = manifest.get(remoteName)
+    manifest.setPartial(remoteName, item['size'], item['modificationTimestamp'])
+  unpack = unpack and remoteName.endswith('.tar')
+  succeeded = False
+  try:
+    if unpack:
+      succeeded = db.downloadAndUnpack(remoteName, path, item['size'])
+    else:
+      succeeded = db.downloadFile(remoteName, path, item['size'])
+  except:
+    print("Unexpected error:", sys.exc_info()[0]) # keep *.part file for resuming
+  t1 = time.time()
+  # an outdated copy of the file may still be at path, only the result of
+  # this download counts (same as lapdMouseDownloadEngine._runJob)
+  downloadSucceeded = bool(succeeded) and not os.path.exists(path+'.corrupt') and \
+    (unpack or os.path.exists(path))
+  if manifest:
+    if downloadSucceeded:
+      manifest.setComplete(remoteName, item['size'], item['modificationTimestamp'], db.getExpectedMD5(remoteName))
+    elif previousEntry is not None and previousEntry['state']=='complete' and os.path.exists(path):
+      manifest.restore(previousEntry) # the outdated copy is still there
+    elif not os.path.exists(path+('.part.unpack' if unpack else '.part')):
+      manifest.remove(remoteName)
+  sys.stdout.write( ( '[DONE]' if downloadSucceeded else '[ERROR]')+' time: '+time.strftime("%M:%S", time.gmtime(t1-t0))+'\n')
+  if not downloadSucceeded and os.path.exists(path+'.corrupt'):
+    return 'ERROR: checksum mismatch for file: '+localName
+  if not downloadSucceeded:
+    return 'ERROR: download failed for file: '+localName
+  else:
+    return None
@@ -0,0 +1,140 @@
+# Catalog of the files in the lapdMouse archive (Resources/allfiles.json),
+# parsed once per process, indexed by folder and queryable across datasets,
+# and merging of catalog updates from the archive.
+
+import os, json, sqlite3, threading
+
+class lapdMouseCatalog():
+  # Entries of a catalog file ({'name':'m01/m01_Lobes.nrrd', 'isFolder',
+  # 'size', 'modificationTimestamp'}) indexed by every folder they are in,
+  # so that listing a folder is a dictionary lookup. Catalogs are shared by
+  # file name, see lapdMouseCatalog.get. Files can be searched across
+  # datasets with query/summarize, backed by an in-memory SQLite table that
+  # is built on first use.
+
+  # name of the refreshed catalog in a local cache folder, see
+  # lapdMouseDBUtil.refreshCatalog
+  cachedFileName = '.lapdMouseCatalog.json'
+  _catalogs = {} # file name -> (modification time, size, catalog)
+  _lock = threading.Lock()
+
+  @classmethod
+  def get(cls, fileName):
+    # catalog of fileName, parsed again only if the file changed; None if
+    # it cannot be read
+    try:
+      stat = os.stat(fileName)
+    except OSError:
+      return None
+    key = os.path.abspath(fileName)
+    with cls._lock:
+      cached = cls._catalogs.get(key)
+      if cached is not None and cached[:2]==(stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+      try:
+        with open(fileName) as f:
+          catalog = cls(json.load(f))
+      except (OSError, ValueError):
+        return None
+      cls._catalogs[key] = (stat.st_mtime_ns, stat.st_size, catalog)
+      return catalog
+
+  def __init__(self, entries):
+    self.entries = entries
+    self._connection = None
+    self._connectionLock = threading.Lock()
+    # folder ('' for the root) -> [(number of '/' in remaining path,
+    # remaining path, entry)]; a folder is listed in its own index under
+    # its base name, as listDirectory always did
+    self._index = {}
+    for entry in entries:
+      parts = entry['name'].split('/')
+      self._index.setdefault('', []).append((len(parts)-1, entry['name'], entry))
+      for i in range(1, len(parts)+1):
+        remainingPath = '/'.join(parts[i:]) or parts[-1]
+        self._index.setdefault('/'.join(parts[:i]), []).append((len(parts)-i-1 if i<len(parts) else 0, \
+          remainingPath, entry))
+
+  def listDirectory(self, dirname='', depth=0):
+    # copies of the entries below dirname at most depth folders deep, named
+    # relative to dirname
+    if dirname=='.':
+      dirname = ''
+    return [dict(entry, name=remainingPath) for numberOfSeparators, remainingPath, entry in \
+      self._index.get(dirname.strip('/'), []) if numberOfSeparators<=depth]
+
+  def query(self, datasets=None, pattern=None, suffix=None, minimumSize=None, maximumSize=None, \
+    modifiedAfter=None, modifiedBefore=None):
+    # copies of the file entries (with full names) matching all given
+    # filters: datasets and pattern are glob patterns ('m0*', '*Sub4.mha')
+    # for the dataset and the file name, suffix the end of the file name
+    # ('_LobesDeposition.csv'), sizes in bytes and times in milliseconds
+    # like modificationTimestamp; both bounds are inclusive
+    where, parameters = self._where(datasets, pattern, suffix, minimumSize, maximumSize, \
+      modifiedAfter, modifiedBefore)
+    with self._connectionLock:
+      rows = self._database().execute('SELECT id FROM files WHERE '+where+' ORDER BY id', parameters).fetchall()
+    return [dict(self.entries[row[0]]) for row in rows]
+
+  def summarize(self, **filters):
+    # {dataset: (number of files, number of bytes)} of the files matching
+    # the filters of query
+    where, parameters = self._where(**filters)
+    with self._connectionLock:
+      rows = self._database().execute('SELECT dataset, COUNT(*), SUM(size) FROM files WHERE '+where+\
+        ' GROUP BY dataset ORDER BY dataset', parameters).fetchall()
+    return {dataset:(numberOfFiles, numberOfBytes) for dataset, numberOfFiles, numberOfBytes in rows}
+
+  def _where(self, datasets=None, pattern=None, suffix=None, minimumSize=None, maximumSize=None, \
+    modifiedAfter=None, modifiedBefore=None):
+    conditions, parameters = [], []
+    if datasets:
+      conditions.append('('+' OR '.join(['dataset GLOB ?']*len(datasets))+')')
+      parameters += list(datasets)
+    if pattern:
+      conditions.append('basename GLOB ?')
+      parameters.append(pattern)
+    if suffix:
+      conditions.append('substr(basename, -?) = ?')
+      parameters += [len(suffix), suffix]
+    for condition, value in [('size >= ?', minimumSize), ('size <= ?', maximumSize), \
+      ('modificationTimestamp >= ?', modifiedAfter), ('modificationTimestamp <= ?', modifiedBefore)]:
+      if value is not None:
+        conditions.append(condition)
+        parameters.append(value)
+    return ' AND '.join(conditions) or '1', parameters
+
+  def _database(self):
+    # expects self._connectionLock to be held
+    if self._connection is None:
+      self._connection = sqlite3.connect(':memory:', check_same_thread=False)
+      self._connection.execute('CREATE TABLE files (id INTEGER PRIMARY KEY, dataset TEXT, basename TEXT, '+\
+        'size INTEGER, modificationTimestamp INTEGER)')
+      self._connection.executemany('INSERT INTO files VALUES (?, ?, ?, ?, ?)', \
+        [(i, e['name'].split('/')[0], e['name'].split('/')[-1], e.get('size') or 0, e.get('modificationTimestamp') or 0) \
+        for i, e in enumerate(self.entries) if not e.get('isFolder') and '/' in e['name']])
+    return self._connection
+
+def mergeCatalogEntries(current, remote, timestamp):
+  # entries of catalog remote, where unchanged entries are those of current.
+  # A changed entry (size or folder flag differ, or newer
+  # modificationTimestamp) that has no newer modificationTimestamp than in
+  # current gets timestamp, so that downloaded copies are reported as
+  # 'require update' by getStatus. Returns (entries, names of the added,
+  # changed and removed entries)
+  currentEntries = {e['name']:e for e in current}
+  entries, changedNames = [], []
+  for e in remote:
+    old = currentEntries.get(e['name'])
+    remoteTimestamp = e.get('modificationTimestamp') or 0
+    if old is not None and old.get('size')==e.get('size') and old.get('isFolder')==e.get('isFolder') and \
+      remoteTimestamp<=(old.get('modificationTimestamp') or 0):
+      entries.append(old)
+      continue
+    if old is not None and remoteTimestamp<=(old.get('modificationTimestamp') or 0) or not remoteTimestamp:
+      e = dict(e, modificationTimestamp=timestamp)
+    entries.append(e)
+    changedNames.append(e['name'])
+  remoteNames = set(e['name'] for e in remote)
+  changedNames += [name for name in currentEntries if name not in remoteNames]
+  return entries, changedNames
@@ -0,0 +1,314 @@
+# Background download queue with a pool of worker threads.
+
+import os, sys, time, shutil, heapq, threading, collections
+
+from .Archive import lapdMouseDBUtil, partialFileSuffixes, unpackedFolderName
+
+class lapdMouseTokenBucket():
+  # Token bucket limiting the number of bytes per second shared by several
+  # threads; consume() blocks until the amount may be used. Requests larger
+  # than the bucket are allowed and paid back by waiting. A rate of 0 means
+  # no limit.
+
+  def __init__(self, rate=0, burst=1024*1024):
+    self.rate = rate
+    self.burst = burst
+    self._tokens = burst
+    self._last = time.time()
+    self._lock = threading.Lock()
+
+  def setRate(self, rate):
+    with self._lock:
+      self.rate = rate
+
+  def consume(self, amount):
+    with self._lock:
+      if not self.rate:
+        return
+      now = time.time()
+      self._tokens = min(self.burst, self._tokens+(now-self._last)*self.rate)-amount
+      self._last = now
+      delay = -self._tokens/self.rate if self._tokens<0 else 0
+    if delay>0:
+      time.sleep(delay)
+
+class lapdMouseDownloadEngine():
+  # Downloads files with a bounded pool of worker threads. Jobs are plain
+  # dicts; their 'status' moves from 'queued' over 'downloading' to 'done',
+  # 'failed', 'corrupt' (checksum mismatch), 'paused' or 'canceled'. Jobs can
+  # be added, paused, resumed and canceled while the engine runs. The engine
+  # never touches Qt, progress is polled by the caller via progress() and
+  # throughput().
+  # Queued jobs are started by priority (lower first), then by size. All
+  # transfers share the bandwidth limit of bandwidth (a lapdMouseTokenBucket),
+  # and jobs of a priority listed in allowedHours, e.g. {2:(22,6)}, are only
+  # started between those hours of the day.
+
+  def __init__(self, remoteFolderUrl, numberOfWorkers=4, manifest=None):
+    self.db = lapdMouseDBUtil(remoteFolderUrl)
+    self.manifest = manifest
+    self.numberOfWorkers = max(1, numberOfWorkers)
+    self.throughputWindow = 5.0 # seconds
+    self.bandwidth = lapdMouseTokenBucket()
+    self.allowedHours = {}
+    self.jobs = []
+    self._pending = [] # heap of (priority, size, sequence number, job)
+    self._sequence = 0
+    self._lock = threading.Lock()
+    self._jobsChanged = threading.Condition(self._lock)
+    self._started = False
+    self._canceled = False
+    self._threads = []
+    self._bytesTransferred = 0
+    self._throughputSamples = collections.deque()
+
+  def addJob(self, remoteName, localName, size=None, modificationTimestamp=None, priority=1, unpack=False):
+    # with unpack, a tar archive is unpacked while downloading, see
+    # lapdMouseDBUtil.downloadAndUnpack
+    job = {'remoteName':remoteName, 'localName':localName, 'size':size, \
+      'modificationTimestamp':modificationTimestamp, 'priority':priority, 'bytesDownloaded':0, \
+      'status':'queued', 'control':None, 'bytesTransferred':0, 'startTime':None, 'endTime':None, \
+      'unpack':unpack}
+    with self._lock:
+      self.jobs.append(job)
+      self._queue(job)
+    if self._started:
+      self._startWorkers()
+    return job
+
+  def start(self):
+    self._started = True
+    self._canceled = False
+    self._startWorkers()
+
+  def isRunning(self):
+    with self._lock:
+      return len(self._threads)>0
+
+  def wait(self, timeout=None):
+    t0 = time.time()
+    while True:
+      with self._lock:
+        threads = list(self._threads)
+      if len(threads)==0:
+        return True
+      remaining = None if timeout is None else timeout-(time.time()-t0)
+      if remaining is not None and remaining<=0:
+        return False
+      threads[0].join(remaining)
+
+  def cancel(self):
+    # stops all jobs, partial data is kept for resuming later
+    with self._lock:
+      self._canceled = True
+      for job in self.jobs:
+        self._stopJob(job, 'cancel')
+
+  def wasCanceled(self):
+    return self._canceled
+
+  def pauseJob(self, job):
+    with self._lock:
+      self._stopJob(job, 'pause')
+
+  def cancelJob(self, job):
+    # stops the job and deletes its partial data
+    with self._lock:
+      wasRunning = job['status']=='downloading'
+      self._stopJob(job, 'cancel')
+      job['discardPartialData'] = True
+    if not wasRunning:
+      self._discardPartialData(job)
+
+  def resumeJob(self, job):
+    with self._lock:
+      if job['status'] not in ['paused','canceled','failed','corrupt']:
+        return
+      job['status'] = 'queued'
+      job['bytesDownloaded'] = 0 # partial data is reported again when resuming
+      job['discardPartialData'] = False
+      self._queue(job)
+    if self._started:
+      self._startWorkers()
+
+  def setAllowedHours(self, priority, hours):
+    # hours is (startHour, endHour) or None for no restriction
+    with self._lock:
+      if hours is None:
+        self.allowedHours.pop(priority, None)
+      else:
+        self.allowedHours[priority] = hours
+      self._jobsChanged.notify_all()
+    if self._started:
+      self._startWorkers()
+
+  def isAllowedNow(self, priority):
+    hours = self.allowedHours.get(priority)
+    if hours is None:
+      return True
+    startHour, endHour = hours
+    hour = time.localtime().tm_hour
+    if startHour<=endHour:
+      return startHour<=hour<endHour
+    return hour>=startHour or hour<endHour
+
+  def findJob(self, localName, statuses=['queued','downloading','paused']):
+    with self._lock:
+      for job in self.jobs:
+        if job['localName']==localName and job['status'] in statuses:
+          return job
+    return None
+
+  def progress(self):
+    # returns (filesFinished, filesTotal, bytesDownloaded, bytesTotal)
+    with self._lock:
+      filesFinished = len([j for j in self.jobs if j['status'] in ['done','failed','corrupt','canceled']])
+      bytesDownloaded = sum(j['bytesDownloaded'] for j in self.jobs)
+      bytesTotal = sum(j['size'] or 0 for j in self.jobs)
+      return filesFinished, len(self.jobs), bytesDownloaded, bytesTotal
+
+  def throughput(self):
+    # bytes per second transferred over the last throughputWindow seconds
+    now = time.time()
+    with self._lock:
+      self._throughputSamples.append((now, self._bytesTransferred))
+      while len(self._throughputSamples)>2 and \
+        self._throughputSamples[1][0]<now-self.throughputWindow:
+        self._throughputSamples.popleft()
+      t0, bytes0 = self._throughputSamples[0]
+    return (self._bytesTransferred-bytes0)/(now-t0) if now>t0 else 0.0
+
+  def jobThroughput(self, job):
+    # average bytes per second since the job was (re)started
+    if job['startTime'] is None:
+      return 0.0
+    elapsed = (job['endTime'] or time.time())-job['startTime']
+    return job['bytesTransferred']/elapsed if elapsed>0 else 0.0
+
+  def failedJobs(self):
+    return [j for j in self.jobs if j['status'] in ['failed','corrupt']]
+
+  def _stopJob(self, job, control):
+    # expects the lock to be held
+    if job['status']=='queued':
+      self._pending = [entry for entry in self._pending if entry[3] is not job]
+      heapq.heapify(self._pending)
+      self._jobsChanged.notify_all()
+      job['status'] = 'paused' if control=='pause' else 'canceled'
+    elif job['status']=='paused' and control=='cancel':
+      job['status'] = 'canceled'
+    elif job['status']=='downloading':
+      job['control'] = control
+
+  def _discardPartialData(self, job):
+    for suffix in partialFileSuffixes:
+      if os.path.isdir(job['localName']+suffix):
+        shutil.rmtree(job['localName']+suffix)
+      elif os.path.exists(job['localName']+suffix):
+        os.remove(job['localName']+suffix)
+    if job['unpack'] and os.path.isdir(unpackedFolderName(job['localName'])):
+      shutil.rmtree(unpackedFolderName(job['localName']))
+    if self.manifest:
+      self.manifest.remove(job['remoteName'])
+
+  def _startWorkers(self):
+    with self._lock:
+      numberOfThreads = min(self.numberOfWorkers-len(self._threads), len(self._pending))
+      for i in range(numberOfThreads):
+        thread = threading.Thread(target=self._worker, name='lapdMouseDownload')
+        thread.daemon = True
+        self._threads.append(thread)
+        thread.start()
+
+  def _queue(self, job):
+    # expects the lock to be held
+    heapq.heappush(self._pending, (job['priority'], job['size'] or 0, self._sequence, job))
+    self._sequence += 1
+    self._jobsChanged.notify_all()
+
+  def _nextJob(self):
+    # a worker that finds no more work unregisters itself while holding the
+    # lock, so that addJob can tell whether a new worker is needed; if only
+    # jobs outside of their allowed hours are left, it waits for them
+    with self._lock:
+      while True:
+        if len(self._pending)==0:
+          self._threads.remove(threading.current_thread())
+          return None
+        if not self.allowedHours:
+          entry = heapq.heappop(self._pending)
+          break
+        allowed = [entry for entry in self._pending if self.isAllowedNow(entry[0])]
+        if len(allowed):
+          entry = min(allowed)
+          self._pending.remove(entry)
+          heapq.heapify(self._pending)
+          break
+        self._jobsChanged.wait(60)
+      job = entry[3]
+      job['status'] = 'downloading'
+      job['control'] = None
+      job['bytesTransferred'] = 0
+      job['startTime'] = time.time()
+      job['endTime'] = None
+      return job
+
+  def _worker(self):
+    while True:
+      job = self._nextJob()
+      if job is None:
+        break
+      self._runJob(job)
+
+  def _runJob(self, job):
+    def onProgress(numberOfBytes, transferred=True):
+      if transferred:
+        self.bandwidth.consume(numberOfBytes)
+      with self._lock:
+        job['bytesDownloaded'] += numberOfBytes
+        if transferred:
+          job['bytesTransferred'] += numberOfBytes
+          self._bytesTransferred += numberOfBytes
+        return job['control'] is None
+    localName = job['localName']
+    previousEntry = None
+    if self.manifest:
+      previousEntry = self.manifest.get(job['remoteName'])
+      self.manifest.setPartial(job['remoteName'], job['size'], job['modificationTimestamp'])
+    succeeded = False
+    try:
+      if job['unpack']:
+        succeeded = self.db.downloadAndUnpack(job['remoteName'], localName, job['size'], onProgress)
+      else:
+        succeeded = self.db.downloadFile(job['remoteName'], localName, job['size'], onProgress)
+    except:
+      print('Unexpected error downloading '+job['remoteName']+':', sys.exc_info()[0])
+    # an outdated copy of the file may still be at localName, only the
+    # result of this download counts
+    complete = bool(succeeded) and not os.path.exists(localName+'.corrupt') and \
+      (job['unpack'] or os.path.exists(localName))
+    if self.manifest:
+      if complete:
+        self.manifest.setComplete(job['remoteName'], job['size'] if job['unpack'] else os.path.getsize(localName), \
+          job['modificationTimestamp'], self.db.getExpectedMD5(job['remoteName']))
+      elif previousEntry is not None and previousEntry['state']=='complete' and os.path.exists(localName):
+        self.manifest.restore(previousEntry) # the outdated copy is still there
+      elif not os.path.exists(localName+('.part.unpack' if job['unpack'] else '.part')):
+        self.manifest.remove(job['remoteName'])
+    with self._lock:
+      control = job['control']
+      job['control'] = None
+      job['endTime'] = time.time()
+      if complete:
+        job['status'] = 'done'
+      elif os.path.exists(localName+'.corrupt'):
+        job['status'] = 'corrupt'
+      elif control=='pause':
+        job['status'] = 'paused'
+      elif control=='cancel':
+        job['status'] = 'canceled'
+      else:
+        job['status'] = 'failed'
+      discard = job['status']=='canceled' and job.get('discardPartialData')
+    if discard:
+      self._discardPartialData(job)
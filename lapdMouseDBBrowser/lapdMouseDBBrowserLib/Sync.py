@@ -0,0 +1,145 @@
+# Command line synchronization of a local folder with the lapdMouse archive,
+# e.g. to mirror datasets onto compute nodes from cron:
+#
+#   Slicer --no-main-window --python-script <path>/lapdMouseDBBrowserLib/Sync.py \
+#     --local-folder /data/lapdMouse --datasets 'm0*' --files '*Sub4.mha,*.nrrd'
+#
+# or with a plain Python 3 interpreter:
+#
+#   python <path>/lapdMouseDBBrowserLib/Sync.py --local-folder /data/lapdMouse --dry-run
+#
+# Refreshes the catalog of the local folder from the archive (the bundled
+# catalog is used when offline), prints the status summary of the matching
+# files and downloads the missing and outdated ones with a pool of parallel
+# workers. Exit code 0 if all files are up to date, 1 if downloads failed,
+# 2 if the archive is not reachable and 3 if another sync of the same
+# folder is running. Use --help for all options.
+
+import os, sys, time, fnmatch, argparse
+
+if __name__ == '__main__':
+  sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lapdMouseDBBrowserLib.Archive import lapdMouseDBUtil, defaultRemoteFolderUrl, testDBAccess
+from lapdMouseDBBrowserLib.Cache import lapdMouseCacheManifest, lapdMouseSharedCache, getStatus, summarizeItems, listItem, \
+  humanReadableSize, humanReadableTime
+from lapdMouseDBBrowserLib.Catalog import lapdMouseCatalog
+from lapdMouseDBBrowserLib.DownloadEngine import lapdMouseDownloadEngine
+
+def matches(name, patterns):
+  return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(name.split('/')[-1], p) for p in patterns)
+
+def listItems(db, localFolder, datasetPatterns=['*'], filePatterns=['*'], manifest=None):
+  # catalog files of the matching datasets and file names (including those
+  # in subfolders) as items for getStatus/downloadItem, with their status
+  items = []
+  datasets = [d['name'] for d in db.listDirectory() if d['isFolder'] and matches(d['name'], datasetPatterns)]
+  for dataset in sorted(datasets):
+    for f in db.listDirectory(dataset, sys.maxsize):
+      if f['isFolder'] or not matches(f['name'], filePatterns):
+        continue
+      remoteName = dataset+'/'+f['name']
+      item = {'remoteName':remoteName, 'localName':os.path.join(localFolder, remoteName.replace('/',os.sep)), \
+        'isFolder':False, 'size':f['size'], 'modificationTimestamp':f['modificationTimestamp']}
+      item['status'] = getStatus(item, manifest)
+      items.append(item)
+  return items
+
+def sync(items, remoteFolderUrl, manifest=None, numberOfWorkers=4, bandwidthLimit=0, unpack=False, \
+  progressInterval=60, sharedCache=None):
+  # downloads the items that are not up to date; returns the failed jobs
+  engine = lapdMouseDownloadEngine(remoteFolderUrl, numberOfWorkers, manifest)
+  engine.bandwidth.setRate(bandwidthLimit)
+  engine.db.sharedCache = sharedCache
+  for item in items:
+    if item['status']!='downloaded':
+      engine.addJob(item['remoteName'], item['localName'], item['size'], item['modificationTimestamp'], \
+        unpack=unpack and item['remoteName'].endswith('.tar'))
+  if len(engine.jobs)==0:
+    return []
+  t0 = time.time()
+  engine.start()
+  try:
+    while not engine.wait(progressInterval):
+      filesFinished, filesTotal, bytesDownloaded, bytesTotal = engine.progress()
+      print('%s %d/%d files, %s of %s, %s/s' % (humanReadableTime(time.time()-t0), filesFinished, filesTotal, \
+        humanReadableSize(bytesDownloaded), humanReadableSize(bytesTotal), \
+        humanReadableSize(engine.throughput())), flush=True)
+  except KeyboardInterrupt:
+    print('Interrupted, partial downloads are kept for the next run', flush=True)
+    engine.cancel()
+    engine.wait()
+  for job in engine.jobs:
+    print(job['remoteName']+' ['+job['status']+']')
+  return [j for j in engine.jobs if j['status']!='done']
+
+def lockFolder(localFolder):
+  # only one sync per local folder at a time; returns the lock file, which
+  # has to be kept open, or None if another process holds the lock
+  os.makedirs(localFolder, exist_ok=True)
+  lockFile = open(os.path.join(localFolder, '.lapdMouseSync.lock'), 'a')
+  try:
+    import fcntl
+  except ImportError:
+    return lockFile # no locking on this platform
+  try:
+    fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except OSError:
+    lockFile.close()
+    return None
+  return lockFile
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='Synchronize a local folder with the lapdMouse archive.')
+  parser.add_argument('--local-folder', default=os.path.join(os.path.expanduser('~'),'lapdMouse'), \
+    help='local storage folder (default: ~/lapdMouse)')
+  parser.add_argument('--datasets', default='*', help='comma separated dataset names or patterns (default: all)')
+  parser.add_argument('--files', default='*', help='comma separated file names or patterns, e.g. \'*Sub4.mha,*.nrrd\' (default: all)')
+  parser.add_argument('--dry-run', action='store_true', help='only print the status summary')
+  parser.add_argument('--list', action='store_true', help='print the status of every matching file')
+  parser.add_argument('--workers', type=int, default=4, help='number of parallel downloads (default: 4)')
+  parser.add_argument('--bandwidth', type=float, default=0, help='total download rate limit in MB/s (default: unlimited)')
+  parser.add_argument('--unpack', action='store_true', help='unpack raw data tar archives while downloading')
+  parser.add_argument('--shared-cache', default=None, help='folder shared between users that holds every file once, see README')
+  parser.add_argument('--progress-interval', type=float, default=60, help='seconds between progress reports')
+  parser.add_argument('--remote-url', default=defaultRemoteFolderUrl, help=argparse.SUPPRESS)
+  parser.add_argument('--catalog', default=None, help=argparse.SUPPRESS)
+  args = parser.parse_args(argv)
+
+  db = lapdMouseDBUtil(args.remote_url)
+  if args.catalog:
+    db.catalogFile = args.catalog
+  else:
+    db.refreshCatalog(os.path.join(args.local_folder, lapdMouseCatalog.cachedFileName))
+  lockFile = None
+  if not args.dry_run:
+    lockFile = lockFolder(args.local_folder)
+    if lockFile is None:
+      print('Another sync of '+args.local_folder+' is running', flush=True)
+      return 3
+  try:
+    manifest = lapdMouseCacheManifest(args.local_folder)
+    items = listItems(db, args.local_folder, args.datasets.split(','), args.files.split(','), manifest)
+    if args.list:
+      for item in items:
+        listItem(item)
+    summarizeItems(items)
+    if args.dry_run or all(i['status']=='downloaded' for i in items):
+      return 0
+    if not testDBAccess(db):
+      return 2
+    failedJobs = sync(items, args.remote_url, manifest, args.workers, int(args.bandwidth*1024*1024), \
+      args.unpack, args.progress_interval, lapdMouseSharedCache(args.shared_cache) if args.shared_cache else None)
+    if len(failedJobs):
+      print(str(len(failedJobs))+' file(s) could not be downloaded', flush=True)
+      return 1
+    return 0
+  finally:
+    if lockFile:
+      lockFile.close()
+
+if __name__ == '__main__':
+  exitCode = main(sys.argv[1:])
+  if 'slicer' in sys.modules:
+    import slicer
+    slicer.util.exit(exitCode)
+  sys.exit(exitCode)
@@ -0,0 +1,228 @@
+# Local stand-in for the lapdMouse archive, used by tests and benchmarks.
+# Not exported by the package, import it from lapdMouseDBBrowserLib.TestServer.
+
+import os, time, ssl, hashlib, threading, urllib.parse, email.utils
+
+class lapdMouseSyntheticFile():
+  # read-only file object of the given size repeating block, used by
+  # lapdMouseDBBrowserTestServer to serve large files without storing them
+
+  def __init__(self, block, size):
+    self.block = block
+    self.size = size
+    self.position = 0
+
+  def seek(self, position):
+    self.position = position
+
+  def read(self, amt=-1):
+    if amt<0:
+      amt = self.size-self.position
+    amt = max(0, min(amt, self.size-self.position))
+    offset = self.position%len(self.block)
+    chunks = []
+    remaining = amt
+    while remaining>0:
+      chunk = self.block[offset:offset+remaining]
+      chunks.append(chunk)
+      remaining -= len(chunk)
+      offset = 0
+    self.position += amt
+    return b''.join(chunks)
+
+  def md5(self):
+    digest = hashlib.md5()
+    self.seek(0)
+    while self.position<self.size:
+      digest.update(self.read(len(self.block)))
+    return digest.hexdigest()
+
+  def close(self):
+    pass
+
+class lapdMouseDBBrowserTestServer():
+  # Local HTTP(S) stand-in for the lapdMouse archive, run in a background
+  # thread with keep-alive connections. Serves either the files of
+  # rootFolder or, with syntheticFiles={remoteName:size}, generated content
+  # (see syntheticContent) including a MD5SUMS file per folder.
+  # Supports single 'Range: bytes=a-b' requests; received Range headers are
+  # recorded in rangeRequests, the number of accepted connections in
+  # connectionCount. HTTPS is used if a certificate file (see
+  # createCertificate) is given. For benchmarks, each response can be
+  # delayed by latency seconds, limited to bandwidth bytes/s and, with
+  # probability failureRate, cut off half way through its body (except for
+  # MD5SUMS files). Files of rootFolder are sent with ETag and
+  # Last-Modified, and requests with a matching If-None-Match (or, without
+  # it, If-Modified-Since) are answered with 304, counted in
+  # notModifiedCount.
+
+  def __init__(self, rootFolder=None, certificateFile=None, syntheticFiles=None, \
+    latency=0, bandwidth=0, failureRate=0, seed=0):
+    import http.server, functools, random, socket
+    server = self
+    self.syntheticFiles = syntheticFiles or {}
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.failureRate = failureRate
+    self.random = random.Random(seed)
+    self.rangeRequests = []
+    self.connectionCount = 0
+    self.failureCount = 0
+    self.notModifiedCount = 0
+    self._md5sums = {}
+    class QuietHandler(http.server.SimpleHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      disable_nagle_algorithm = True # headers and body are separate writes
+      def setup(self):
+        server.connectionCount += 1
+        super().setup()
+      def log_message(self, format, *args):
+        pass
+      def send_head(self):
+        self._remaining = None
+        if server.latency:
+          time.sleep(server.latency)
+        source = server._open(self.path.lstrip('/'), self.translate_path(self.path))
+        if source is None:
+          return super().send_head()
+        f, size = source
+        validators = server._validators(self.translate_path(self.path))
+        if validators and server._notModified(self.headers, validators):
+          f.close()
+          server.notModifiedCount += 1
+          self.send_response(304)
+          self.send_header('ETag', validators['ETag'])
+          self.end_headers()
+          return None
+        start, end = 0, size-1
+        rangeHeader = self.headers.get('Range')
+        if rangeHeader is not None:
+          server.rangeRequests.append(rangeHeader)
+          start, end = rangeHeader[len('bytes='):].split('-')
+          start = int(start)
+          end = min(int(end), size-1) if end else size-1
+          if start>=size:
+            f.close()
+            self.send_error(416)
+            return None
+        f.seek(start)
+        self.send_response(206 if rangeHeader is not None else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if rangeHeader is not None:
+          self.send_header('Content-Range', 'bytes '+str(start)+'-'+str(end)+'/'+str(size))
+        self.send_header('Content-Length', str(end-start+1))
+        for key, value in (validators or {}).items():
+          self.send_header(key, value)
+        self.end_headers()
+        self._remaining = end-start+1
+        self._failAfter = None
+        if server.failureRate and os.path.basename(self.path)!='MD5SUMS' and \
+          server.random.random()<server.failureRate:
+          self._failAfter = self._remaining//2
+        return f
+      def copyfile(self, source, outputfile):
+        if self._remaining is None:
+          return super().copyfile(source, outputfile)
+        t0 = time.time()
+        sent = 0
+        while self._remaining>0:
+          buffer = source.read(min(self._remaining, 64*1024))
+          if not buffer:
+            break
+          if self._failAfter is not None and sent+len(buffer)>self._failAfter:
+            server.failureCount += 1
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+          outputfile.write(buffer)
+          sent += len(buffer)
+          self._remaining -= len(buffer)
+          if server.bandwidth:
+            delay = sent/server.bandwidth-(time.time()-t0)
+            if delay>0:
+              time.sleep(delay)
+    class QuietServer(http.server.ThreadingHTTPServer):
+      def handle_error(self, request, clientAddress):
+        pass # clients aborting a transfer is expected
+    handler = functools.partial(QuietHandler, directory=rootFolder or os.getcwd())
+    self.httpd = QuietServer(('127.0.0.1', 0), handler)
+    self.httpd.daemon_threads = True
+    scheme = 'http'
+    if certificateFile:
+      context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+      context.load_cert_chain(certificateFile)
+      self.httpd.socket = context.wrap_socket(self.httpd.socket, server_side=True)
+      scheme = 'https'
+    self.url = scheme+'://127.0.0.1:'+str(self.httpd.server_address[1])+'/'
+    self.thread = threading.Thread(target=self.httpd.serve_forever)
+    self.thread.daemon = True
+
+  @staticmethod
+  def syntheticContent(remoteName, size):
+    # deterministic content: a 64 KB block derived from the name, repeated
+    return lapdMouseSyntheticFile(hashlib.sha256(remoteName.encode()).digest()*2048, size)
+
+  def _open(self, remoteName, localPath):
+    # (file object, size) for files served with Range support, None to let
+    # SimpleHTTPRequestHandler handle the request
+    remoteName = urllib.parse.unquote(remoteName)
+    if os.path.basename(remoteName)=='MD5SUMS' and len(self.syntheticFiles):
+      folder = os.path.dirname(remoteName)
+      if folder not in self._md5sums:
+        lines = [self.syntheticContent(name, size).md5()+'  '+os.path.basename(name)+'\n' \
+          for name, size in self.syntheticFiles.items() \
+          if os.path.dirname(name)==folder and os.path.basename(name)!='MD5SUMS']
+        self._md5sums[folder] = ''.join(lines).encode()
+      content = self._md5sums[folder]
+      return lapdMouseSyntheticFile(content, len(content)), len(content)
+    if remoteName in self.syntheticFiles:
+      size = self.syntheticFiles[remoteName]
+      return self.syntheticContent(remoteName, size), size
+    if os.path.isfile(localPath):
+      return open(localPath, 'rb'), os.path.getsize(localPath)
+    return None
+
+  def _validators(self, localPath):
+    if not os.path.isfile(localPath):
+      return None
+    stat = os.stat(localPath)
+    return {'ETag':'"%x-%x"' % (stat.st_mtime_ns, stat.st_size), \
+      'Last-Modified':email.utils.formatdate(stat.st_mtime, usegmt=True)}
+
+  def _notModified(self, headers, validators):
+    if headers.get('If-None-Match') is not None:
+      return headers['If-None-Match']==validators['ETag']
+    if headers.get('If-Modified-Since') is not None:
+      try:
+        return email.utils.parsedate_to_datetime(headers['If-Modified-Since'])>= \
+          email.utils.parsedate_to_datetime(validators['Last-Modified'])
+      except (TypeError, ValueError):
+        return False
+    return False
+
+  @staticmethod
+  def createCertificate(folder):
+    # self-signed certificate+key for 127.0.0.1 in a single PEM file, None
+    # if the openssl command line tool is not available
+    import subprocess
+    certificateFile = os.path.join(folder, 'localhost.pem')
+    try:
+      subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', \
+        '-subj', '/CN=127.0.0.1', '-addext', 'subjectAltName=IP:127.0.0.1', \
+        '-keyout', certificateFile, '-out', certificateFile+'.crt'], \
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+      return None
+    with open(certificateFile+'.crt') as f:
+      certificate = f.read()
+    with open(certificateFile, 'a') as f:
+      f.write(certificate)
+    return certificateFile
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *args):
+    self.httpd.shutdown()
+    self.httpd.server_close()
@@ -0,0 +1,4 @@
+from .Archive import *
+from .Cache import *
+from .Catalog import *
+from .DownloadEngine import *
@@ -0,0 +1,106 @@
+"""Airway tree reading benchmark for lapdMouseVisualizer.
+
+Compares lapdMouseVisualizerLogic.readMetaTree with the previous line by
+line parser (_readMetaTreeLineByLine) on an airway tree file, either a
+downloaded *_AirwayTree.meta or a synthetic tree of about the same size,
+and checks that both return the same tubes:
+
+  Slicer --no-main-window --python-script lapdMouseVisualizerBenchmark.py \\
+    --file ~/lapdMouse/m01/m01_AirwayTree.meta
+
+Use --help for all options.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import tempfile
+import argparse
+import platform
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from lapdMouseVisualizer import lapdMouseVisualizerLogic
+
+def writeSyntheticTree(fileName, numberOfTubes=2000, pointsPerTube=25, seed=0):
+  # MetaIO tube tree with the columns of the lapdMouse airway trees; the
+  # defaults give about the size of m01_AirwayTree.meta
+  generator = random.Random(seed)
+  with open(fileName, 'w') as f:
+    f.write('ObjectType = Scene\nNDims = 3\nNObjects = %d\n' % numberOfTubes)
+    for tubeID in range(1, numberOfTubes+1):
+      f.write('ObjectType = Tube\nNDims = 3\nID = %d\nParentID = %d\n' % (tubeID, tubeID//2))
+      if tubeID==1:
+        f.write('Name = Trachea\n')
+      f.write('Color = 1 0 0 1\nPointDim = x y z r v1x v1y v1z v2x v2y v2z tx ty tz red green blue alpha id\n')
+      f.write('NPoints = %d\nPoints = \n' % pointsPerTube)
+      for i in range(pointsPerTube):
+        values = [generator.uniform(-10,10) for j in range(3)]+[generator.uniform(0,1)]+ \
+          [generator.uniform(-1,1) for j in range(9)]+[1, 0, 0, 1, tubeID]
+        f.write(' '.join('%g' % v for v in values)+' \n')
+
+def sameTrees(tree, reference):
+  # reference as returned by _readMetaTreeLineByLine
+  if sorted(tree.keys())!=sorted(reference.keys()):
+    return False
+  for ID, tube in tree.items():
+    referenceTube = reference[ID]
+    if sorted(tube.keys())!=sorted(referenceTube.keys()):
+      return False
+    for key, value in tube.items():
+      if key in ('Coordinates', 'Radius', 'Color'):
+        value = value.tolist()
+      if value!=referenceTube[key]:
+        return False
+  return True
+
+def benchmark(fileName, repetitions=3):
+  logic = lapdMouseVisualizerLogic()
+  results = {}
+  for label, read in [('line by line', logic._readMetaTreeLineByLine), ('readMetaTree', logic.readMetaTree)]:
+    timings = []
+    for repetition in range(repetitions):
+      t0 = time.perf_counter()
+      tree = read(fileName)
+      timings.append(time.perf_counter()-t0)
+    results[label] = {'seconds':min(timings), 'tubes':len(tree)}
+    print('%-15s %6d tubes %8.3f s' % (label, len(tree), min(timings)))
+  results['speedup'] = results['line by line']['seconds']/results['readMetaTree']['seconds']
+  results['sameTrees'] = sameTrees(logic.readMetaTree(fileName), logic._readMetaTreeLineByLine(fileName))
+  print('speedup %.1fx, same trees: %s' % (results['speedup'], results['sameTrees']))
+  return results
+
+def main(argv):
+  parser = argparse.ArgumentParser(description='lapdMouseVisualizer airway tree reading benchmark')
+  parser.add_argument('--file', default=None, help='airway tree file (default: synthetic tree)')
+  parser.add_argument('--tubes', type=int, default=2000, help='number of tubes of the synthetic tree')
+  parser.add_argument('--points', type=int, default=25, help='points per tube of the synthetic tree')
+  parser.add_argument('--repetitions', type=int, default=3)
+  parser.add_argument('--output', default=None, help='write results as JSON to this file')
+  args = parser.parse_args(argv)
+
+  fileName = args.file
+  if fileName is None:
+    fileName = os.path.join(tempfile.mkdtemp(), 'synthetic_AirwayTree.meta')
+    writeSyntheticTree(fileName, args.tubes, args.points)
+  try:
+    print('%s (%.1f MB)' % (fileName, os.path.getsize(fileName)/1e6))
+    results = benchmark(fileName, args.repetitions)
+  finally:
+    if args.file is None:
+      os.remove(fileName)
+      os.rmdir(os.path.dirname(fileName))
+  results.update({'file':args.file or 'synthetic', 'timestamp':time.strftime('%Y-%m-%dT%H:%M:%S'), \
+    'python':platform.python_version(), 'platform':platform.platform()})
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+  return 0 if results['sameTrees'] else 1
+
+if __name__ == '__main__':
+  exitCode = main(sys.argv[1:])
+  if 'slicer' in sys.modules:
+    import slicer
+    slicer.util.exit(exitCode)
+  sys.exit(exitCode)
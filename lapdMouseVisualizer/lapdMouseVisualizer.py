@@ -206,7 +206,78 @@ class lapdMouseVisualizerWidget(ScriptedLoadableModuleWidget):
 class lapdMouseVisualizerLogic(ScriptedLoadableModuleLogic):
     
   def readMetaTree(self, filename):
-    # read *.meta file and extracts 'Tube' objects
+    # read *.meta file and extracts 'Tube' objects; the header lines are
+    # scanned once, skipping the point lists, which are then converted
+    # together (per tube if their columns differ) into arrays 'Coordinates'
+    # (N,3), 'Radius' (N) and 'Color' (N,3), with the values of
+    # _readMetaTreeLineByLine
+    import numpy
+    with open(filename,'r') as f:
+      lines = f.read().split('\n')
+    if len(lines)>0 and lines[-1]=='':
+      lines.pop()
+    tree = {}
+    tubes = [] # (tube, index of its first point line)
+    tube = None
+    i = 0
+    while i<len(lines):
+      line = lines[i]
+      i += 1
+      if line.startswith('ObjectType = '):
+        tube = {} if line.endswith('Tube') else None
+        continue
+      if tube is None or ' = ' not in line:
+        continue
+      key, value = line.split(' = ', 1)
+      if key in ('ID', 'ParentID', 'NPoints'):
+        tube[key] = int(value)
+      elif key=='Name':
+        tube['Name'] = value
+      elif key=='Points':
+        if tube['NPoints']>0 and i+tube['NPoints']<=len(lines):
+          tubes.append((tube, i))
+          tree[tube['ID']] = tube
+        i += tube['NPoints']
+    pointLines = []
+    for tube, firstLine in tubes:
+      pointLines += lines[firstLine:firstLine+tube['NPoints']]
+    points = self._metaTreePoints(pointLines)
+    start = 0
+    for tube, firstLine in tubes:
+      if points is not None:
+        tubePoints = points[start:start+tube['NPoints']]
+        start += tube['NPoints']
+      else:
+        tubePoints = self._metaTreePoints(lines[firstLine:firstLine+tube['NPoints']])
+      if tubePoints is None:
+        tubePoints = numpy.array([[float(x) for x in line.split(' ')[0:-1]] \
+          for line in lines[firstLine:firstLine+tube['NPoints']]])
+      tube['Coordinates'] = tubePoints[:,0:3]
+      tube['Radius'] = tubePoints[:,3]
+      tube['Color'] = tubePoints[:,-5:-2]
+    self._addChildIDs(tree)
+    return tree
+
+  def _metaTreePoints(self, pointLines):
+    # values of the point lines as rows of an array, without the last space
+    # separated token of each line (usually empty); None if the lines have
+    # different numbers of values
+    import numpy
+    if len(pointLines)==0:
+      return numpy.zeros((0,0))
+    trailingSpaces = sum(1 for line in pointLines if line.endswith(' '))
+    if trailingSpaces in (0, len(pointLines)):
+      try:
+        values = numpy.loadtxt(pointLines, dtype=numpy.float64, comments=None, ndmin=2)
+        if values.shape[0]==len(pointLines):
+          return values if trailingSpaces else values[:,0:-1]
+      except ValueError:
+        pass
+    return None
+
+  def _readMetaTreeLineByLine(self, filename):
+    # previous implementation of readMetaTree, with lists instead of arrays;
+    # kept for comparison, see Testing/Python/lapdMouseVisualizerBenchmark.py
     tree = {}
     tube = None
     readNPoints = 0
@@ -236,7 +307,10 @@ class lapdMouseVisualizerLogic(ScriptedLoadableModuleLogic):
           tube['Color'] = []
       if line.startswith('ObjectType = '):
         tube = {} if line.endswith('Tube') else None
-          
+    self._addChildIDs(tree)
+    return tree
+
+  def _addChildIDs(self, tree):
     # establish list of child IDs for each tube
     for ID in tree.keys():
       tube = tree[ID]
@@ -246,8 +320,6 @@ class lapdMouseVisualizerLogic(ScriptedLoadableModuleLogic):
           parent['ChildIDs'].append(tube['ID'])
         else:
           parent['ChildIDs'] = [tube['ID']]
-    
-    return tree
   
   # Sets and hides a transform
   def getTransformNode(self):
@@ -490,6 +562,7 @@ class lapdMouseVisualizerTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_lapdMouseVisualizer1()
+    self.test_lapdMouseVisualizerReadMetaTree()
 
   def test_lapdMouseVisualizer1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -532,3 +605,43 @@ class lapdMouseVisualizerTest(ScriptedLoadableModuleTest):
     slicer.mrmlScene.AddNode(model)
     
     self.delayDisplay('Test passed!')
+
+  def test_lapdMouseVisualizerReadMetaTree(self):
+    # same tubes as the line by line parser, including tubes without
+    # points, other objects, lines without trailing space and tubes with
+    # other columns
+    import tempfile, shutil
+    pointDim = 'PointDim = x y z r v1x v1y v1z v2x v2y v2z tx ty tz red green blue alpha id\n'
+    text = 'ObjectType = Scene\nNDims = 3\nNObjects = 5\n'
+    text += 'ObjectType = Tube\nNDims = 3\nID = 1\nParentID = 0\nName = Trachea\n'+pointDim+'NPoints = 2\nPoints = \n'
+    text += '0 0 0 0.5 1 0 0 0 1 0 0 0 1 1 0 0 1 1 \n0.25 -1.5 10 0.75 1 0 0 0 1 0 0 0 1 1 0 0 1 1 \n'
+    text += 'ObjectType = Tube\nNDims = 3\nID = 2\nParentID = 1\n'+pointDim+'NPoints = 0\nPoints = \n'
+    text += 'ObjectType = Ellipse\nNDims = 3\nID = 7\nRadius = 1 1 1\n'
+    text += 'ObjectType = Tube\nNDims = 3\nID = 3\nParentID = 1\n'+pointDim+'NPoints = 3\nPoints = \n'
+    text += '1 2 3 0.1 0 0 0 0 0 0 0 0 0 0.5 0.25 0.125 1 3\n'*2+'4 5 6 0.3 0 0 0 0 0 0 0 0 0 1 1 1 1 3\n'
+    text += 'ObjectType = Tube\nNDims = 3\nID = 4\nParentID = 3\nPointDim = x y z r red green blue alpha\n'
+    text += 'NPoints = 2\nPoints = \n1e-3 2.5E2 -0 2 0.1 0.2 0.3 1 \n7 8 9 4 0.4 0.5 0.6 1 \n'
+    folder = tempfile.mkdtemp()
+    try:
+      filename = os.path.join(folder, 'test_AirwayTree.meta')
+      with open(filename, 'w') as f:
+        f.write(text)
+      logic = lapdMouseVisualizerLogic()
+      tree = logic.readMetaTree(filename)
+      reference = logic._readMetaTreeLineByLine(filename)
+      self.assertEqual(sorted(tree.keys()), [1, 3, 4])
+      self.assertEqual(sorted(tree.keys()), sorted(reference.keys()))
+      for ID in tree:
+        self.assertEqual(sorted(tree[ID].keys()), sorted(reference[ID].keys()))
+        for key in tree[ID]:
+          value = tree[ID][key]
+          if key in ('Coordinates', 'Radius', 'Color'):
+            value = value.tolist()
+          self.assertEqual(value, reference[ID][key])
+      self.assertEqual(tree[1]['Coordinates'].shape, (2,3))
+      self.assertEqual(tree[1]['Name'], 'Trachea')
+      self.assertEqual(tree[1]['ChildIDs'], [3])
+      self.assertEqual(tree[1]['Color'].tolist(), [[1, 0, 0]]*2)
+      self.assertEqual(tree[4]['Radius'].tolist(), [2, 4])
+    finally:
+      shutil.rmtree(folder)